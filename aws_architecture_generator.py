@@ -1,15 +1,34 @@
-import boto3
 import json
 import os
 import sys
 import random
 from pathlib import Path
-from botocore.exceptions import ClientError
-import importlib
-import pkgutil
 import ast
 import re
-from diagrams import __path__ as diagrams_path
+import threading
+import functools
+import argparse
+import atexit
+import builtins
+import contextlib
+import difflib
+import hashlib
+import importlib.util
+import io
+import keyword
+import math
+import mimetypes
+import queue
+import select
+import shutil
+import subprocess
+import tempfile
+import time
+import traceback
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from http import HTTPStatus
+from urllib.parse import unquote, urlsplit
 
 """
 Anthropic Claude 3.7 Sonnet reasoning capability
@@ -24,7 +43,174 @@ with Amazon Bedrock
 # Get region and model from environment variables with defaults
 AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
 AWS_BEDROCK_MODEL = os.environ.get('AWS_BEDROCK_MODEL', 'us.anthropic.claude-3-7-sonnet-20250219-v1:0' ) #'anthropic.claude-3-sonnet-20240229-v1:0'
-tracking_number = random.randint(1, 1000)  
+# Shared Bedrock client connection pool and retry/backoff settings
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_BEDROCK_MAX_POOL_CONNECTIONS', '10'))
+BEDROCK_MAX_ATTEMPTS = int(os.environ.get('AWS_BEDROCK_MAX_ATTEMPTS', '5'))
+BEDROCK_READ_TIMEOUT = int(os.environ.get('AWS_BEDROCK_READ_TIMEOUT', '300'))
+# Local cache directory for the class index and Bedrock responses
+CACHE_DIR = Path(os.environ.get('AWS_DIAGRAM_CACHE_DIR', Path.home() / ".cache" / "aws_architecture_generator"))
+RESPONSE_CACHE_MAX_MB = float(os.environ.get('AWS_DIAGRAM_RESPONSE_CACHE_MAX_MB', '200'))
+RESPONSE_CACHE_MAX_AGE_DAYS = float(os.environ.get('AWS_DIAGRAM_RESPONSE_CACHE_MAX_AGE_DAYS', '30'))
+RENDER_CACHE_MAX_MB = float(os.environ.get('AWS_DIAGRAM_RENDER_CACHE_MAX_MB', '500'))
+
+####section on telemetry
+# Every stage (prompt build, Bedrock call, extraction, class map load, import repair,
+# static check, render) appends one JSON line with its wall time, tokens and cache hits.
+# Set AWS_DIAGRAM_TELEMETRY=off to disable.
+TELEMETRY_PATH = os.environ.get('AWS_DIAGRAM_TELEMETRY', str(CACHE_DIR / "telemetry.jsonl"))
+# Stable ID for this run, inherited by worker processes through the environment
+RUN_ID = os.environ.setdefault('AWS_DIAGRAM_RUN_ID', f"{random.getrandbits(64):016x}")
+_telemetry_lock = threading.Lock()
+
+def record_stage(stage, seconds, **fields):
+    """Append one stage record to the telemetry file"""
+    if TELEMETRY_PATH.lower() == "off":
+        return
+    record = {"run_id": RUN_ID, "stage": stage, "time": round(time.time(), 3), "seconds": round(seconds, 4), **fields}
+    try:
+        Path(TELEMETRY_PATH).parent.mkdir(parents=True, exist_ok=True)
+        line = json.dumps(record, default=str) + "\n"
+        with _telemetry_lock, open(TELEMETRY_PATH, "a") as telemetry_file:
+            telemetry_file.write(line)
+    except OSError as e:
+        print(f"[WARN] Could not write telemetry: {e}")
+
+def error_name(error):
+    """AWS error code of a botocore ClientError (e.g. ThrottlingException), otherwise the exception class name"""
+    return (getattr(error, "response", None) or {}).get("Error", {}).get("Code") or type(error).__name__
+
+def instrumented(stage, fields=None, context=None):
+    """Decorator recording the wall time of each call as a telemetry stage;
+    fields(result) adds stage specific values such as tokens or cache hits, and
+    context(*args, **kwargs) values known from the arguments, also recorded on failure"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            known = {}
+            if context:
+                try:
+                    known = context(*args, **kwargs)
+                except Exception:
+                    known = {}
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as e:
+                record_stage(stage, time.perf_counter() - start, ok=False, error=error_name(e), **known)
+                raise
+            extra = {}
+            if fields:
+                try:
+                    extra = fields(result)
+                except Exception:
+                    extra = {}
+            record_stage(stage, time.perf_counter() - start, **{"ok": True, **known, **extra})
+            return result
+        return wrapper
+    return decorator
+
+def load_telemetry(path=None, since_days=None):
+    """Stage records from the telemetry file, optionally only the last since_days days"""
+    path = Path(path or TELEMETRY_PATH)
+    oldest = time.time() - since_days * 86400 if since_days else 0
+    records = []
+    if not path.exists():
+        return records
+    with open(path) as telemetry_file:
+        for line in telemetry_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("time", 0) >= oldest:
+                records.append(record)
+    return records
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def summarize_telemetry(records):
+    """Per stage count, p50/p95 seconds, p50/p95 tokens, cache hit rate and failures"""
+    stages = {}
+    for record in records:
+        stages.setdefault(record["stage"], []).append(record)
+    summary = {}
+    for stage, items in stages.items():
+        seconds = [item["seconds"] for item in items]
+        tokens = [item.get("input_tokens", 0) + item.get("output_tokens", 0) for item in items if "input_tokens" in item]
+        cached = [item["cache_hit"] for item in items if "cache_hit" in item]
+        summary[stage] = {"count": len(items), "failed": sum(not item.get("ok", True) for item in items),
+                          "p50_seconds": percentile(seconds, 0.5), "p95_seconds": percentile(seconds, 0.95),
+                          "total_seconds": sum(seconds),
+                          "p50_tokens": percentile(tokens, 0.5), "p95_tokens": percentile(tokens, 0.95),
+                          "total_tokens": sum(tokens) if tokens else None,
+                          "cache_hit_rate": sum(cached) / len(cached) if cached else None}
+    return summary
+
+def format_prometheus(summary):
+    """Prometheus text exposition of a telemetry summary, e.g. for the node_exporter textfile collector"""
+    lines = ["# HELP aws_diagram_stage_seconds Wall time per pipeline stage.",
+             "# TYPE aws_diagram_stage_seconds summary"]
+    for stage, values in summary.items():
+        lines.append(f'aws_diagram_stage_seconds{{stage="{stage}",quantile="0.5"}} {values["p50_seconds"]}')
+        lines.append(f'aws_diagram_stage_seconds{{stage="{stage}",quantile="0.95"}} {values["p95_seconds"]}')
+        lines.append(f'aws_diagram_stage_seconds_sum{{stage="{stage}"}} {round(values["total_seconds"], 4)}')
+        lines.append(f'aws_diagram_stage_seconds_count{{stage="{stage}"}} {values["count"]}')
+    lines += ["# HELP aws_diagram_stage_failures_total Failed calls per pipeline stage.",
+              "# TYPE aws_diagram_stage_failures_total counter"]
+    lines += [f'aws_diagram_stage_failures_total{{stage="{stage}"}} {values["failed"]}' for stage, values in summary.items()]
+    lines += ["# HELP aws_diagram_stage_tokens_total Bedrock tokens per pipeline stage.",
+              "# TYPE aws_diagram_stage_tokens_total counter"]
+    lines += [f'aws_diagram_stage_tokens_total{{stage="{stage}"}} {values["total_tokens"]}' for stage, values in summary.items()
+              if values["total_tokens"] is not None]
+    lines += ["# HELP aws_diagram_stage_cache_hit_ratio Cache hit ratio per pipeline stage.",
+              "# TYPE aws_diagram_stage_cache_hit_ratio gauge"]
+    lines += [f'aws_diagram_stage_cache_hit_ratio{{stage="{stage}"}} {values["cache_hit_rate"]}' for stage, values in summary.items()
+              if values["cache_hit_rate"] is not None]
+    return "\n".join(lines) + "\n"
+
+def run_summarize(path=None, since_days=None, prometheus_path=None):
+    """Summarize command: per stage latency and token percentiles over all recorded runs"""
+    records = load_telemetry(path, since_days)
+    if not records:
+        print(f"No telemetry recorded in {path or TELEMETRY_PATH}")
+        return {}
+    summary = summarize_telemetry(records)
+    def show(value, pattern):
+        return "-" if value is None else pattern.format(value)
+    print(f"{len({record['run_id'] for record in records})} runs, {len(records)} stage records from {path or TELEMETRY_PATH}\n")
+    print(f"{'Stage':<18} {'Count':>6} {'Failed':>6} {'p50 s':>9} {'p95 s':>9} {'p50 tok':>8} {'p95 tok':>8} {'Cache hit':>9}")
+    for stage, values in sorted(summary.items(), key=lambda item: -item[1]["total_seconds"]):
+        print(f"{stage:<18} {values['count']:>6} {values['failed']:>6} {show(values['p50_seconds'], '{:.3f}'):>9} "
+              f"{show(values['p95_seconds'], '{:.3f}'):>9} {show(values['p50_tokens'], '{}'):>8} {show(values['p95_tokens'], '{}'):>8} "
+              f"{show(values['cache_hit_rate'], '{:.0%}'):>9}")
+    models = telemetry_model_stats(records)
+    if models:
+        print("\n" + format_model_stats(models))
+    reasoning = summarize_reasoning(records)
+    if reasoning:
+        print(f"\n{'Tier':<12} {'Budget':>7} {'Runs':>5} {'No repair':>9} {'Repairs':>7} {'p50 s':>8} {'p50 out tok':>11}")
+        tiers = [name for name, _, _ in REASONING_TIERS]
+        for (tier, budget), values in sorted(reasoning.items(), key=lambda item: (tiers.index(item[0][0]) if item[0][0] in tiers else len(tiers), item[0][1])):
+            print(f"{tier:<12} {budget:>7} {values['runs']:>5} {values['success_rate']:>9.0%} {values['mean_repairs']:>7.2f} "
+                  f"{show(values['p50_seconds'], '{:.2f}'):>8} {show(values['p50_output_tokens'], '{}'):>11}")
+    if prometheus_path:
+        text = format_prometheus(summary)
+        if prometheus_path == "-":
+            print("\n" + text, end="")
+        else:
+            # Write then rename so a scraping collector never sees a partial file
+            tmp_path = f"{prometheus_path}.{os.getpid()}.tmp"
+            Path(tmp_path).write_text(text)
+            os.replace(tmp_path, prometheus_path)
+            print(f"\nPrometheus metrics written to {prometheus_path}")
+    return summary
+####end section on telemetry
+
 def get_user_description():
     """Get user's natural language description of their AWS architecture"""
     print("Please describe your AWS application architecture in natural language.")
@@ -40,17 +226,12 @@ def get_user_description():
     
     return "\n".join(lines)
 
-def invoke_bedrock_model(description):
-    """Call Amazon Bedrock with the user's description"""
-    try:
-        # Create and initialize the Amazon Bedrock runtime client
-        bedrock_runtime  = boto3.client(service_name="bedrock-runtime",region_name=AWS_DEFAULT_REGION)
-        # Specify the model ID. For the latest available models, see:
-        # https://docs.aws.amazon.com/bedrock/latest/userguide/models-supported.html
-        model_id = AWS_BEDROCK_MODEL #"us.anthropic.claude-3-7-sonnet-20250219-v1:0" or "us.anthropic.claude-3-7-sonnet-20250219-v1:0" #AWS_BEDROCK_MODEL #'amazon.nova-pro-v1:0' 
-        
-        # Prepare the prompt for Claude
-        prompt = f"""
+# Configure reasoning parameters with a 2000 token budget
+REASONING_CONFIG = {"thinking": {"type": "enabled","budget_tokens": 2000}}
+
+def build_full_prompt(description):
+    """Prepare the full prompt for Claude, with every AWS import and all worked examples"""
+    return f"""
         Acting as a cloud architect, please provide a complete runnable Python script using the diagrams library, adhering strictly to the official documentation at https://diagrams.mingrammer.com/docs/nodes/aws. 
         Use ONLY these exact module and submodule imports in the python code respecting exact diagrams categories, spelling, and type-case including camelcase when importing and calling aws service icons in order to avoid import errors :
         from diagrams.aws.analytics import AmazonOpensearchService, Analytics, Athena,CloudsearchSearchDocuments,Cloudsearch,DataLakeResource,DataPipeline,ElasticsearchService,ES,EMRCluster, EMREngineMaprM3,EMREngineMaprM5,EMREngineMaprM7,EMREngine,EMRHdfsCluster,EMR,GlueCrawlers,GlueDataCatalog,Glue,KinesisDataAnalytics,KinesisDataFirehose,KinesisDataStreams,KinesisVideoStreams,Kinesis,LakeFormation,ManagedStreamingForKafka,Quicksight, RedshiftDenseComputeNode, RedshiftDenseStorageNode, Redshift 
@@ -220,51 +401,1095 @@ def invoke_bedrock_model(description):
         Please provide the Python code needed to create an aws architecture diagram for the following 
         {description} of the application. The output should be a complete, runnable Python script that generates a clear and professional AWS architecture diagram.
         """
-        conversation = [{"role": "user","content": [{"text": prompt}],}]
-        
-        # Configure reasoning parameters with a 2000 token budget
-        reasoning_config = {"thinking": {"type": "enabled","budget_tokens": 2000}} 
-        
+
+####section on building slim prompts
+# The slim prompt lists only the diagrams classes that a local TF-IDF index over
+# class names and aliases finds relevant to the description, plus one example.
+SLIM_PROMPT_TEMPLATE = """
+        Acting as a cloud architect, please provide a complete runnable Python script using the diagrams library, adhering strictly to the official documentation at https://diagrams.mingrammer.com/docs/nodes/aws. 
+        Use ONLY these exact module and submodule imports in the python code respecting exact diagrams categories, spelling, and type-case including camelcase when importing and calling aws service icons in order to avoid import errors :
+        from diagrams import Diagram, Cluster, Edge
+{whitelist}
+
+        Follow these rules: 
+        1. Always use the official import structure from diagrams library documentation
+        2. Include only the specific services/icons that will be used, imported from the modules listed above
+        3. Create appropriate clusters for different layers (e.g., Network Layer, Application Layer, Data Layer)
+        4. Add all relevant AWS services for the application
+        5. Define connections between services and use () around nodes separated by dashes -
+        6. Include proper configuration for the diagram (direction, filename, etc.)
+        7. Cluster object cannot have links to each other
+        8. Use '-' operator only if you have an explicit demand
+        9. Check and remove double links except when explicitly required
+        10. when connecting multiple services be sure to connect them one at a time or using for loops to avoid connection lists and getting errors
+
+        Example of generated python script for clustered web services:
+
+        from diagrams import Cluster, Diagram
+        from diagrams.aws.compute import ECS
+        from diagrams.aws.database import ElastiCache, RDS
+        from diagrams.aws.network import ELB, Route53
+
+        with Diagram("Clustered Web Services", show=False):
+            dns = Route53("dns")
+            lb = ELB("lb")
+
+            with Cluster("Services"):
+                svc_group = [ECS("web1"), ECS("web2")]
+
+            with Cluster("DB Cluster"):
+                db_primary = RDS("userdb")
+
+            memcached = ElastiCache("memcached")
+
+            dns >> lb
+            for svc in svc_group:
+                lb >> svc
+                svc >> db_primary
+                svc >> memcached
+
+        Please provide the Python code needed to create an aws architecture diagram for the following 
+        {description} of the application. The output should be a complete, runnable Python script that generates a clear and professional AWS architecture diagram.
+        """
+# The full prompt is used when the class index is unavailable, with --full-prompt or AWS_DIAGRAM_PROMPT=full
+PROMPT_MODE = os.environ.get('AWS_DIAGRAM_PROMPT', 'slim')
+SLIM_PROMPT_MAX_CLASSES = int(os.environ.get('AWS_DIAGRAM_PROMPT_MAX_CLASSES', '60'))
+# Calibrated against bedrock_token_usage.log: ~17.4k prompt characters were billed as ~5.3k input tokens
+ESTIMATED_CHARS_PER_TOKEN = 3.3
+ALWAYS_INCLUDED_CLASSES = ("User", "Users", "Client")
+RETRIEVAL_STOPWORDS = {"aws", "amazon", "the", "and", "for", "with", "from", "into", "using", "that", "this", "are", "via", "through", "uses", "use"}
+_retrieval_index = None
+
+def split_identifier(text):
+    """Split CamelCase identifiers and free text into word pieces (e.g. 'Route53' -> ['Route', '53'])"""
+    return re.findall(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+', text)
+
+def stem_term(word):
+    """Very light stemmer so 'balancer', 'balancing' and 'balancers' share a term"""
+    word = word.lower()
+    for suffix in ("ing", "ers", "er", "es", "s", "e"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def class_terms(names):
+    """Terms for a class document: stemmed name pieces plus each full name/alias lowercased"""
+    terms = set()
+    for name in names:
+        terms.add(name.lower())
+        terms.update(stem_term(piece) for piece in split_identifier(name) if len(piece) > 1)
+    return terms - RETRIEVAL_STOPWORDS
+
+def description_terms(description):
+    """Terms for a description: stemmed words plus adjacent pairs joined ('Route 53' -> 'route53')"""
+    pieces = split_identifier(description)
+    words = re.findall(r'[A-Za-z0-9]+', description)
+    terms = {stem_term(piece) for piece in pieces if len(piece) > 1}
+    terms.update(word.lower() for word in words)
+    terms.update((a + b).lower() for a, b in zip(words, words[1:]))
+    terms.update((a + b).lower() for a, b in zip(pieces, pieces[1:]))
+    return terms - RETRIEVAL_STOPWORDS
+
+def build_retrieval_index():
+    """Build the TF-IDF index over AWS diagrams classes (canonical name plus aliases per document)"""
+    global _retrieval_index
+    index = load_class_index()
+    if _retrieval_index is not None and _retrieval_index["fingerprint"] == index["fingerprint"]:
+        return _retrieval_index
+    documents = []
+    for modname, entry in index["modules"].items():
+        if not modname.startswith("diagrams.aws."):
+            continue
+        aliases_by_target = {}
+        for alias, target in entry["aliases"].items():
+            aliases_by_target.setdefault(target, []).append(alias)
+        for name in entry["classes"]:
+            names = [name] + aliases_by_target.get(name, [])
+            documents.append({"module": modname, "names": names, "terms": class_terms(names),
+                              "exact": {n.lower() for n in names}})
+    document_frequency = {}
+    for document in documents:
+        for term in document["terms"]:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    idf = {term: math.log(len(documents) / count) for term, count in document_frequency.items()}
+    _retrieval_index = {"fingerprint": index["fingerprint"], "documents": documents, "idf": idf}
+    return _retrieval_index
+
+def select_relevant_classes(description, max_classes=None):
+    """Rank AWS classes against the description; returns {module: [class names]} in index order"""
+    max_classes = max_classes or SLIM_PROMPT_MAX_CLASSES
+    retrieval = build_retrieval_index()
+    query = description_terms(description)
+    scored = []
+    for position, document in enumerate(retrieval["documents"]):
+        matched = document["terms"] & query
+        if not matched:
+            continue
+        # Squared idf so one rare term ('redis') outweighs several common ones ('data', 'service')
+        score = sum(retrieval["idf"][term] ** 2 for term in matched) / len(document["terms"]) ** 0.5
+        # A full class name or alias in the description is a near certain match
+        if document["exact"] & query:
+            score += 100
+        scored.append((score, position))
+    scored.sort(reverse=True)
+    selected = {position for _, position in scored[:max_classes]}
+    for position, document in enumerate(retrieval["documents"]):
+        if document["module"] == "diagrams.aws.general" and document["names"][0] in ALWAYS_INCLUDED_CLASSES:
+            selected.add(position)
+    whitelist = {}
+    for position in sorted(selected):
+        document = retrieval["documents"][position]
+        whitelist.setdefault(document["module"], []).extend(document["names"])
+    return whitelist
+
+def estimate_tokens(text):
+    """Rough input token estimate for reporting prompt savings"""
+    return int(len(text) / ESTIMATED_CHARS_PER_TOKEN)
+
+def build_slim_prompt(description, services=()):
+    """Prepare a prompt whose import whitelist only covers classes relevant to the description,
+    always including the services extracted from it"""
+    whitelist = select_relevant_classes(description)
+    for service in services:
+        if service["class"] not in whitelist.setdefault(service["module"], []):
+            whitelist[service["module"]].append(service["class"])
+    lines = "\n".join(f"        from {module} import {', '.join(names)}" for module, names in whitelist.items())
+    return SLIM_PROMPT_TEMPLATE.format(whitelist=lines, description=description)
+
+@instrumented("prompt_build", lambda prompt: {"mode": PROMPT_MODE, "estimated_tokens": estimate_tokens(prompt)})
+def build_prompt(description):
+    """Prepare the prompt for Claude, slim by default, with the AWS services found in the
+    description listed, and report the estimated token savings"""
+    full_prompt = build_full_prompt(description)
+    try:
+        services = extract_services(description)
+    except ImportError:
+        # No local diagrams install to build the whitelist or service list from
+        return full_prompt
+    if PROMPT_MODE == "full":
+        return full_prompt + format_service_list(services)
+    prompt = build_slim_prompt(description, services) + format_service_list(services)
+    full_tokens, slim_tokens = estimate_tokens(full_prompt), estimate_tokens(prompt)
+    saved = full_tokens - slim_tokens
+    print(f"Prompt builder: ~{slim_tokens} input tokens (~{saved} saved vs full prompt, {saved / full_tokens:.0%})")
+    return prompt
+####end section on building slim prompts
+
+####section on extracting AWS services from descriptions
+# A word trie built from the class map (class names, aliases and their CamelCase
+# pieces) plus a table of everyday synonyms finds the AWS services a description
+# names in one pass, longest phrase first. The services are listed in the prompt,
+# and descriptions that are only a short chain of services get a script from a
+# local template without any model call.
+SERVICE_SYNONYMS = {
+    "load balancer": "ELB", "application load balancer": "ALB", "network load balancer": "NLB",
+    "queue": "SQS", "message queue": "SQS", "topic": "SNS", "notification": "SNS", "push notification": "SNS",
+    "bucket": "S3", "object storage": "S3", "simple storage service": "S3", "file storage": "EFS", "shared file system": "EFS",
+    "database": "RDS", "relational database": "RDS", "sql database": "RDS", "postgres": "RDS", "postgresql": "RDS", "mysql": "RDS",
+    "nosql": "Dynamodb", "nosql database": "Dynamodb", "key value store": "Dynamodb",
+    "cache": "ElastiCache", "redis": "ElastiCache", "memcached": "ElastiCache",
+    "cdn": "CloudFront", "content delivery network": "CloudFront", "dns": "Route53",
+    "function": "Lambda", "serverless function": "Lambda", "api": "APIGateway", "rest api": "APIGateway",
+    "container": "ECS", "kubernetes": "EKS", "virtual machine": "EC2", "server": "EC2", "web server": "EC2", "ec2 instance": "EC2",
+    "data stream": "KinesisDataStreams", "event stream": "Kinesis", "data warehouse": "Redshift", "search engine": "ElasticsearchService",
+    "firewall": "WAF", "web application firewall": "WAF", "user pool": "Cognito", "authentication": "Cognito",
+    "secret": "SecretsManager", "encryption key": "KMS", "monitoring": "Cloudwatch",
+    "event bus": "Eventbridge", "scheduler": "Eventbridge", "workflow": "StepFunctions", "state machine": "StepFunctions",
+    "email": "SES", "machine learning model": "Sagemaker", "container registry": "ECR", "graphql": "Appsync",
+    "user": "Users", "users": "Users", "customer": "Users", "client": "Client", "browser": "Client", "web client": "Client",
+    "mobile app": "Mobile", "mobile client": "Mobile",
+}
+# Class names that are also everyday words count only when capitalized or after AWS/Amazon
+SERVICE_AMBIGUOUS_NAMES = {"Artifact", "Backup", "Batch", "Budgets", "Chatbot", "Config", "Connect", "Detective", "Disk",
+                           "Endpoint", "Forecast", "Forums", "Glue", "Inspector", "Iq", "Marketplace", "Organizations",
+                           "Outposts", "Personalize", "Proton", "Shield", "Support", "Toolkit", "Transform", "Translate"}
+SERVICE_QUALIFIERS = {"aws", "amazon"}
+# Classes defined in several AWS modules come from their usual home, not the first module alphabetically
+SERVICE_HOME_MODULES = {"APIGateway": "diagrams.aws.network", "APIGatewayEndpoint": "diagrams.aws.network",
+                        "InternetGateway": "diagrams.aws.network", "Pinpoint": "diagrams.aws.engagement",
+                        "Appsync": "diagrams.aws.integration"}
+# Descriptions simple enough for a template: few services, no groups, few other words
+TEMPLATE_MODE = os.environ.get('AWS_DIAGRAM_TEMPLATES', 'on')
+TEMPLATE_MAX_SERVICES = int(os.environ.get('AWS_DIAGRAM_TEMPLATE_MAX_SERVICES', '5'))
+TEMPLATE_MAX_OTHER_WORDS = 3
+TEMPLATE_FILLER_WORDS = {"a", "an", "the", "then", "which", "that", "who", "and", "or", "in", "on", "of", "by", "from",
+                         "into", "via", "through", "behind", "using", "uses", "use", "is", "are", "it", "its", "their",
+                         "back", "where", "finally", "also", "each", "data", "requests", "request", "traffic", "files",
+                         "messages", "events", "results", "them", "with", "for", "this", "my", "our", "app", "application"}
+# Verbs linking one service to the next, besides the reasoning section's LINK_WORDS
+TEMPLATE_LINK_WORDS = {"call", "feeds", "serves", "resolves", "accesses", "hits", "reaches", "passes", "pushes", "loads",
+                       "fronts", "notifies", "processes", "consumes", "polls", "sends", "write", "read", "invoke", "trigger"}
+TEMPLATE_JOIN_WORDS = {"and", "or", "also", "a", "an", "the"}
+# Any of these sends the description to the model: the template cannot draw a link that is not there
+TEMPLATE_NEGATION_WORDS = {"not", "no", "never", "without", "nor", "cannot", "t"}
+TEMPLATE_MODEL = "local-template"
+TEMPLATE_TITLE_MAX_WORDS = 12
+_TRIE_END = ""
+_service_trie = None
+
+def service_tokens(text):
+    """(term, word, start, end) for each word of text; terms are lowercased and lightly stemmed"""
+    return [(stem_term(match.group()), match.group(), match.start(), match.end()) for match in re.finditer(r"[A-Za-z0-9]+", text)]
+
+def build_service_trie():
+    """Word trie over synonyms, class names, aliases and CamelCase pieces of AWS classes.
+    Each phrase ends in an entry (class, module, canonical class, how it was named); synonyms
+    take precedence over names and names over aliases when phrases collide. A class defined in
+    several modules resolves to its SERVICE_HOME_MODULES entry, else the first module"""
+    global _service_trie
+    index = load_class_index()
+    if _service_trie is not None and _service_trie["fingerprint"] == index["fingerprint"]:
+        return _service_trie
+    canonical, entries = {}, []
+    for modname, entry in index["modules"].items():
+        if not modname.startswith("diagrams.aws."):
+            continue
+        for name in entry["classes"]:
+            if SERVICE_HOME_MODULES.get(name) == modname:
+                canonical[name] = (modname, name)
+            else:
+                canonical.setdefault(name, (modname, name))
+        for alias, target in entry["aliases"].items():
+            if SERVICE_HOME_MODULES.get(target) == modname:
+                canonical[alias] = (modname, target)
+            else:
+                canonical.setdefault(alias, (modname, target))
+    for phrase, name in SERVICE_SYNONYMS.items():
+        if name in canonical:
+            entries.append(([term for term, *_ in service_tokens(phrase)], name, "synonym"))
+    generic = set(GENERIC_CATEGORY_CLASSES.values())
+    for via in ("name", "alias"):
+        for name, (modname, target) in canonical.items():
+            if (name == target) != (via == "name") or name in generic:
+                continue
+            pieces = [stem_term(piece) for piece in split_identifier(name) if piece.lower() not in SERVICE_QUALIFIERS]
+            entries.append(([stem_term(name)], name, via))
+            if len(pieces) > 1:
+                entries.append((pieces, name, via))
+    root = {}
+    for terms, name, via in entries:
+        node = root
+        for term in terms:
+            node = node.setdefault(term, {})
+        modname, target = canonical[name]
+        node.setdefault(_TRIE_END, {"class": name, "module": modname, "canonical": target, "via": via})
+    _service_trie = {"fingerprint": index["fingerprint"], "root": root}
+    return _service_trie
+
+def find_service_mentions(description):
+    """Every AWS service mention in a description, leftmost longest phrase first: dicts with the
+    matched 'text', 'class', 'module', 'canonical' class, 'via' (synonym, name or alias) and
+    character 'start'/'end'"""
+    root = build_service_trie()["root"]
+    tokens, qualified = [], set()
+    for token in service_tokens(description or ""):
+        if token[0] in SERVICE_QUALIFIERS:
+            qualified.add(len(tokens))
+        else:
+            tokens.append(token)
+    mentions, position = [], 0
+    while position < len(tokens):
+        node, match = root, None
+        for end in range(position, len(tokens)):
+            node = node.get(tokens[end][0])
+            if node is None:
+                break
+            if _TRIE_END in node:
+                match = (end + 1, node[_TRIE_END])
+        if match and match[1]["class"] in SERVICE_AMBIGUOUS_NAMES and match[1]["via"] != "synonym" \
+                and not tokens[position][1][0].isupper() and position not in qualified:
+            match = None
+        # Link verbs are never services, even when they stem like one ('serves' and 'server')
+        if match and any(token[1].lower() in LINK_WORDS | TEMPLATE_LINK_WORDS for token in tokens[position:match[0]]):
+            match = None
+        if match is None:
+            position += 1
+            continue
+        end, entry = match
+        mentions.append({**entry, "text": description[tokens[position][2]:tokens[end - 1][3]],
+                         "start": tokens[position][2], "end": tokens[end - 1][3]})
+        position = end
+    return mentions
+
+def extract_services(description):
+    """The distinct AWS services a description names, in order of first mention"""
+    services = {}
+    for mention in find_service_mentions(description):
+        services.setdefault(mention["canonical"], mention)
+    return list(services.values())
+
+def format_service_list(services):
+    """Prompt block listing the services found in the description, or '' when there are none"""
+    if not services:
+        return ""
+    lines = "\n".join(f'        - "{service["text"]}": from {service["module"]} import {service["class"]}' for service in services)
+    return f"\n        AWS services named in the description (use these classes for them):\n{lines}\n"
+
+def service_stages(description, mentions):
+    """Mentions grouped into consecutive stages, or None when the text between two mentions is
+    neither a link (sends, reads, ->...), which starts the next stage, nor a list ('and', 'or',
+    commas), which stays in the stage"""
+    links = {stem_term(word) for word in LINK_WORDS | TEMPLATE_LINK_WORDS}
+    stages = []
+    for previous, mention in zip([None] + mentions, mentions):
+        if previous is None:
+            stages.append([mention])
+            continue
+        between = description[previous["end"]:mention["start"]].lower()
+        words = re.findall(r"[a-z]+", between)
+        if re.search(r"->|>>|→", between) or any(stem_term(word) in links for word in words):
+            stages.append([mention])
+        elif set(words) <= TEMPLATE_JOIN_WORDS and not re.search(r"[.;:]", between):
+            stages[-1].append(mention)
+        else:
+            return None
+    return stages
+
+def template_title(description):
+    """Diagram title for a template: the leading clauses of the description that fit in
+    TEMPLATE_TITLE_MAX_WORDS words, or its first words and an ellipsis when the first clause is longer"""
+    title, count = "", 0
+    for clause in re.findall(r"[^,;:.]+[,;:.]*", description.strip()):
+        words = clause.split()
+        if count + len(words) > TEMPLATE_TITLE_MAX_WORDS:
+            break
+        title, count = title + clause, count + len(words)
+    if not title:
+        return " ".join(description.split()[:TEMPLATE_TITLE_MAX_WORDS]).rstrip(",;:.") + "..."
+    return title.strip().rstrip(",;:.")
+
+def template_script(description):
+    """A diagrams script for a description that is only a short chain of named services
+    (e.g. 'Users call API Gateway, which invokes Lambda, which writes to DynamoDB and S3'),
+    or None when the description needs the model"""
+    if TEMPLATE_MODE.lower() == "off" or not description:
+        return None
+    mentions = find_service_mentions(description)
+    services = extract_services(description)
+    if not services or len(services) > TEMPLATE_MAX_SERVICES:
+        return None
+    covered = {(mention["start"], mention["end"]) for mention in mentions}
+    tokens = service_tokens(description)
+    if any(word.lower() in TEMPLATE_NEGATION_WORDS for _, word, _, _ in tokens):
+        return None
+    root = build_service_trie()["root"]
+    other = [(term, word) for term, word, start, end in tokens
+             if not any(start >= low and end <= high for low, high in covered)
+             and word.lower() not in TEMPLATE_FILLER_WORDS | LINK_WORDS | TEMPLATE_LINK_WORDS | SERVICE_QUALIFIERS]
+    if any(word.lower() in GROUPING_WORDS for _, word in other) or len(other) > TEMPLATE_MAX_OTHER_WORDS:
+        return None
+    # A capitalized or service-like word that was not resolved may be a service the template would drop
+    if any(word[0].isupper() or term in root for term, word in other):
+        return None
+    stages = service_stages(description, mentions)
+    # At least two stages, so at least one explicit link between them
+    if stages is None or len(stages) < 2:
+        return None
+    names, imports = {}, {}
+    for service in services:
+        variable = re.sub(r"\W", "_", service["class"].lower())
+        variable = f"{variable}_node" if keyword.iskeyword(variable) else variable
+        names[service["canonical"]] = variable if variable not in names.values() else f"{variable}_{len(names)}"
+        imports.setdefault(service["module"], []).append(service["class"])
+    title = template_title(description)
+    lines = ["from diagrams import Diagram"]
+    lines += [f"from {module} import {', '.join(dict.fromkeys(classes))}" for module, classes in imports.items()]
+    lines += ["", f"with Diagram({json.dumps(title)}, show=False, direction=\"LR\"):"]
+    lines += [f"    {names[service['canonical']]} = {service['class']}({json.dumps(service['text'])})" for service in services]
+    edges = []
+    for sources, targets in zip(stages, stages[1:]):
+        for source in sources:
+            for target in targets:
+                edge = (names[source["canonical"]], names[target["canonical"]])
+                if edge[0] != edge[1] and edge not in edges:
+                    edges.append(edge)
+    if not edges:
+        return None
+    lines += [f"    {source} >> {target}" for source, target in edges]
+    return "\n".join(lines) + "\n"
+
+def template_response(description):
+    """A converse-shaped response holding template_script(), with no tokens spent, or None"""
+    start = time.perf_counter()
+    try:
+        code = template_script(description)
+    except ImportError:
+        # No local diagrams install to recognize service names with
+        return None
+    if code is None:
+        return None
+    services = extract_services(description)
+    record_stage("template", time.perf_counter() - start, ok=True, services=len(services))
+    print(f"[TEMPLATE] Simple chain of {len(services)} services ({', '.join(service['class'] for service in services)}); "
+          f"generated locally without a model call. Set AWS_DIAGRAM_TEMPLATES=off to always use the model.")
+    response = synthesize_converse_response(code, reasoning="Generated locally from a template.")
+    response["usage"] = {"inputTokens": 0, "outputTokens": 0, "totalTokens": 0}
+    return response
+####end section on extracting AWS services from descriptions
+
+# Shared Amazon Bedrock runtime client, created once per process
+_bedrock_client = None
+_bedrock_client_lock = threading.Lock()
+
+def get_bedrock_client(max_pool_connections=None):
+    """Return the process wide Bedrock runtime client, creating it on first use"""
+    global _bedrock_client
+    if _bedrock_client is None:
+        with _bedrock_client_lock:
+            if _bedrock_client is None:
+                # boto3 takes a few hundred milliseconds to import, so it is loaded on first use
+                import boto3
+                from botocore.config import Config
+                pool_size = max(max_pool_connections or 0, BEDROCK_MAX_POOL_CONNECTIONS)
+                config = Config(
+                    max_pool_connections=pool_size,
+                    retries={"max_attempts": BEDROCK_MAX_ATTEMPTS, "mode": "adaptive"},
+                    read_timeout=BEDROCK_READ_TIMEOUT,
+                )
+                # Create and initialize the Amazon Bedrock runtime client
+                _bedrock_client = boto3.client(service_name="bedrock-runtime",region_name=AWS_DEFAULT_REGION, config=config)
+    return _bedrock_client
+
+def set_bedrock_client(client):
+    """Install a client (e.g. a local stand-in for benchmarks) as the shared Bedrock client; None resets it"""
+    global _bedrock_client
+    with _bedrock_client_lock:
+        _bedrock_client = client
+
+def converse_with_bedrock(prompt, bedrock_runtime=None, model_id=None, reasoning_config=None):
+    """Send the prompt (with reasoning enabled unless reasoning_config is {}) and return the raw converse response"""
+    if bedrock_runtime is None:
+        bedrock_runtime = get_bedrock_client()
+    # Specify the model ID. For the latest available models, see:
+    # https://docs.aws.amazon.com/bedrock/latest/userguide/models-supported.html
+    model_id = model_id or AWS_BEDROCK_MODEL
+    reasoning_config = REASONING_CONFIG if reasoning_config is None else reasoning_config
+    conversation = [{"role": "user","content": [{"text": prompt}],}]
+    if not reasoning_config:
+        return bedrock_runtime.converse(modelId=model_id, messages=conversation)
+    return bedrock_runtime.converse(
+        modelId=model_id,
+        messages=conversation,
+        additionalModelRequestFields=reasoning_config,
+        # The answer needs room beyond the thinking budget
+        inferenceConfig={"maxTokens": reasoning_budget_of(reasoning_config) + REASONING_OUTPUT_TOKENS}
+    )
+
+####section on caching Bedrock responses
+RESPONSE_CACHE_DIR = CACHE_DIR / "responses"
+response_cache_stats = {"hits": 0, "misses": 0}
+_response_cache_lock = threading.Lock()
+
+def response_cache_key(prompt, model_id, reasoning_config):
+    """Content address for a generation: hash of the full prompt, model ID and reasoning config"""
+    payload = json.dumps({"prompt": prompt, "model": model_id, "reasoning": reasoning_config}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def evict_response_cache():
+    """Drop entries older than the max age, then least recently used ones until under the size limit"""
+    entries = []
+    for path in RESPONSE_CACHE_DIR.glob("*.json"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    oldest_allowed = time.time() - RESPONSE_CACHE_MAX_AGE_DAYS * 86400
+    total_size = sum(size for _, size, _ in entries)
+    max_size = RESPONSE_CACHE_MAX_MB * 1024 * 1024
+    for mtime, size, path in entries:
+        if mtime >= oldest_allowed and total_size <= max_size:
+            break
+        path.unlink(missing_ok=True)
+        total_size -= size
+
+def read_cached_response(key):
+    """Return the cached converse response for key, or None"""
+    path = RESPONSE_CACHE_DIR / f"{key}.json"
+    if not path.exists():
+        return None
+    try:
+        response = json.loads(path.read_text())
+        # Touch the entry so eviction is least recently used
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    with _response_cache_lock:
+        response_cache_stats["hits"] += 1
+    return response
+
+def store_cached_response(key, response):
+    """Atomically write a converse response to the cache and apply eviction"""
+    path = RESPONSE_CACHE_DIR / f"{key}.json"
+    try:
+        RESPONSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps(response, default=str))
+        os.replace(tmp_path, path)
+        with _response_cache_lock:
+            evict_response_cache()
+    except OSError as e:
+        print(f"[WARN] Could not write response cache entry: {e}")
+
+def converse_stage_fields(result):
+    """Telemetry fields of a cached_converse() call; cache hits spend no tokens"""
+    response, cache_hit = result
+    if cache_hit:
+        return {"cache_hit": True}
+    usage = response.get("usage") or {}
+    return {"cache_hit": False, "input_tokens": usage.get("inputTokens", 0), "output_tokens": usage.get("outputTokens", 0)}
+
+def converse_stage_context(prompt, bedrock_runtime=None, model_id=None, *args, **kwargs):
+    """Telemetry fields known before a cached_converse() call"""
+    return {"model": model_id or AWS_BEDROCK_MODEL}
+
+@instrumented("bedrock_call", converse_stage_fields, converse_stage_context)
+def cached_converse(prompt, bedrock_runtime=None, model_id=None, refresh=False, reasoning_config=None):
+    """converse_with_bedrock() behind a local content-addressed cache; returns (response, cache_hit)"""
+    model_id = model_id or AWS_BEDROCK_MODEL
+    reasoning_config = REASONING_CONFIG if reasoning_config is None else reasoning_config
+    key = response_cache_key(prompt, model_id, reasoning_config)
+    if not refresh:
+        response = read_cached_response(key)
+        if response is not None:
+            return response, True
+    with _response_cache_lock:
+        response_cache_stats["misses"] += 1
+    response = converse_with_bedrock(prompt, bedrock_runtime, model_id, reasoning_config)
+    store_cached_response(key, response)
+    return response, False
+####end section on caching Bedrock responses
+
+def log_token_usage(token_usage, cached=False):
+    """Print token usage; the structured record is written by the bedrock_call telemetry stage"""
+    if cached:
+        print("Cached response, no tokens spent (original call below)")
+    print("Input Tokens:",token_usage['inputTokens'])
+    print("Output Tokens:",token_usage['outputTokens'])
+    print("Total Tokens:",token_usage['totalTokens'])
+    print(f"Response Cache: {response_cache_stats['hits']} hits, {response_cache_stats['misses']} misses")
+
+def parse_converse_response(response):
+    """Return (reasoning, text) from a converse response"""
+    # Extract the list of content blocks from the model's response
+    content_blocks = response["output"]["message"]["content"]
+
+    reasoning = None
+    text = None
+
+    # Process each content block to find reasoning and response text
+    for block in content_blocks:
+        if "reasoningContent" in block:
+            reasoning = block["reasoningContent"]["reasoningText"]["text"]
+        if "text" in block:
+            text = block["text"]
+
+    return reasoning, text
+
+####section on model routing and hedged requests
+# AWS_BEDROCK_MODELS lists the models to fail over through, in order (default: AWS_BEDROCK_MODEL only).
+# Short descriptions go to AWS_BEDROCK_FAST_MODEL first when it is set. A call still running after
+# AWS_BEDROCK_HEDGE_AFTER_SECONDS is raced against the next model and the first valid script wins;
+# throttling and other errors move on to the next model at once instead of ending the run.
+AWS_BEDROCK_MODELS = [model.strip() for model in os.environ.get('AWS_BEDROCK_MODELS', AWS_BEDROCK_MODEL).split(",") if model.strip()]
+MODEL_LIST_ERROR = "AWS_BEDROCK_MODELS lists no model IDs; set it to a comma separated list such as " + AWS_BEDROCK_MODEL
+AWS_BEDROCK_FAST_MODEL = os.environ.get('AWS_BEDROCK_FAST_MODEL', '')
+ROUTING_SIMPLE_MAX_WORDS = int(os.environ.get('AWS_BEDROCK_SIMPLE_MAX_WORDS', '60'))
+HEDGE_AFTER_SECONDS = float(os.environ.get('AWS_BEDROCK_HEDGE_AFTER_SECONDS', '45'))
+# Extended thinking is only sent to models that accept it
+REASONING_MODEL_MARKERS = ("claude-3-7", "claude-sonnet-4", "claude-opus-4")
+# USD per million input/output tokens, matched as a substring of the model ID;
+# extend with AWS_BEDROCK_MODEL_PRICES='{"model-substring": [input, output]}'
+MODEL_PRICES = {"claude-3-7-sonnet": (3.0, 15.0), "claude-3-5-sonnet": (3.0, 15.0), "claude-3-5-haiku": (0.8, 4.0),
+                "claude-3-haiku": (0.25, 1.25), "nova-pro": (0.8, 3.2), "nova-lite": (0.06, 0.24), "nova-micro": (0.035, 0.14)}
+MODEL_PRICES.update(json.loads(os.environ.get('AWS_BEDROCK_MODEL_PRICES', '{}')))
+# Errors that mean the model is busy rather than that the request is wrong
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+                          "ModelNotReadyException", "ModelTimeoutException"}
+model_stats = {}
+_model_stats_lock = threading.Lock()
+
+def description_complexity(description):
+    """Size of a description: words, distinct AWS services named, grouping words (VPC, subnet,
+    tier...) and link words (sends, reads, ->...)"""
+    words = re.findall(r"\S+", description or "")
+    lowered = [word.lower().strip(".,;:()") for word in words]
+    try:
+        services = len(extract_services(description or ""))
+    except ImportError:
+        # No local diagrams install to recognize service names with
+        services = 0
+    return {"words": len(words), "services": services,
+            "groups": sum(word in GROUPING_WORDS for word in lowered),
+            "links": sum(word in LINK_WORDS for word in lowered)}
+
+def route_models(description=None):
+    """Models to try for a description, in order: the fast model first for short ones, then AWS_BEDROCK_MODELS"""
+    if not AWS_BEDROCK_MODELS:
+        raise ValueError(MODEL_LIST_ERROR)
+    models = list(AWS_BEDROCK_MODELS)
+    if AWS_BEDROCK_FAST_MODEL and description is not None:
+        if description_complexity(description)["words"] <= ROUTING_SIMPLE_MAX_WORDS:
+            models.insert(0, AWS_BEDROCK_FAST_MODEL)
+        else:
+            models.append(AWS_BEDROCK_FAST_MODEL)
+    return list(dict.fromkeys(models))
+
+def reasoning_for_model(model_id, reasoning_config):
+    """The reasoning config if the model supports extended thinking, otherwise none"""
+    return reasoning_config if any(marker in model_id for marker in REASONING_MODEL_MARKERS) else {}
+
+def model_price(model_id):
+    """(input, output) USD per million tokens for a model ID, or None when unknown"""
+    for marker, price in MODEL_PRICES.items():
+        if marker in model_id:
+            return price
+    return None
+
+def record_model_call(model_id, seconds, response=None, cache_hit=False, error=None):
+    """Add one call to the per-model latency, token and error counters"""
+    with _model_stats_lock:
+        stats = model_stats.setdefault(model_id, {"calls": 0, "wins": 0, "errors": 0, "throttled": 0, "cache_hits": 0,
+                                                  "seconds": [], "input_tokens": 0, "output_tokens": 0})
+        stats["calls"] += 1
+        if error is not None:
+            stats["errors"] += 1
+            stats["throttled"] += error_name(error) in THROTTLING_ERROR_CODES
+            return
+        stats["seconds"].append(seconds)
+        stats["cache_hits"] += cache_hit
+        if not cache_hit:
+            usage = response.get("usage") or {}
+            stats["input_tokens"] += usage.get("inputTokens", 0)
+            stats["output_tokens"] += usage.get("outputTokens", 0)
+
+def response_has_script(response):
+    """Whether a converse response holds a diagrams script that parses"""
+    _, text = parse_converse_response(response)
+    if not text:
+        return False
+    if "```python" in text:
+        start_idx = text.find("```python") + len("```python")
+        code = text[start_idx:text.find("```", start_idx)]
+    elif "from diagrams import" in text:
+        code = text[text.find("from diagrams import"):]
+    else:
+        return False
+    try:
+        ast.parse(code)
+    except SyntaxError:
+        return False
+    return True
+
+def routed_converse(prompt, description=None, bedrock_runtime=None, refresh=False, reasoning_config=None, accept=None, models=None):
+    """cached_converse() across the routed models; returns (response, cache_hit, model_id).
+
+    Starts with the first model, hedges with the next one when no answer arrived after
+    HEDGE_AFTER_SECONDS and fails over immediately on errors or responses that accept(response)
+    rejects. The first accepted response wins; calls still running finish in the background
+    and only fill the cache. Raises the last error when every model failed."""
+    models = list(models or route_models(description))
+    if not models:
+        raise ValueError(MODEL_LIST_ERROR)
+    accept = accept or response_has_script
+    reasoning_config = REASONING_CONFIG if reasoning_config is None else reasoning_config
+    start = time.perf_counter()
+    results = queue.Queue()
+    remaining = list(models)
+    in_flight = 0
+    rejected, last_error = None, None
+
+    def call(model_id):
+        call_start = time.perf_counter()
+        try:
+            response, cache_hit = cached_converse(prompt, bedrock_runtime, model_id, refresh,
+                                                  reasoning_for_model(model_id, reasoning_config))
+        except Exception as e: # includes botocore's ClientError
+            record_model_call(model_id, time.perf_counter() - call_start, error=e)
+            results.put((model_id, None, False, e))
+            return
+        record_model_call(model_id, time.perf_counter() - call_start, response, cache_hit)
+        results.put((model_id, response, cache_hit, None))
+
+    def launch(reason=None):
+        nonlocal in_flight
+        model_id = remaining.pop(0)
+        if reason:
+            print(f"[ROUTE] {reason}, sending the request to {model_id}")
+        # Daemon threads so a losing call never holds up the end of the run
+        threading.Thread(target=call, args=(model_id,), daemon=True).start()
+        in_flight += 1
+
+    launch()
+    while in_flight:
+        hedge = remaining and HEDGE_AFTER_SECONDS > 0
+        try:
+            model_id, response, cache_hit, error = results.get(timeout=HEDGE_AFTER_SECONDS if hedge else None)
+        except queue.Empty:
+            launch(f"No response after {HEDGE_AFTER_SECONDS:g}s")
+            continue
+        in_flight -= 1
+        if error is not None:
+            last_error = error
+            if remaining:
+                launch(f"{model_id} failed with {error_name(error)}")
+            continue
+        if accept(response):
+            with _model_stats_lock:
+                model_stats[model_id]["wins"] += 1
+            record_stage("model_route", time.perf_counter() - start, ok=True, model=model_id, cache_hit=cache_hit,
+                         tried=len(models) - len(remaining), failed=last_error is not None)
+            return response, cache_hit, model_id
+        rejected = rejected or (response, cache_hit, model_id)
+        if remaining:
+            launch(f"{model_id} returned no valid script")
+    record_stage("model_route", time.perf_counter() - start, ok=rejected is not None, tried=len(models),
+                 model=rejected[2] if rejected else None, error=None if rejected else error_name(last_error))
+    if rejected:
+        return rejected
+    raise last_error
+
+def summarize_models(stats=None):
+    """Per model calls, wins, errors, p50/p95 seconds, tokens and estimated cost"""
+    summary = {}
+    for model_id, values in (model_stats if stats is None else stats).items():
+        price = model_price(model_id)
+        cost = (values["input_tokens"] * price[0] + values["output_tokens"] * price[1]) / 1e6 if price else None
+        summary[model_id] = {**{key: value for key, value in values.items() if key != "seconds"},
+                             "p50_seconds": percentile(values["seconds"], 0.5),
+                             "p95_seconds": percentile(values["seconds"], 0.95), "cost_usd": cost}
+    return summary
+
+def telemetry_model_stats(records):
+    """Per model counters in record_model_call() form, rebuilt from bedrock_call telemetry records"""
+    stats = {}
+    for record in records:
+        if record["stage"] != "bedrock_call" or not record.get("model"):
+            continue
+        values = stats.setdefault(record["model"], {"calls": 0, "wins": 0, "errors": 0, "throttled": 0, "cache_hits": 0,
+                                                    "seconds": [], "input_tokens": 0, "output_tokens": 0})
+        values["calls"] += 1
+        if not record.get("ok", True):
+            values["errors"] += 1
+            values["throttled"] += record.get("error") in THROTTLING_ERROR_CODES
+            continue
+        values["seconds"].append(record["seconds"])
+        values["cache_hits"] += bool(record.get("cache_hit"))
+        values["input_tokens"] += record.get("input_tokens", 0)
+        values["output_tokens"] += record.get("output_tokens", 0)
+    for record in records:
+        if record["stage"] == "model_route" and record.get("ok") and record.get("model") in stats:
+            stats[record["model"]]["wins"] += 1
+    return stats
+
+def format_model_stats(stats=None):
+    """Table of summarize_models(), or an empty string when no model was called"""
+    summary = summarize_models(stats)
+    if not summary:
+        return ""
+    def show(value, pattern):
+        return "-" if value is None else pattern.format(value)
+    lines = [f"{'Model':<48} {'Calls':>5} {'Wins':>5} {'Errors':>6} {'Throttled':>9} {'p50 s':>8} {'p95 s':>8} {'Tokens':>8} {'Cost $':>8}"]
+    for model_id, values in summary.items():
+        lines.append(f"{model_id:<48} {values['calls']:>5} {values['wins']:>5} {values['errors']:>6} {values['throttled']:>9} "
+                     f"{show(values['p50_seconds'], '{:.2f}'):>8} {show(values['p95_seconds'], '{:.2f}'):>8} "
+                     f"{values['input_tokens'] + values['output_tokens']:>8} {show(values['cost_usd'], '{:.4f}'):>8}")
+    return "\n".join(lines)
+####end section on model routing and hedged requests
+
+####section on adaptive reasoning budgets
+# The thinking budget follows the size of the architecture: trivial descriptions skip thinking,
+# large ones get more. Each generation records its budget and outcome (repairs, render or static
+# check success, latency) as a reasoning_outcome telemetry stage; once a complexity tier has enough
+# recorded runs per budget, the budget with the best success rate (and then the lowest latency)
+# is used for that tier. AWS_DIAGRAM_REASONING=fixed restores the fixed 2000 token budget and
+# a number sets a fixed budget of that many tokens (0 disables thinking).
+REASONING_POLICY = os.environ.get('AWS_DIAGRAM_REASONING', 'adaptive')
+# (tier, highest complexity score, default budget); Bedrock's smallest thinking budget is 1024 tokens
+REASONING_TIERS = (("trivial", 6, 0), ("simple", 12, 1024), ("medium", 24, 2000), ("large", 40, 4000), ("enterprise", None, 8000))
+REASONING_BUDGETS = sorted({budget for _, _, budget in REASONING_TIERS})
+# Output tokens allowed on top of the thinking budget
+REASONING_OUTPUT_TOKENS = int(os.environ.get('AWS_DIAGRAM_REASONING_OUTPUT_TOKENS', '4096'))
+REASONING_MIN_RUNS = int(os.environ.get('AWS_DIAGRAM_REASONING_MIN_RUNS', '5'))
+REASONING_HISTORY_DAYS = 30
+# Budgets whose success rate is within this margin of the best count as equally good
+REASONING_SUCCESS_MARGIN = 0.05
+# Below this success rate an untried higher budget is tried next
+REASONING_TARGET_SUCCESS = 0.8
+# One in this many descriptions probes an untried lower budget when the current one does well
+REASONING_PROBE_EVERY = 10
+GROUPING_WORDS = {"vpc", "vpcs", "subnet", "subnets", "cluster", "clusters", "region", "regions", "zone", "zones",
+                  "account", "accounts", "tier", "tiers", "layer", "layers", "environment", "environments"}
+LINK_WORDS = {"->", ">>", "to", "sends", "calls", "connects", "triggers", "reads", "writes", "streams",
+              "publishes", "subscribes", "forwards", "routes", "invokes", "stores", "queries"}
+_reasoning_history = None
+_reasoning_history_lock = threading.Lock()
+
+def complexity_score(complexity):
+    """Single number from description_complexity(): services and groups weigh most"""
+    return round(complexity["words"] / 30 + 1.5 * complexity["services"] + 1.5 * complexity["groups"] + 0.5 * complexity["links"], 2)
+
+def reasoning_config_for_budget(budget):
+    """Bedrock additionalModelRequestFields for a thinking budget; {} disables thinking"""
+    return {"thinking": {"type": "enabled", "budget_tokens": budget}} if budget else {}
+
+def reasoning_budget_of(reasoning_config):
+    """Thinking budget in tokens of a reasoning config, 0 when thinking is off"""
+    return ((reasoning_config or {}).get("thinking") or {}).get("budget_tokens", 0)
+
+def load_reasoning_history():
+    """Recorded reasoning_outcome telemetry of the last REASONING_HISTORY_DAYS days, read once per process"""
+    global _reasoning_history
+    with _reasoning_history_lock:
+        if _reasoning_history is None:
+            records = load_telemetry(since_days=REASONING_HISTORY_DAYS) if TELEMETRY_PATH.lower() != "off" else []
+            _reasoning_history = [record for record in records if record["stage"] == "reasoning_outcome"]
+        return _reasoning_history
+
+def summarize_reasoning(records):
+    """Per (tier, budget): runs, success rate (no repair needed), mean repairs, p50 seconds and output tokens"""
+    groups = {}
+    for record in records:
+        if record["stage"] == "reasoning_outcome":
+            groups.setdefault((record["tier"], record["budget"]), []).append(record)
+    summary = {}
+    for key, items in groups.items():
+        summary[key] = {"runs": len(items),
+                        "success_rate": sum(bool(item.get("ok")) and not item.get("repairs") for item in items) / len(items),
+                        "mean_repairs": sum(item.get("repairs", 0) for item in items) / len(items),
+                        "p50_seconds": percentile([item["seconds"] for item in items], 0.5),
+                        "p50_output_tokens": percentile([item.get("output_tokens", 0) for item in items], 0.5)}
+    return summary
+
+def choose_reasoning_budget(description, history=None):
+    """Pick the thinking budget for a description; returns a dict with 'config' for Bedrock plus
+    'budget', 'tier', 'score', 'complexity' and 'policy' (fixed, default, learned, escalate or probe)"""
+    complexity = description_complexity(description)
+    score = complexity_score(complexity)
+    tier, budget = next((name, default) for name, highest, default in REASONING_TIERS if highest is None or score < highest)
+    choice = {"tier": tier, "score": score, "complexity": complexity, "policy": "default"}
+    if REASONING_POLICY != "adaptive":
+        budget = reasoning_budget_of(REASONING_CONFIG) if REASONING_POLICY == "fixed" else int(REASONING_POLICY)
+        return {**choice, "budget": budget, "config": reasoning_config_for_budget(budget), "policy": "fixed"}
+    stats = {budget_: values for (tier_, budget_), values in
+             summarize_reasoning(load_reasoning_history() if history is None else history).items() if tier_ == tier}
+    proven = {budget_: values for budget_, values in stats.items() if values["runs"] >= REASONING_MIN_RUNS}
+    if proven:
+        best = max(values["success_rate"] for values in proven.values())
+        # Among budgets about as reliable as the best one, the fastest wins
+        budget = min((values["p50_seconds"], budget_) for budget_, values in proven.items()
+                     if values["success_rate"] >= best - REASONING_SUCCESS_MARGIN)[1]
+        choice["policy"] = "learned"
+    current = stats.get(budget)
+    untried_higher = [budget_ for budget_ in REASONING_BUDGETS if budget_ > budget and budget_ not in proven]
+    untried_lower = [budget_ for budget_ in REASONING_BUDGETS if budget_ < budget and budget_ not in proven]
+    if current and current["runs"] >= REASONING_MIN_RUNS:
+        if current["success_rate"] < REASONING_TARGET_SUCCESS and untried_higher:
+            budget, choice["policy"] = untried_higher[0], "escalate"
+        # Deterministic per description, so a repeated description keeps its cached response
+        elif untried_lower and int(hashlib.sha256(description.encode()).hexdigest(), 16) % REASONING_PROBE_EVERY == 0:
+            budget, choice["policy"] = untried_lower[-1], "probe"
+    return {**choice, "budget": budget, "config": reasoning_config_for_budget(budget)}
+
+def describe_reasoning_choice(choice):
+    """One line log of a choose_reasoning_budget() result"""
+    complexity = choice["complexity"]
+    budget = f"{choice['budget']} thinking tokens" if choice["budget"] else "thinking off"
+    return (f"Reasoning budget: {budget} ({choice['tier']}, score {choice['score']}: {complexity['words']} words, "
+            f"{complexity['services']} services, {complexity['groups']} groups, {complexity['links']} links; {choice['policy']})")
+
+def record_reasoning_outcome(choice, seconds, ok, repairs=0, output_tokens=0, cache_hit=False):
+    """Record how a generation with the chosen budget went; cached responses say nothing about latency"""
+    if cache_hit:
+        return
+    fields = {"tier": choice["tier"], "budget": choice["budget"], "score": choice["score"], "policy": choice["policy"],
+              "repairs": repairs, "output_tokens": output_tokens}
+    record_stage("reasoning_outcome", seconds, ok=ok, **fields)
+    if _reasoning_history is not None:
+        with _reasoning_history_lock:
+            _reasoning_history.append({"stage": "reasoning_outcome", "seconds": seconds, "ok": ok, **fields})
+####end section on adaptive reasoning budgets
+
+def invoke_bedrock_model(description, bedrock_runtime=None, refresh_cache=False, prompt=None, accept=None, models=None,
+                         reasoning_config=None, call_info=None):
+    """Call Amazon Bedrock with the user's description (or a prebuilt prompt), routed across the
+    configured models; returns (None, None) when every model failed. A call_info dict receives
+    the answering model, cache hit, token usage and raw response."""
+    models = list(models or route_models(description))
+    if prompt is None:
+        response = template_response(description)
+        if response is not None:
+            if call_info is not None:
+                call_info.update({"model": TEMPLATE_MODEL, "cache_hit": False, "usage": response["usage"], "response": response})
+            return parse_converse_response(response)
+    try:
         # Send message and reasoning configuration to the model
-        print("\nSending request to Amazon Bedrock (Claude 3.7)...")
-        response = bedrock_runtime.converse(
-            modelId=model_id,
-            messages=conversation,
-            additionalModelRequestFields=reasoning_config
-        )
-
-       # Extract token usage from response metadata
-        token_usage = response['usage']
-        
-        # Log token usage
-        print("Input Tokens:",token_usage['inputTokens'])
-        print("Output Tokens:",token_usage['outputTokens'])
-        print("Total Tokens:",token_usage['totalTokens'])
-        
-        #Optional: Save token usage to a log file
-        with open(f"bedrock_token_usage_{tracking_number}.log", 'a') as log_file:
-            import datetime
-            log_file.write(f"{datetime.datetime.now()}: Input Tokens: {token_usage['inputTokens']}, Output Tokens: {token_usage['outputTokens']}, Total Tokens: {token_usage['totalTokens']}\n")
-        
-        # Extract the list of content blocks from the model's response
-        content_blocks = response["output"]["message"]["content"]
+        print(f"\nSending request to Amazon Bedrock ({models[0]})...")
+        response, cache_hit, model_id = routed_converse(prompt or build_prompt(description), description, bedrock_runtime,
+                                                        refresh_cache, reasoning_config, accept=accept, models=models)
+        if model_id != models[0]:
+            print(f"Answered by {model_id}")
+        if call_info is not None:
+            call_info.update({"model": model_id, "cache_hit": cache_hit, "usage": response.get("usage") or {}, "response": response})
 
-        reasoning = None
-        text = None
+        # Extract token usage from response metadata
+        log_token_usage(response['usage'], cached=cache_hit)
 
-        # Process each content block to find reasoning and response text
-        for block in content_blocks:
-            if "reasoningContent" in block:
-                reasoning = block["reasoningContent"]["reasoningText"]["text"]
-            if "text" in block:
-                text = block["text"]
+        return parse_converse_response(response)
 
-        return reasoning, text
+    except Exception as e: # includes botocore's ClientError
+        print(f"ERROR: No model could answer ({', '.join(models)}). Last error: {e}")
+        return None, None
 
-    except (ClientError, Exception) as e:
-        print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
-        exit(1)
-        
+
+def invoke_bedrock_model_streaming(description, bedrock_runtime=None, refresh_cache=False, on_code_block=None,
+                                   reasoning_config=None, call_info=None):
+    """Call Amazon Bedrock with converse_stream, printing reasoning and text as they arrive.
+
+    on_code_block(code) is called as soon as the ```python fence closes, while the
+    rest of the response is still streaming. Returns (reasoning, text, metrics);
+    call_info is filled as for invoke_bedrock_model()."""
+    models = route_models(description)
+    model_id = models[0]
+    requested_config = REASONING_CONFIG if reasoning_config is None else reasoning_config
+    reasoning_config = reasoning_for_model(model_id, requested_config)
+    if call_info is None:
+        call_info = {}
+    call_info.update({"model": model_id, "cache_hit": False, "usage": {}})
+    start = time.perf_counter()
+    metrics = {"time_to_first_token": None, "time_to_code": None, "total": None}
+    response = template_response(description)
+    if response is not None:
+        call_info.update({"model": TEMPLATE_MODEL, "usage": response["usage"], "response": response})
+        reasoning, text = parse_converse_response(response)
+        print(text)
+        if on_code_block:
+            on_code_block(extract_python_code(text))
+        metrics["total"] = time.perf_counter() - start
+        return reasoning, text, metrics
+    prompt = build_prompt(description)
+    key = response_cache_key(prompt, model_id, reasoning_config)
+
+    if not refresh_cache:
+        response = read_cached_response(key)
+        if response is not None:
+            log_token_usage(response['usage'], cached=True)
+            call_info.update({"cache_hit": True, "usage": response.get("usage") or {}, "response": response})
+            reasoning, text = parse_converse_response(response)
+            print("\n<thinking>")
+            print(reasoning)
+            print(text)
+            if on_code_block and text and "```python" in text:
+                on_code_block(extract_python_code(text))
+            metrics["total"] = time.perf_counter() - start
+            record_stage("bedrock_call", metrics["total"], ok=True, model=model_id, cache_hit=True, stream=True)
+            return reasoning, text, metrics
+    with _response_cache_lock:
+        response_cache_stats["misses"] += 1
+
+    try:
+        if bedrock_runtime is None:
+            bedrock_runtime = get_bedrock_client()
+        print(f"\nStreaming request to Amazon Bedrock ({model_id})...")
+        request = {"modelId": model_id, "messages": [{"role": "user","content": [{"text": prompt}],}]}
+        if reasoning_config:
+            request["additionalModelRequestFields"] = reasoning_config
+            request["inferenceConfig"] = {"maxTokens": reasoning_budget_of(reasoning_config) + REASONING_OUTPUT_TOKENS}
+        response = bedrock_runtime.converse_stream(**request)
+
+        reasoning_parts, text_parts = [], []
+        signature = None
+        usage, stop_reason = None, None
+        text = ""
+        # Incremental fence detection: where the code starts and where to resume searching
+        code_start, scan_from = None, 0
+        in_text = False
+        print("\n<thinking>")
+        for event in response["stream"]:
+            if "contentBlockDelta" in event:
+                delta = event["contentBlockDelta"]["delta"]
+                if metrics["time_to_first_token"] is None:
+                    metrics["time_to_first_token"] = time.perf_counter() - start
+                if "reasoningContent" in delta:
+                    chunk = delta["reasoningContent"].get("text", "")
+                    signature = delta["reasoningContent"].get("signature", signature)
+                    reasoning_parts.append(chunk)
+                    sys.stdout.write(chunk)
+                    sys.stdout.flush()
+                elif "text" in delta:
+                    if not in_text:
+                        in_text = True
+                        print()
+                    text_parts.append(delta["text"])
+                    sys.stdout.write(delta["text"])
+                    sys.stdout.flush()
+                    if metrics["time_to_code"] is not None:
+                        continue
+                    text = "".join(text_parts)
+                    if code_start is None:
+                        idx = text.find("```python", scan_from)
+                        if idx == -1:
+                            scan_from = max(0, len(text) - len("```python") + 1)
+                            continue
+                        code_start = scan_from = idx + len("```python")
+                    end_idx = text.find("```", scan_from)
+                    if end_idx == -1:
+                        scan_from = max(code_start, len(text) - 2)
+                        continue
+                    metrics["time_to_code"] = time.perf_counter() - start
+                    if on_code_block:
+                        on_code_block(text[code_start:end_idx].strip())
+            elif "messageStop" in event:
+                stop_reason = event["messageStop"].get("stopReason")
+            elif "metadata" in event:
+                usage = event["metadata"].get("usage")
+        print()
+        metrics["total"] = time.perf_counter() - start
+
+        reasoning = "".join(reasoning_parts) or None
+        text = "".join(text_parts) or None
+        content = []
+        if reasoning:
+            content.append({"reasoningContent": {"reasoningText": {"text": reasoning, "signature": signature}}})
+        if text:
+            content.append({"text": text})
+        call_info["response"] = {
+            "output": {"message": {"role": "assistant", "content": content}},
+            "stopReason": stop_reason,
+            "usage": usage,
+        }
+        store_cached_response(key, call_info["response"])
+        if usage:
+            log_token_usage(usage)
+        call_info["usage"] = usage or {}
+        record_model_call(model_id, metrics["total"], {"usage": usage})
+        record_stage("bedrock_call", metrics["total"], ok=True, model=model_id, cache_hit=False, stream=True,
+                     input_tokens=(usage or {}).get("inputTokens", 0), output_tokens=(usage or {}).get("outputTokens", 0),
+                     time_to_first_token=metrics["time_to_first_token"], time_to_code=metrics["time_to_code"])
+        for name, value in metrics.items():
+            if value is not None:
+                print(f"{name.replace('_', ' ').capitalize()}: {value:.2f}s")
+        return reasoning, text, metrics
+
+    except Exception as e: # includes botocore's ClientError
+        record_stage("bedrock_call", time.perf_counter() - start, ok=False, model=model_id, stream=True, error=error_name(e))
+        record_model_call(model_id, time.perf_counter() - start, error=e)
+        # Fail over to the other models without streaming instead of ending the run
+        print(f"\n[ROUTE] Streaming from {model_id} failed with {error_name(e)}, retrying without streaming")
+        reasoning, text = invoke_bedrock_model(description, bedrock_runtime, refresh_cache, prompt=prompt,
+                                               models=models[1:] or models, reasoning_config=requested_config,
+                                               call_info=call_info)
+        if text:
+            print("\n<thinking>")
+            print(reasoning)
+            print(text)
+            if on_code_block and "```python" in text:
+                on_code_block(extract_python_code(text))
+        metrics["total"] = time.perf_counter() - start
+        return reasoning, text, metrics
+
+@instrumented("extraction", lambda code: {"format": "python", "found": bool(code)})
 def extract_python_code(text):
     """Extract Python code from the Bedrock model response"""
     # Look for code blocks in markdown format
@@ -287,23 +1512,144 @@ def extract_python_code(text):
     return text
 
 # #####part to fix diagrams imports#########################
-# Cache of all valid class locations: {class_name: full.module.path}
-def build_aws_class_to_module_map():
-    """Scan only AWS diagrams modules to map class names to their correct module paths."""
-    class_to_module = {}
-    for importer, modname, ispkg in pkgutil.walk_packages(path=diagrams_path, prefix="diagrams."):
-        if not modname.startswith("diagrams.aws."):
-            continue # skip non-AWS providers
+# Persistent on-disk index of every diagrams class: built once per installed
+# diagrams version by parsing the provider sources (no imports), then reused.
+CLASS_INDEX_FORMAT = 2
+CLASS_INDEX_PATH = CACHE_DIR / "diagrams_class_index.json"
+_class_index = None
+
+def find_diagrams_sources():
+    """Locate the installed diagrams package without importing it: returns (version, root_dir)."""
+    spec = importlib.util.find_spec("diagrams")
+    if spec is None or not spec.submodule_search_locations:
+        raise ImportError("diagrams is not installed. Please install it using: pip install diagrams")
+    # importlib.metadata costs tens of milliseconds to import; the dist-info name is enough
+    return installed_version("diagrams") or "unknown", Path(list(spec.submodule_search_locations)[0])
+
+def iter_diagrams_modules(root):
+    """Yield (module_name, file_path) for every diagrams source file, in walk_packages order."""
+    def walk(directory, prefix):
+        for entry in sorted(os.listdir(directory)):
+            path = directory / entry
+            if path.is_dir() and (path / "__init__.py").exists():
+                yield prefix + entry, path / "__init__.py"
+                yield from walk(path, f"{prefix}{entry}.")
+            elif entry.endswith(".py") and entry != "__init__.py":
+                yield prefix + entry[:-3], path
+    yield "diagrams", root / "__init__.py"
+    yield from walk(root, "diagrams.")
+
+def diagrams_fingerprint(version, modules):
+    """Hash the diagrams version and the mtime/size of every module so upgrades invalidate the index."""
+    digest = hashlib.sha256(f"{CLASS_INDEX_FORMAT}:{version}".encode())
+    for modname, path in modules:
+        stat = path.stat()
+        digest.update(f"{modname}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+    return digest.hexdigest()
+
+def parse_module_classes(path):
+    """Read public class names, module level aliases (e.g. ELB = ElasticLoadBalancing) and
+    icon paths (_icon_dir/_icon, inherited from base classes in the same file) from a source file."""
+    classes, aliases, icons = [], {}, {}
+    class_attrs = {} # every class in the file -> (base names, {_icon, _icon_dir})
+    tree = ast.parse(path.read_text(encoding="utf-8"))
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            attrs = {}
+            for item in node.body:
+                if (isinstance(item, ast.Assign) and len(item.targets) == 1 and isinstance(item.targets[0], ast.Name)
+                        and item.targets[0].id in ("_icon", "_icon_dir") and isinstance(item.value, ast.Constant)):
+                    attrs[item.targets[0].id] = item.value.value
+            class_attrs[node.name] = ([base.id for base in node.bases if isinstance(base, ast.Name)], attrs)
+            if node.name[0].isupper():
+                classes.append(node.name)
+        elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Name):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id[0].isupper():
+                    aliases[target.id] = node.value.id
+
+    def inherited(name, attr):
+        while name in class_attrs:
+            bases, attrs = class_attrs[name]
+            if attr in attrs:
+                return attrs[attr]
+            name = bases[0] if bases else None
+        return None
+
+    for name in classes:
+        icon, icon_dir = inherited(name, "_icon"), inherited(name, "_icon_dir")
+        if icon and icon_dir:
+            icons[name] = f"{icon_dir}/{icon}"
+    return classes, aliases, icons
+
+def build_class_index():
+    """Scan all diagrams providers and build the class index dictionary."""
+    version, root = find_diagrams_sources()
+    modules = list(iter_diagrams_modules(root))
+    index = {
+        "format": CLASS_INDEX_FORMAT,
+        "version": version,
+        # Icon paths in the index are relative to this directory
+        "resources_root": str(root.parent),
+        "fingerprint": diagrams_fingerprint(version, modules),
+        "modules": {},
+    }
+    for modname, path in modules:
+        try:
+            classes, aliases, icons = parse_module_classes(path)
+        except (OSError, SyntaxError, UnicodeDecodeError):
+            continue
+        if classes or aliases:
+            index["modules"][modname] = {"classes": classes, "aliases": aliases, "icons": icons}
+    return index
+
+def load_class_index(rebuild=False):
+    """Return the diagrams class index, rebuilding the on-disk copy when the library changed."""
+    global _class_index
+    # Validated once per process; the installed library does not change underneath a run
+    if not rebuild and _class_index is not None:
+        return _class_index
+    start = time.perf_counter()
+    version, root = find_diagrams_sources()
+    fingerprint = diagrams_fingerprint(version, list(iter_diagrams_modules(root)))
+    if not rebuild and CLASS_INDEX_PATH.exists():
         try:
-            module = importlib.import_module(modname)
-            for attr in dir(module):
-                if attr[0].isupper():
-                    # Only map if not already mapped (keeps first-found AWS class)
-                    class_to_module.setdefault(attr, modname)
-        except Exception:
+            index = json.loads(CLASS_INDEX_PATH.read_text())
+            if index.get("format") == CLASS_INDEX_FORMAT and index.get("fingerprint") == fingerprint:
+                _class_index = index
+                record_stage("class_map_load", time.perf_counter() - start, ok=True, rebuilt=False)
+                return index
+        except (OSError, ValueError):
+            pass
+    print(f"Indexing diagrams {version} classes (one-time per installed version)...")
+    index = build_class_index()
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = CLASS_INDEX_PATH.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(index, separators=(",", ":")))
+        os.replace(tmp_path, CLASS_INDEX_PATH)
+    except OSError as e:
+        print(f"[WARN] Could not write class index to {CLASS_INDEX_PATH}: {e}")
+    _class_index = index
+    record_stage("class_map_load", time.perf_counter() - start, ok=True, rebuilt=True)
+    return index
+
+def build_class_to_module_map(prefix="diagrams."):
+    """Map class names (and aliases) to the first module under prefix that defines them."""
+    class_to_module = {}
+    for modname, entry in load_class_index()["modules"].items():
+        if not modname.startswith(prefix):
             continue
+        for name in entry["classes"] + list(entry["aliases"]):
+            # Only map if not already mapped (keeps first-found class)
+            class_to_module.setdefault(name, modname)
     return class_to_module
 
+# Cache of all valid class locations: {class_name: full.module.path}
+def build_aws_class_to_module_map():
+    """Map AWS diagrams class names to their correct module paths using the cached index."""
+    return build_class_to_module_map("diagrams.aws.")
+
 def generate_diagram_script() -> str:
     """Generates a diagrams script with wrong module/class references."""
     return """from diagrams import Diagram
@@ -328,82 +1674,1664 @@ def extract_imports(code: str):
                 imports.append((node.module, alias.name))
     return imports
 
-def validate_and_fix_imports(code: str, class_map: dict):
-    imports = extract_imports(code)
-    code_lines = code.splitlines()
-    replacements = {} # class_name -> (old_module, new_module)
-    usage_corrections = {} # class_name -> corrected_name (if renamed)
-    for module_path, class_name in imports:
-        valid = False
-        try:
-            mod = importlib.import_module(module_path)
-            if hasattr(mod, class_name):
-                print(f"[VALID] {class_name} from {module_path}")
-                valid = True
-        except ModuleNotFoundError:
-            print(f"[INVALID MODULE] {module_path}")
-        except Exception as e:
-            print(f"[ERROR] {module_path}: {str(e)}")
-        if not valid:
-            correct_module = class_map.get(class_name)
-            if correct_module:
-                print(f"[FIX] {class_name} should be imported from {correct_module}")
-                replacements[class_name] = (module_path, correct_module)
+_repair_tables = None
+
+def get_repair_tables():
+    """Lookup tables for import repair, derived once from the class index:
+    names per module, first module per name and lowercase name -> canonical name"""
+    global _repair_tables
+    index = load_class_index()
+    if _repair_tables is not None and _repair_tables["fingerprint"] == index["fingerprint"]:
+        return _repair_tables
+    module_names = {}
+    all_names = {}
+    for modname, entry in index["modules"].items():
+        names = entry["classes"] + list(entry["aliases"])
+        module_names[modname] = set(names)
+        for name in names:
+            all_names.setdefault(name, modname)
+    lowercase_names = {}
+    for name in all_names:
+        lowercase_names.setdefault(name.lower(), name)
+    _repair_tables = {"fingerprint": index["fingerprint"], "module_names": module_names,
+                      "all_names": all_names, "lowercase_names": lowercase_names}
+    return _repair_tables
+
+# Nearest-name resolution for unknown classes: a trigram index proposes candidates,
+# edit distance picks the best, and a category's generic node is the last resort.
+NAME_MATCH_MAX_DISTANCE = int(os.environ.get('AWS_DIAGRAM_NAME_MAX_DISTANCE', '3'))
+NAME_MATCH_CANDIDATES = 8
+GENERIC_CATEGORY_CLASSES = {
+    "analytics": "Analytics", "ar": "ArVr", "blockchain": "Blockchain", "business": "BusinessApplications",
+    "compute": "Compute", "cost": "CostManagement", "database": "Database", "devtools": "DeveloperTools",
+    "enablement": "CustomerEnablement", "enduser": "DesktopAndAppStreaming", "engagement": "CustomerEngagement",
+    "game": "GameTech", "general": "General", "integration": "ApplicationIntegration", "iot": "InternetOfThings",
+    "management": "ManagementAndGovernance", "media": "MediaServices", "migration": "MigrationAndTransfer",
+    "ml": "MachineLearning", "mobile": "Mobile", "network": "NetworkingAndContentDelivery",
+    "quantum": "QuantumTechnologies", "robotics": "Robotics", "satellite": "Satellite",
+    "security": "SecurityIdentityAndCompliance", "storage": "Storage",
+}
+_name_indexes = {}
+
+def name_trigrams(name):
+    """Padded lowercase trigrams, so short names and prefixes still share grams"""
+    padded = f"$${name.lower()}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance between a and b, or limit + 1 as soon as it must exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def get_name_index(provider=None):
+    """Trigram index over the class names of one provider (e.g. 'aws'), or all providers; built once"""
+    tables = get_repair_tables()
+    cached = _name_indexes.get(provider)
+    if cached is not None and cached["fingerprint"] == tables["fingerprint"]:
+        return cached
+    prefix = f"diagrams.{provider}." if provider else "diagrams"
+    modules = {}
+    for modname, names in tables["module_names"].items():
+        if modname.startswith(prefix):
+            for name in sorted(names):
+                # Keeps the first module (in index order) defining the name
+                modules.setdefault(name, modname)
+    names = list(modules)
+    postings = {}
+    for position, name in enumerate(names):
+        for gram in name_trigrams(name):
+            postings.setdefault(gram, []).append(position)
+    lowercase = {}
+    for name in names:
+        lowercase.setdefault(name.lower(), name)
+    index = {"fingerprint": tables["fingerprint"], "names": names, "lowered": [n.lower() for n in names],
+             "grams": [len(n) + 1 for n in names], "postings": postings, "modules": modules, "lowercase": lowercase}
+    _name_indexes[provider] = index
+    return index
+
+def nearest_class_name(class_name, provider=None, max_distance=None):
+    """Closest known class name within the edit distance threshold (or one the name extends,
+    e.g. Route53Domain -> Route53), or None"""
+    max_distance = NAME_MATCH_MAX_DISTANCE if max_distance is None else max_distance
+    index = get_name_index(provider)
+    shared = {}
+    for gram in name_trigrams(class_name):
+        for position in index["postings"].get(gram, ()):
+            shared[position] = shared.get(position, 0) + 1
+    if not shared:
+        return None
+    query = class_name.lower()
+    query_grams = len(query) + 1
+    # Dice coefficient on trigrams, so long names sharing a prefix do not crowd out the best match
+    overlap = {position: 2 * count / (query_grams + index["grams"][position]) for position, count in shared.items()}
+    # Short names need proportionally closer matches (SQS must not become SES)
+    limit = min(max_distance, len(query) // 3)
+    best, best_key = None, None
+    for position in sorted(overlap, key=overlap.get, reverse=True)[:NAME_MATCH_CANDIDATES]:
+        candidate = index["lowered"][position]
+        distance = edit_distance(query, candidate, limit)
+        if distance > limit:
+            if len(candidate) >= 4 and query.startswith(candidate):
+                distance = limit + 1 # extends a known name: accept, ranked after edit matches
+            else:
+                continue
+        key = (distance, -overlap[position])
+        if best_key is None or key < best_key:
+            best, best_key = index["names"][position], key
+    return best
+
+def generic_category_node(module_path, tables):
+    """(module, class) of the generic icon for the module's category, e.g. diagrams.aws.network
+    -> NetworkingAndContentDelivery; diagrams.aws.general.General for unknown AWS categories"""
+    parts = module_path.split(".")
+    if len(parts) >= 3 and parts[1] == "aws":
+        name = GENERIC_CATEGORY_CLASSES.get(parts[2])
+        if name and name in tables["module_names"].get(module_path, ()):
+            return module_path, name
+        return "diagrams.aws.general", "General"
+    return "diagrams.generic.blank", "Blank"
+
+def resolve_diagrams_import(module_path, class_name, lookup, tables):
+    """Return (module, name, how) for a diagrams import. how is 'valid', 'moved' (class lives in
+    another module), 'case', 'nearest' (misspelling) or 'generic' (category fallback).
+    Matches within the import's provider (e.g. aws) win over other providers."""
+    if class_name in tables["module_names"].get(module_path, ()):
+        return module_path, class_name, "valid"
+    parts = module_path.split(".")
+    provider = parts[1] if len(parts) > 2 else None
+    index = get_name_index(provider)
+
+    def module_for(name):
+        # Keep the script's module when it defines the corrected name (APIGateway is in network and mobile)
+        if name in tables["module_names"].get(module_path, ()):
+            return module_path
+        return lookup.get(name, index["modules"][name])
+
+    if class_name in index["modules"]:
+        return module_for(class_name), class_name, "moved"
+    canonical = index["lowercase"].get(class_name.lower())
+    if canonical:
+        return module_for(canonical), canonical, "case"
+    nearest = nearest_class_name(class_name, provider)
+    if nearest:
+        return module_for(nearest), nearest, "nearest"
+    if class_name in lookup:
+        return lookup[class_name], class_name, "moved"
+    return (*generic_category_node(module_path, tables), "generic")
+
+def iter_statements(tree):
+    """Every statement in the module, nested ones included, without visiting expressions;
+    much cheaper than ast.walk() for finding imports, which are always statements"""
+    stack = list(reversed(tree.body))
+    while stack:
+        statement = stack.pop()
+        yield statement
+        children = []
+        for field in ("body", "orelse", "finalbody"):
+            children.extend(getattr(statement, field, ()))
+        for handler in getattr(statement, "handlers", ()):
+            children.extend(handler.body)
+        for case in getattr(statement, "cases", ()):
+            children.extend(case.body)
+        stack.extend(reversed(children))
+
+@instrumented("import_repair", lambda result: {"modified": result[1]})
+def validate_and_fix_imports(code: str, class_map: dict, only=None, log=print):
+    """Check every diagrams import against the class index in one AST pass and rewrite the
+    script once: wrong modules, wrong case, misspellings and duplicate import lines are fixed.
+
+    only, if given, is a set of imported names to check; other imports are kept as they are.
+    log receives each report line"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        log(f"[ERROR] Could not parse generated code (line {e.lineno}): {e.msg}")
+        return code, False
+    tables = get_repair_tables()
+    # Prefer the AWS class map, then any provider in the index
+    lookup = {**tables["all_names"], **class_map}
+    top_level = {id(node) for node in tree.body}
+    renames = {} # bound name -> corrected name, for usages
+    merged = {} # module -> [(name, asname)] for top-level imports, in first-seen order
+    import_nodes = []
+    changed = False
+    for node in iter_statements(tree):
+        if not (isinstance(node, ast.ImportFrom) and node.module and node.module.startswith("diagrams")):
+            continue
+        import_nodes.append(node)
+        fixed_names = []
+        for alias in node.names:
+            if alias.name == "*" or (only is not None and alias.name not in only):
+                fixed_names.append((node.module, alias.name, alias.asname))
+                continue
+            if node.module not in tables["module_names"]:
+                log(f"[INVALID MODULE] {node.module}")
+            module_path, class_name, how = resolve_diagrams_import(node.module, alias.name, lookup, tables)
+            if how == "valid":
+                log(f"[VALID] {class_name} from {module_path}")
             else:
-                print(f"[UNKNOWN CLASS] {class_name} not found in diagrams.*")
-
-    # Replace imports and usage
-    for i, line in enumerate(code_lines):
-        if line.strip().startswith("from diagrams"):
-            for cls, (old_mod, new_mod) in replacements.items():
-                if f"from {old_mod} import" in line and cls in line:
-                    # Extract all class names in the line
-                    all_classes = re.findall(r'\b\w+\b', line.split("import")[-1])
-                    fixed_classes = [c for c in all_classes if c != cls]
-                    if cls not in fixed_classes:
-                        fixed_classes.append(cls)
-
-                    # Update line to correct module and class list
-                    code_lines[i] = f"from {new_mod} import {', '.join(fixed_classes)}"
-
-    # Replace usages throughout the script
-    full_code = "\n".join(code_lines)
-    for cls, (old_mod, new_mod) in replacements.items():
-        full_code = re.sub(rf'\b{cls}\b', cls, full_code)
-    return full_code, bool(replacements)
+                changed = True
+                if how == "moved":
+                    log(f"[FIX] {class_name} should be imported from {module_path}")
+                elif how == "generic":
+                    log(f"[UNKNOWN CLASS] {alias.name} not found in diagrams.*, using generic {class_name} from {module_path}")
+                else:
+                    log(f"[FIX] {alias.name} should be {class_name} imported from {module_path}")
+                if class_name != alias.name and not alias.asname:
+                    renames[alias.name] = class_name
+            fixed_names.append((module_path, class_name, alias.asname))
+        node.fixed_names = fixed_names
+        if id(node) in top_level:
+            for module_path, class_name, asname in fixed_names:
+                names = merged.setdefault(module_path, [])
+                if (class_name, asname) in names:
+                    changed = True
+                else:
+                    names.append((class_name, asname))
+    top_level_imports = [node for node in import_nodes if id(node) in top_level]
+    if len(top_level_imports) > len(merged):
+        changed = True
+        log(f"[MERGE] {len(top_level_imports)} diagrams import lines merged into {len(merged)}")
+    if not changed:
+        return code, False
+
+    code_lines = code.splitlines()
+    # Usage renames, collected per line as (start, end, text) character edits
+    edits = {}
+    for node in ast.walk(tree) if renames else ():
+        if isinstance(node, ast.Name) and node.id in renames:
+            line = code_lines[node.lineno - 1].encode()
+            # ast offsets are UTF-8 byte offsets
+            start = len(line[:node.col_offset].decode())
+            end = len(line[:node.end_col_offset].decode())
+            edits.setdefault(node.lineno - 1, []).append((start, end, renames[node.id]))
+    for index, line_edits in edits.items():
+        line = code_lines[index]
+        for start, end, text in sorted(line_edits, reverse=True):
+            line = line[:start] + text + line[end:]
+        code_lines[index] = line
+
+    def format_import(module_path, names, indent=""):
+        listed = ", ".join(f"{name} as {asname}" if asname else name for name, asname in names)
+        return f"{indent}from {module_path} import {listed}"
+
+    # Replace import statements: top-level ones collapse into one merged block
+    replacements = {} # first line index -> new lines; other statement lines are dropped
+    dropped = set()
+    for node in import_nodes:
+        dropped.update(range(node.lineno - 1, node.end_lineno))
+        if id(node) in top_level:
+            continue
+        indent = " " * node.col_offset
+        by_module = {}
+        for module_path, class_name, asname in node.fixed_names:
+            by_module.setdefault(module_path, []).append((class_name, asname))
+        replacements[node.lineno - 1] = [format_import(m, names, indent) for m, names in by_module.items()]
+    if top_level_imports:
+        replacements[top_level_imports[0].lineno - 1] = [format_import(m, names) for m, names in merged.items()]
+    fixed_lines = []
+    for index, line in enumerate(code_lines):
+        if index in replacements:
+            fixed_lines.extend(replacements[index])
+        elif index not in dropped:
+            fixed_lines.append(line)
+    full_code = "\n".join(fixed_lines)
+    if code.endswith("\n"):
+        full_code += "\n"
+    return full_code, True
 ####end section on repairing diagram imports
 
-def save_diagram_script(full_code): #code
-    """Save the generated Python script to a file"""
-    script_path = f"generated_aws_diagram_{tracking_number}.py"
-    
-    with open(script_path, "w") as f:
-        f.write(full_code) #code
+####section on static checks of diagram scripts
+# The generated script is evaluated symbolically: every expression is typed as a
+# node, list of nodes, cluster, edge or diagram, so the prompt rules (no list to
+# list or Cluster links, no double links) and undefined names are checked in
+# milliseconds, before Graphviz ever runs.
+EDGE_OPERATORS = {ast.RShift: ">>", ast.LShift: "<<", ast.Sub: "-"}
+
+def collect_bound_names(tree, nodes=None):
+    """Every name the script binds anywhere (assignments, loops, imports, defs, with/except targets);
+    nodes is ast.walk(tree) when the caller already has it"""
+    bound = set(dir(builtins))
+    for node in nodes if nodes is not None else ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            bound.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound.update((alias.asname or alias.name).split(".")[0] for alias in node.names)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+    return bound
+
+def diagram_name_kinds(tree):
+    """Kinds of the names imported from diagrams: Diagram, Cluster, Edge or node classes"""
+    kinds = {}
+    for node in iter_statements(tree):
+        if isinstance(node, ast.ImportFrom) and node.module and node.module.startswith("diagrams"):
+            for alias in node.names:
+                bound = alias.asname or alias.name
+                if node.module == "diagrams":
+                    kinds[bound] = {"Diagram": "diagram", "Cluster": "cluster", "Edge": "edge"}.get(alias.name, "node")
+                else:
+                    kinds[bound] = "node"
+    return kinds
+
+def analyze_diagram_script(code):
+    """Statically check a diagrams script and return a report dict with 'errors' (each with
+    type, line and message), 'nodes', 'edges' and 'seconds'. Nothing is executed."""
+    start = time.perf_counter()
+    report = {"errors": [], "nodes": 0, "edges": 0}
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        report["errors"].append({"type": "SyntaxError", "line": e.lineno, "message": e.msg})
+        report["seconds"] = round(time.perf_counter() - start, 4)
+        return report
+
+    # One walk over all nodes is shared by the checks that need every node
+    nodes = list(ast.walk(tree))
+    bound = collect_bound_names(tree, nodes)
+    callable_kinds = diagram_name_kinds(tree)
+    env = {} # variable -> kind
+    versions = {} # variable -> number of times it was bound, so a rebound name is a new node
+    seen_edges = {} # (source, operator, target) -> first line
+
+    def error(kind, node, message):
+        report["errors"].append({"type": kind, "line": node.lineno, "message": message})
+
+    def operand_key(node):
+        # Only variables and indexed variables identify the same node twice, as long as none
+        # of their names was bound again in between (loop targets, reassignments)
+        if isinstance(node, (ast.Name, ast.Subscript)):
+            names = sorted({name.id for name in ast.walk(node) if isinstance(name, ast.Name)})
+            return ast.unparse(node), tuple(versions.get(name, 0) for name in names)
+        return None
+
+    def kind_of(node):
+        if isinstance(node, ast.Name):
+            return env.get(node.id, "unknown")
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            kind = callable_kinds.get(node.func.id)
+            if kind == "node":
+                report["nodes"] += 1
+            return kind or "unknown"
+        if isinstance(node, (ast.List, ast.Tuple, ast.ListComp)):
+            for element in ast.walk(node):
+                if element is not node and isinstance(element, ast.Call):
+                    kind_of(element)
+            return "list"
+        if isinstance(node, ast.Subscript):
+            return "node" if kind_of(node.value) == "list" else "unknown"
+        if isinstance(node, ast.BinOp) and type(node.op) in EDGE_OPERATORS:
+            return edge_kind(node)
+        return "unknown"
+
+    def edge_kind(node):
+        operator = EDGE_OPERATORS[type(node.op)]
+        left, right = kind_of(node.left), kind_of(node.right)
+        if "cluster" in (left, right):
+            error("ClusterEdge", node, f"Cluster objects cannot be linked: {ast.unparse(node)}")
+        elif left == "list" and right == "list":
+            error("ListToListEdge", node, f"lists of nodes cannot be linked to lists: {ast.unparse(node)}")
+        elif "node" in (left, right) or "edge" in (left, right):
+            report["edges"] += 1
+            # For chains the source is the right-most operand of the left side (a >> b >> c links b and c)
+            source = node.left.right if isinstance(node.left, ast.BinOp) and type(node.left.op) in EDGE_OPERATORS else node.left
+            key = (operand_key(source), operator, operand_key(node.right))
+            if None not in key:
+                if key in seen_edges and seen_edges[key] != node.lineno:
+                    error("DuplicateEdge", node, f"duplicate link {key[0][0]} {operator} {key[2][0]} (first on line {seen_edges[key]})")
+                seen_edges.setdefault(key, node.lineno)
+        return right
+
+    def bind(target, kind):
+        for name in ast.walk(target):
+            if isinstance(name, ast.Name):
+                versions[name.id] = versions.get(name.id, 0) + 1
+        if isinstance(target, ast.Name):
+            env[target.id] = kind
+
+    def visit(statements):
+        for statement in statements:
+            if isinstance(statement, ast.Assign):
+                kind = kind_of(statement.value)
+                for target in statement.targets:
+                    bind(target, kind)
+            elif isinstance(statement, (ast.AnnAssign, ast.AugAssign)) and statement.value is not None:
+                bind(statement.target, kind_of(statement.value))
+            elif isinstance(statement, ast.Expr):
+                kind_of(statement.value)
+            elif isinstance(statement, (ast.With, ast.AsyncWith)):
+                for item in statement.items:
+                    kind = kind_of(item.context_expr)
+                    if item.optional_vars:
+                        bind(item.optional_vars, kind)
+                visit(statement.body)
+            elif isinstance(statement, (ast.For, ast.AsyncFor)):
+                bind(statement.target, "node" if kind_of(statement.iter) == "list" else "unknown")
+                visit(statement.body)
+                visit(statement.orelse)
+            elif isinstance(statement, (ast.If, ast.While)):
+                visit(statement.body)
+                visit(statement.orelse)
+            elif isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Try)):
+                visit(statement.body)
+                for handler in getattr(statement, "handlers", []):
+                    visit(handler.body)
+
+    visit(tree.body)
+    for node in nodes:
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in bound:
+            error("UndefinedName", node, f"name '{node.id}' is not defined")
+            bound.add(node.id) # report each name once
+    report["errors"].sort(key=lambda e: e["line"] or 0)
+    report["seconds"] = round(time.perf_counter() - start, 4)
+    return report
+
+def fix_diagram_script(code, report=None, log=print):
+    """Auto-fix what can be fixed safely: list >> list statements between variables become
+    nested loops and repeated single-link statements are dropped. Returns (code, fixed errors);
+    log receives a line per fix."""
+    report = report or analyze_diagram_script(code)
+    fixable = [e for e in report["errors"] if e["type"] in ("ListToListEdge", "DuplicateEdge")]
+    if not fixable:
+        return code, []
+    tree = ast.parse(code)
+    bound = collect_bound_names(tree)
+    # Statements alone in their block are replaced by pass instead of dropped
+    only_statements = {id(block[0]) for node in ast.walk(tree) for field in ("body", "orelse", "finalbody")
+                       for block in [getattr(node, field, None)] if isinstance(block, list) and len(block) == 1}
+    lines = code.splitlines()
+    lines_to_fix = {e["line"]: e for e in fixable}
+    replacements, fixed = {}, []
+    loop_number = 0
+    for statement in ast.walk(tree):
+        if not (isinstance(statement, ast.Expr) and statement.lineno in lines_to_fix
+                and statement.lineno == statement.end_lineno):
+            continue
+        line = lines[statement.lineno - 1]
+        indent = line[:len(line) - len(line.lstrip())]
+        value = statement.value
+        # Only whole-line statements linking two variables are rewritten
+        if not (isinstance(value, ast.BinOp) and type(value.op) in EDGE_OPERATORS and line.strip() == ast.unparse(value)
+                and all(isinstance(side, (ast.Name, ast.Subscript, ast.List)) for side in (value.left, value.right))):
+            continue
+        error = lines_to_fix[statement.lineno]
+        if error["type"] == "DuplicateEdge":
+            replacements[statement.lineno - 1] = [f"{indent}pass"] if id(statement) in only_statements else []
+        else:
+            while f"_src{loop_number}" in bound or f"_dst{loop_number}" in bound:
+                loop_number += 1
+            source, target = f"_src{loop_number}", f"_dst{loop_number}"
+            loop_number += 1
+            operator = EDGE_OPERATORS[type(value.op)]
+            replacements[statement.lineno - 1] = [
+                f"{indent}for {source} in {ast.unparse(value.left)}:",
+                f"{indent}    for {target} in {ast.unparse(value.right)}:",
+                f"{indent}        {source} {operator} {target}",
+            ]
+        fixed.append(error)
+    if not fixed:
+        return code, []
+    fixed_lines = []
+    for index, line in enumerate(lines):
+        fixed_lines.extend(replacements.get(index, [line]))
+    fixed_code = "\n".join(fixed_lines) + ("\n" if code.endswith("\n") else "")
+    for error in fixed:
+        log(f"[AUTO-FIX] line {error['line']}: {error['message']}")
+    return fixed_code, fixed
+
+@instrumented("static_check", lambda result: {"errors": len(result[1]["errors"]), "fixed": len(result[1]["fixed"])})
+def check_diagram_script(code, log=print):
+    """Analyze, auto-fix and re-analyze a script; passes the report lines to log and returns (code, report)"""
+    report = analyze_diagram_script(code)
+    code, fixed = fix_diagram_script(code, report, log)
+    if fixed:
+        report = analyze_diagram_script(code)
+    report["fixed"] = fixed
+    for error in report["errors"]:
+        log(f"[STATIC {error['type']}] line {error['line']}: {error['message']}")
+    log(f"Static check: {report['nodes']} nodes, {report['edges']} links, {len(report['errors'])} errors ({report['seconds'] * 1000:.1f} ms)")
+    return code, report
+####end section on static checks of diagram scripts
+
+####section on output formats and large diagram layout
+# Every render (diagrams scripts, IR graphs and the render command) goes through layout_dot():
+# it picks the output format and layout engine, splits very large diagrams into an overview and
+# one image per top level cluster rendered in parallel, and reports layout time and size per image.
+# Output format: as the script asks (png by default), or png, svg, svgz (gzip compressed SVG), jpg or pdf.
+# SVG output links the icons from the local diagrams install instead of embedding them.
+RENDER_FORMAT = os.environ.get('AWS_DIAGRAM_FORMAT', '')
+RENDER_FORMATS = ("png", "svg", "svgz", "jpg", "pdf")
+# Layout engine: auto (dot, or fast from LARGE_DIAGRAM_NODES nodes on), dot, fast, sfdp, fdp or neato
+RENDER_ENGINE = os.environ.get('AWS_DIAGRAM_ENGINE', 'auto')
+LARGE_DIAGRAM_NODES = int(os.environ.get('AWS_DIAGRAM_LARGE_NODES', '50'))
+# From this many nodes a diagram with two or more top level clusters is split; 0 never splits
+SPLIT_DIAGRAM_NODES = int(os.environ.get('AWS_DIAGRAM_SPLIT_NODES', '100'))
+# Graphviz program and graph attributes per engine. 'fast' keeps dot's ranked, clustered look
+# but routes edges as polylines instead of the (slow) orthogonal splines and caps crossing
+# minimization; sfdp, fdp and neato are force directed and sfdp/neato ignore clusters.
+LAYOUT_ENGINES = {"dot": ("dot", {}),
+                  "fast": ("dot", {"splines": "polyline", "mclimit": "0.3", "nslimit": "2", "nslimit1": "2",
+                                   "remincross": "false", "searchsize": "10"}),
+                  "sfdp": ("sfdp", {"splines": "line", "overlap": "prism"}),
+                  "fdp": ("fdp", {"splines": "line"}),
+                  "neato": ("neato", {"splines": "line", "overlap": "false"})}
+DOT_ID = r'"(?:[^"\\]|\\.)*"|[\w.]+'
+DOT_NODE_PATTERN = re.compile(rf'\s*({DOT_ID})\s*\[')
+DOT_EDGE_PATTERN = re.compile(rf'\s*({DOT_ID})\s*->\s*({DOT_ID})')
+# Attribute statements (graph/node/edge defaults, bare or with attributes), never nodes
+DOT_ATTR_STATEMENT_PATTERN = re.compile(r'\s*(graph|node|edge)\s*(\[|;|$)', re.IGNORECASE)
+DOT_LABEL_PATTERN = re.compile(r'[\[\s,]label=("(?:[^"\\]|\\.)*"|[^\s,\]]+)')
+
+def render_settings():
+    """Render options that change the produced images, for render cache keys"""
+    return f"{RENDER_FORMAT or 'default'}:{RENDER_ENGINE}:{LARGE_DIAGRAM_NODES}:{SPLIT_DIAGRAM_NODES}"
+
+def layout_engine(nodes, engine=None):
+    """(engine name, Graphviz program, extra graph attributes) for a graph with this many nodes"""
+    engine = engine or RENDER_ENGINE
+    if engine == "auto":
+        engine = "fast" if nodes >= LARGE_DIAGRAM_NODES else "dot"
+    return (engine,) + LAYOUT_ENGINES[engine]
+
+def unquote_dot_id(value):
+    """Text of a DOT ID or attribute value, quoted or not"""
+    if value.startswith('"'):
+        return value[1:-1].replace('\\"', '"')
+    return value
+
+def parse_dot_graph(dot_source):
+    """Split DOT source, one statement per line as written by graphviz and emit_dot(), into the
+    header (graph opening and default attributes), top level nodes, edges and other lines, and
+    one block per top level cluster with its lines, label and the nodes it contains"""
+    lines = dot_source.rstrip().splitlines()
+    graph = {"header": [lines[0]], "nodes": [], "edges": [], "other": [], "blocks": []}
+    position = 1
+    while position < len(lines) - 1 and DOT_ATTR_STATEMENT_PATTERN.match(lines[position]):
+        graph["header"].append(lines[position])
+        position += 1
+    depth, block = 0, None
+    for line in lines[position:-1]:
+        stripped = line.strip()
+        if stripped.startswith("subgraph") and stripped.endswith("{"):
+            if depth == 0:
+                block = {"id": stripped[len("subgraph"):-1].strip(), "label": None, "lines": [], "nodes": set()}
+                graph["blocks"].append(block)
+            depth += 1
+        elif stripped == "}" and depth:
+            depth -= 1
+            block["lines"].append(line)
+            if depth == 0:
+                block = None
+            continue
+        if block is not None:
+            block["lines"].append(line)
+            if DOT_ATTR_STATEMENT_PATTERN.match(line):
+                # The first graph attributes of the block carry its label; nested clusters' are skipped
+                if stripped.lower().startswith("graph") and block["label"] is None:
+                    label = DOT_LABEL_PATTERN.search(stripped)
+                    block["label"] = unquote_dot_id(label.group(1)) if label else None
+            elif not stripped.startswith("subgraph"):
+                node = DOT_NODE_PATTERN.match(line)
+                if node and not DOT_EDGE_PATTERN.match(line):
+                    block["nodes"].add(node.group(1))
+            continue
+        edge = DOT_EDGE_PATTERN.match(line)
+        node = DOT_NODE_PATTERN.match(line)
+        if edge:
+            graph["edges"].append((edge.group(1), edge.group(2), line))
+        elif node and not DOT_ATTR_STATEMENT_PATTERN.match(line):
+            graph["nodes"].append((node.group(1), line))
+        else:
+            graph["other"].append(line)
+    graph["node_count"] = len(graph["nodes"]) + sum(len(block["nodes"]) for block in graph["blocks"])
+    return graph
+
+def assemble_dot(graph, body, attrs=None):
+    """DOT source from a parsed header, body lines and extra graph attributes"""
+    extra = [f"\tgraph [{dot_attrs(attrs)}]"] if attrs else []
+    return "\n".join(graph["header"] + extra + body + ["}"]) + "\n"
+
+def split_dot_graph(graph):
+    """(file suffix, body lines, extra attributes, nodes, edges) per image: an overview with each top
+    level cluster collapsed into one box, then each cluster with the links inside it"""
+    owner = {node_id: block["id"] for block in graph["blocks"] for node_id in block["nodes"]}
+    overview = [line for _, line in graph["nodes"]] + graph["other"]
+    for number, block in enumerate(graph["blocks"]):
+        label = f"{block['label'] or block['id']}\n({len(block['nodes'])} nodes)"
+        attrs = {"label": label, "shape": "box", "style": "rounded,filled", "fillcolor": DOT_CLUSTER_BGCOLORS[number % len(DOT_CLUSTER_BGCOLORS)],
+                 "fixedsize": "false", "width": "2", "height": "1", "labelloc": "c"}
+        overview.append(f"\t{block['id']} [{dot_attrs(attrs)}]")
+    seen = set()
+    for source, target, line in graph["edges"]:
+        source_id, target_id = owner.get(source, source), owner.get(target, target)
+        if source_id == target_id or (source_id, target_id) in seen:
+            continue
+        seen.add((source_id, target_id))
+        match = DOT_EDGE_PATTERN.match(line)
+        overview.append(line[:match.start(1)] + source_id + line[match.end(1):match.start(2)] + target_id + line[match.end(2):])
+    parts = [("", overview, None, len(graph["nodes"]) + len(graph["blocks"]), len(seen))]
+    title = next((DOT_LABEL_PATTERN.search(line) for line in graph["header"] if line.strip().startswith("graph [")), None)
+    title = f"{unquote_dot_id(title.group(1))}: " if title else ""
+    slugs = set()
+    for number, block in enumerate(graph["blocks"]):
+        slug = re.sub(r"\W+", "_", block["label"] or "").strip("_").lower() or f"cluster{number + 1}"
+        while slug in slugs:
+            slug += f"_{number + 1}"
+        slugs.add(slug)
+        edges = [line for source, target, line in graph["edges"] if source in block["nodes"] and target in block["nodes"]]
+        parts.append((f"_{slug}", block["lines"] + edges, {"label": title + (block["label"] or slug)}, len(block["nodes"]), len(edges)))
+    return parts
+
+def run_graphviz(dot_source, image_path, outformat, program):
+    """Lay out one DOT graph into image_path; returns (seconds, bytes, error or None)"""
+    start = time.perf_counter()
+    try:
+        completed = subprocess.run([program, f"-T{outformat}", "-o", str(image_path)], input=dot_source.encode(),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        return time.perf_counter() - start, 0, {"type": "ExecutableNotFound", "message": f"Graphviz '{program}' is not installed or not in PATH", "line": None}
+    if completed.returncode != 0:
+        return time.perf_counter() - start, 0, {"type": "GraphvizError", "message": completed.stderr.decode(errors="replace").strip(), "line": None}
+    return time.perf_counter() - start, os.path.getsize(image_path), None
+
+def layout_dot(dot_source, output_stem, outformat=None, engine=None):
+    """Lay out DOT source into <stem>.<format>, split into <stem>.<format> (overview) plus
+    <stem>_<cluster>.<format> when very large, laying the parts out in parallel.
+    Returns one dict per image: 'image', 'engine', 'nodes', 'edges', 'seconds', 'bytes', 'error'."""
+    outformat = outformat or RENDER_FORMAT or "png"
+    graph = parse_dot_graph(dot_source)
+    if SPLIT_DIAGRAM_NODES and graph["node_count"] >= SPLIT_DIAGRAM_NODES and len(graph["blocks"]) >= 2:
+        parts = split_dot_graph(graph)
+    else:
+        body = [line for _, line in graph["nodes"]] + [line for block in graph["blocks"] for line in block["lines"]]
+        parts = [("", body + graph["other"] + [line for _, _, line in graph["edges"]], None, graph["node_count"], len(graph["edges"]))]
+
+    def run(part):
+        suffix, body, attrs, nodes, edges = part
+        name, program, engine_attrs = layout_engine(nodes, engine)
+        image = f"{output_stem}{suffix}.{outformat}"
+        seconds, size, error = run_graphviz(assemble_dot(graph, body, {**engine_attrs, **(attrs or {})}), image, outformat, program)
+        return {"image": image, "engine": name, "nodes": nodes, "edges": edges, "seconds": round(seconds, 3), "bytes": size, "error": error}
+
+    if len(parts) == 1:
+        return [run(parts[0])]
+    # Graphviz runs in subprocesses, so threads are enough to use every core
+    with ThreadPoolExecutor(max_workers=min(len(parts), os.cpu_count() or 1)) as pool:
+        return list(pool.map(run, parts))
+
+def format_layout_report(layout):
+    """One line per laid out image: engine, graph size, layout time and file size"""
+    return "\n".join(f"  {part['image']}: {part['engine']} layout of {part['nodes']} nodes and {part['edges']} links "
+                     f"in {part['seconds']:.2f} s, {part['bytes'] / 1024:.0f} KB" for part in layout if not part["error"])
+
+def render_stage_fields(result):
+    """Telemetry fields of a render result, including layout time and output size"""
+    fields = {"ok": result["ok"], "cache_hit": result["cache_hit"], "error": (result.get("error") or {}).get("type")}
+    if result.get("layout"):
+        fields.update({"engine": result["layout"][0]["engine"], "parts": len(result["layout"]),
+                       "nodes": sum(part["nodes"] for part in result["layout"][1:]) or result["layout"][0]["nodes"],
+                       "layout_seconds": round(sum(part["seconds"] for part in result["layout"]), 3),
+                       "bytes": sum(part["bytes"] for part in result["layout"])})
+    return fields
+####end section on output formats and large diagram layout
+
+####section on the JSON graph IR
+# Optional mode: the model returns a compact JSON graph instead of a script, and a
+# local compiler validates it against the class index and emits DOT (rendered by
+# Graphviz directly, no exec) or an equivalent diagrams script.
+IR_PROMPT_TEMPLATE = """
+        Acting as a cloud architect, describe an AWS architecture diagram for the following description as a JSON graph, not as Python code.
+        Return ONLY one ```json code block with this structure:
+        {{"title": "Diagram title", "direction": "LR",
+         "clusters": [{{"id": "app", "label": "Application Tier", "parent": null}}],
+         "nodes": [{{"id": "api", "class": "APIGateway", "label": "API Gateway", "cluster": "app"}}],
+         "edges": [{{"from": "api", "to": "fn", "label": "", "direction": "forward"}}]}}
+        - direction is one of TB, BT, LR, RL; edge direction is forward, back, both or none
+        - "parent" nests clusters; "cluster" may be null for top level nodes
+        - every edge connects two node ids; clusters are never linked; do not repeat links
+        - "class" must be one of these diagrams classes:
+{classes}
+
+        Description: {description}
+        """
+IR_DIRECTIONS = ("TB", "BT", "LR", "RL")
+IR_EDGE_DIRECTIONS = {"forward": ">>", "back": "<<", "both": None, "none": "-"}
+# Graphviz attributes matching the diagrams package defaults
+DOT_GRAPH_ATTRS = {"pad": "2.0", "splines": "ortho", "nodesep": "0.60", "ranksep": "0.75",
+                   "fontname": "Sans-Serif", "fontsize": "15", "fontcolor": "#2D3436"}
+DOT_NODE_ATTRS = {"shape": "box", "style": "rounded", "fixedsize": "true", "width": "1.4", "height": "1.4",
+                  "labelloc": "b", "imagescale": "true", "fontname": "Sans-Serif", "fontsize": "13", "fontcolor": "#2D3436"}
+DOT_EDGE_ATTRS = {"color": "#7B8894", "fontname": "Sans-Serif", "fontsize": "13", "fontcolor": "#2D3436"}
+DOT_CLUSTER_ATTRS = {"shape": "box", "style": "rounded", "labeljust": "l", "pencolor": "#AEB6BE",
+                     "fontname": "Sans-Serif", "fontsize": "12"}
+DOT_CLUSTER_BGCOLORS = ("#E5F5FD", "#EBF3E7", "#ECE8F6", "#FDF7E3")
+
+@instrumented("prompt_build", lambda prompt: {"mode": "ir", "estimated_tokens": estimate_tokens(prompt)})
+def build_ir_prompt(description):
+    """Prompt asking for the JSON graph IR, listing the classes relevant to the description"""
+    whitelist = select_relevant_classes(description)
+    classes = "\n".join(f"        {module.split('.')[-1]}: {', '.join(names)}" for module, names in whitelist.items())
+    return IR_PROMPT_TEMPLATE.format(classes=classes, description=description)
+
+def find_graph_ir(text):
+    """Parse the JSON graph IR from a model response; None when the response is not an IR.
+    Not instrumented, as routing checks every model answer with it"""
+    if not text:
+        return None
+    if "```json" in text:
+        start_idx = text.find("```json") + len("```json")
+        end_idx = text.find("```", start_idx)
+        candidate = text[start_idx:end_idx if end_idx != -1 else None]
+    elif "{" in text:
+        candidate = text[text.find("{"):text.rfind("}") + 1]
+    else:
+        return None
+    try:
+        ir = json.loads(candidate)
+    except ValueError:
+        return None
+    return ir if isinstance(ir, dict) and isinstance(ir.get("nodes"), list) else None
+
+@instrumented("extraction", lambda ir: {"format": "ir", "found": ir is not None})
+def extract_graph_ir(text):
+    """find_graph_ir() for the response that was chosen, recorded as the extraction stage"""
+    return find_graph_ir(text)
+
+@instrumented("ir_compile", lambda result: {"nodes": result[1]["nodes"], "edges": result[1]["edges"]})
+def compile_graph_ir(ir, class_map=None):
+    """Validate the IR against the class index in linear time.
+
+    Returns (graph, report): graph holds resolved nodes, clusters, a parent -> children
+    tree and de-duplicated edges; report lists 'fixes' and 'errors'. Unknown classes are
+    resolved like imports (nearest name or generic icon), dangling references dropped.
+    Raises ValueError when the IR is not shaped as lists of objects."""
+    start = time.perf_counter()
+    if not isinstance(ir, dict) or not isinstance(ir.get("nodes"), list):
+        raise ValueError("'graph' needs a 'nodes' list")
+    for field in ("nodes", "clusters", "edges"):
+        items = ir.get(field) or []
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError(f"'graph' {field} must be a list of objects")
+    tables = get_repair_tables()
+    lookup = {**tables["all_names"], **(class_map if class_map is not None else build_aws_class_to_module_map())}
+    report = {"fixes": [], "errors": []}
+    direction = str(ir.get("direction", "LR")).upper()
+    graph = {"title": str(ir.get("title") or "Architecture"), "direction": direction if direction in IR_DIRECTIONS else "LR",
+             "clusters": {}, "nodes": {}, "edges": [], "children": {None: {"clusters": [], "nodes": []}}}
+
+    for cluster in ir.get("clusters") or []:
+        cluster_id = str(cluster.get("id", ""))
+        if not cluster_id or cluster_id in graph["clusters"]:
+            report["errors"].append(f"cluster '{cluster_id}' has a missing or duplicate id, skipped")
+            continue
+        graph["clusters"][cluster_id] = {"label": str(cluster.get("label") or cluster_id), "parent": cluster.get("parent")}
+        graph["children"][cluster_id] = {"clusters": [], "nodes": []}
+    for cluster_id, cluster in graph["clusters"].items():
+        if cluster["parent"] is not None and str(cluster["parent"]) not in graph["clusters"]:
+            report["fixes"].append(f"cluster '{cluster_id}' has unknown parent '{cluster['parent']}', moved to top level")
+            cluster["parent"] = None
+        elif cluster["parent"] is not None:
+            cluster["parent"] = str(cluster["parent"])
+    # Break parent cycles: each cluster is visited once overall
+    state = {}
+    for cluster_id in graph["clusters"]:
+        path = []
+        current = cluster_id
+        while current is not None and current not in state:
+            state[current] = "visiting"
+            path.append(current)
+            current = graph["clusters"][current]["parent"]
+        if current is not None and state[current] == "visiting":
+            report["fixes"].append(f"cluster '{current}' is its own ancestor, moved to top level")
+            graph["clusters"][current]["parent"] = None
+        for visited in path:
+            state[visited] = "done"
+    for cluster_id, cluster in graph["clusters"].items():
+        graph["children"][cluster["parent"]]["clusters"].append(cluster_id)
+
+    resolved = {} # class name as written -> (module, class), resolved once per distinct class
+    for node in ir["nodes"]:
+        node_id = str(node.get("id", ""))
+        if not node_id or node_id in graph["nodes"]:
+            report["errors"].append(f"node '{node_id}' has a missing or duplicate id, skipped")
+            continue
+        written = str(node.get("class") or "General")
+        if written not in resolved:
+            parts = written.split(".")
+            name = parts[-1]
+            hint = ".".join(["diagrams"] + [p for p in parts[:-1] if p != "diagrams"]) if len(parts) > 1 else lookup.get(name, "diagrams.aws.general")
+            module_path, class_name, how = resolve_diagrams_import(hint, name, lookup, tables)
+            if class_name != name:
+                report["fixes"].append(f"class '{written}' replaced by {class_name} ({how})")
+            resolved[written] = (module_path, class_name)
+        module_path, class_name = resolved[written]
+        cluster_id = node.get("cluster")
+        if cluster_id is not None and str(cluster_id) not in graph["clusters"]:
+            report["fixes"].append(f"node '{node_id}' is in unknown cluster '{cluster_id}', moved to top level")
+            cluster_id = None
+        cluster_id = None if cluster_id is None else str(cluster_id)
+        graph["nodes"][node_id] = {"module": module_path, "class": class_name,
+                                   "label": str(node.get("label") or class_name), "cluster": cluster_id}
+        graph["children"][cluster_id]["nodes"].append(node_id)
+
+    seen = set()
+    for edge in ir.get("edges") or []:
+        source, target = str(edge.get("from", "")), str(edge.get("to", ""))
+        if source not in graph["nodes"] or target not in graph["nodes"]:
+            report["fixes"].append(f"edge {source} -> {target} references an unknown node, dropped")
+            continue
+        direction = edge.get("direction", "forward")
+        direction = direction if direction in IR_EDGE_DIRECTIONS else "forward"
+        label = str(edge.get("label") or "")
+        key = (source, target, direction, label)
+        if key in seen:
+            report["fixes"].append(f"duplicate edge {source} -> {target} dropped")
+            continue
+        seen.add(key)
+        graph["edges"].append({"from": source, "to": target, "direction": direction, "label": label})
+    report["nodes"], report["edges"], report["clusters"] = len(graph["nodes"]), len(graph["edges"]), len(graph["clusters"])
+    report["seconds"] = round(time.perf_counter() - start, 4)
+    return graph, report
+
+def dot_attrs(attrs):
+    """Graphviz attribute list, quoted so labels may contain any text"""
+    return ", ".join(f'{key}={json.dumps(str(value), ensure_ascii=False)}' for key, value in attrs.items())
+
+def walk_ir_clusters(graph):
+    """Yield ('open', cluster_id, depth), ('node', node_id, depth) and ('close', cluster_id, depth)
+    events for the cluster tree, iteratively so deep hierarchies cannot hit the recursion limit"""
+    stack = [("open", None, -1)]
+    while stack:
+        event, item, depth = stack.pop()
+        if event != "open":
+            yield event, item, depth
+            continue
+        if item is not None:
+            yield "open", item, depth
+            stack.append(("close", item, depth))
+        children = graph["children"][item]
+        for cluster_id in reversed(children["clusters"]):
+            stack.append(("open", cluster_id, depth + 1))
+        for node_id in reversed(children["nodes"]):
+            stack.append(("node", node_id, depth + 1))
+    return
+
+def emit_dot(graph):
+    """Compile the IR graph into DOT source with the diagrams look and icons"""
+    index = load_class_index()
+    icons = {}
+    for module_path, entry in index["modules"].items():
+        for name, icon in entry.get("icons", {}).items():
+            icons[(module_path, name)] = os.path.join(index["resources_root"], icon)
+        for alias, target in entry["aliases"].items():
+            if target in entry.get("icons", {}):
+                icons[(module_path, alias)] = os.path.join(index["resources_root"], entry["icons"][target])
+    lines = [f"digraph {json.dumps(graph['title'], ensure_ascii=False)} {{",
+             f"\tgraph [{dot_attrs({**DOT_GRAPH_ATTRS, 'label': graph['title'], 'rankdir': graph['direction']})}]",
+             f"\tnode [{dot_attrs(DOT_NODE_ATTRS)}]",
+             f"\tedge [{dot_attrs(DOT_EDGE_ATTRS)}]"]
+    for event, item, depth in walk_ir_clusters(graph):
+        indent = "\t" * (depth + 1)
+        if event == "open":
+            cluster = graph["clusters"][item]
+            attrs = {**DOT_CLUSTER_ATTRS, "label": cluster["label"], "bgcolor": DOT_CLUSTER_BGCOLORS[depth % len(DOT_CLUSTER_BGCOLORS)]}
+            lines.append(f"{indent}subgraph {json.dumps('cluster_' + item, ensure_ascii=False)} {{")
+            lines.append(f"{indent}\tgraph [{dot_attrs(attrs)}]")
+        elif event == "close":
+            lines.append(f"{indent}}}")
+        else:
+            node = graph["nodes"][item]
+            attrs = {"label": node["label"]}
+            icon = icons.get((node["module"], node["class"]))
+            if icon:
+                attrs.update({"shape": "none", "height": str(1.9 + 0.4 * node["label"].count("\n")), "image": icon})
+            lines.append(f"{indent}{json.dumps(item, ensure_ascii=False)} [{dot_attrs(attrs)}]")
+    for edge in graph["edges"]:
+        attrs = {"dir": edge["direction"]}
+        if edge["label"]:
+            attrs["label"] = edge["label"]
+        lines.append(f"\t{json.dumps(edge['from'], ensure_ascii=False)} -> {json.dumps(edge['to'], ensure_ascii=False)} [{dot_attrs(attrs)}]")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+def emit_diagrams_script(graph):
+    """Compile the IR graph into an equivalent, editable diagrams Python script"""
+    imports = {"diagrams": ["Diagram"] + (["Cluster"] if graph["clusters"] else [])}
+    if any(edge["label"] or edge["direction"] == "both" for edge in graph["edges"]):
+        imports["diagrams"].append("Edge")
+    taken = set(imports["diagrams"])
+    for node in graph["nodes"].values():
+        names = imports.setdefault(node["module"], [])
+        if node["class"] not in names:
+            names.append(node["class"])
+            taken.add(node["class"])
+    variables = {}
+    for node_id in graph["nodes"]:
+        variable = re.sub(r"\W", "_", node_id)
+        if not variable or variable[0].isdigit() or keyword.iskeyword(variable):
+            variable = "n_" + variable
+        while variable in taken:
+            variable += "_"
+        taken.add(variable)
+        variables[node_id] = variable
+
+    lines = [f"from {module} import {', '.join(names)}" for module, names in imports.items()]
+    lines += ["", f"with Diagram({graph['title']!r}, show=False, direction={graph['direction']!r}):"]
+    for event, item, depth in walk_ir_clusters(graph):
+        indent = "    " * (depth + 1)
+        if event == "open":
+            lines.append(f"{indent}with Cluster({graph['clusters'][item]['label']!r}):")
+            if not (graph["children"][item]["clusters"] or graph["children"][item]["nodes"]):
+                lines.append(f"{indent}    pass")
+        elif event == "node":
+            node = graph["nodes"][item]
+            lines.append(f"{indent}{variables[item]} = {node['class']}({node['label']!r})")
+    if not graph["nodes"] and not graph["clusters"]:
+        lines.append("    pass")
+    if graph["edges"]:
+        lines.append("")
+    for edge in graph["edges"]:
+        source, target = variables[edge["from"]], variables[edge["to"]]
+        operator = IR_EDGE_DIRECTIONS[edge["direction"]]
+        if edge["direction"] == "both":
+            label = f", label={edge['label']!r}" if edge["label"] else ""
+            lines.append(f"    {source} >> Edge(reverse=True{label}) >> {target}")
+        elif edge["label"]:
+            lines.append(f"    {source} {operator} Edge(label={edge['label']!r}) {operator} {target}")
+        else:
+            lines.append(f"    {source} {operator} {target}")
+    return "\n".join(lines) + "\n"
+
+@instrumented("render", render_stage_fields)
+def render_dot(dot_source, output_stem, outformat=None, engine=None, use_cache=True):
+    """Lay out DOT source with layout_dot(); returns a result like render_diagram_code()"""
+    start = time.perf_counter()
+    outformat = outformat or RENDER_FORMAT or "png"
+    result = {"script": None, "ok": False, "images": [], "cache_hit": False, "layout": []}
+    settings = f"{outformat}:{engine or RENDER_ENGINE}:{LARGE_DIAGRAM_NODES}:{SPLIT_DIAGRAM_NODES}"
+    cache_key = render_cache_key(f"dot:{settings}", hashlib.sha256(dot_source.encode()).hexdigest()) if use_cache else None
+    if cache_key:
+        # Cached image names are relative to the output stem, which differs between runs
+        images = read_cached_render(cache_key, targets=lambda name: f"{output_stem}{name}")
+        if images is not None:
+            result.update({"ok": True, "images": images, "cache_hit": True, "seconds": round(time.perf_counter() - start, 3)})
+            return result
+    result["layout"] = layout_dot(dot_source, output_stem, outformat, engine)
+    failed = [part["error"] for part in result["layout"] if part["error"]]
+    if failed:
+        result["error"] = failed[0]
+    else:
+        result["ok"], result["images"] = True, [part["image"] for part in result["layout"]]
+        if cache_key:
+            store_cached_render(cache_key, [(image, image[len(str(output_stem)):]) for image in result["images"]])
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+def write_graph_ir_outputs(graph_ir, output_stem, class_map=None, render=True):
+    """Compile an IR and write <stem>.json, <stem>.dot and <stem>.py, then render the DOT"""
+    print("\nCompiling JSON graph...")
+    graph, report = compile_graph_ir(graph_ir, class_map)
+    for fix in report["fixes"]:
+        print(f"[FIX] {fix}")
+    for error in report["errors"]:
+        print(f"[IR ERROR] {error}")
+    print(f"Graph: {report['nodes']} nodes, {report['edges']} links, {report['clusters']} clusters ({report['seconds'] * 1000:.1f} ms)")
+    Path(f"{output_stem}.json").write_text(json.dumps(graph_ir, indent=2))
+    Path(f"{output_stem}.dot").write_text(emit_dot(graph))
+    Path(f"{output_stem}.py").write_text(emit_diagrams_script(graph))
+    print(f"Graph written to {output_stem}.json, {output_stem}.dot and {output_stem}.py")
+    result = render_dot(Path(f"{output_stem}.dot").read_text(), output_stem) if render else None
+    if result and result["ok"]:
+        for image in result["images"]:
+            print(f"\nGenerated diagram file: {image}")
+        print(f"Rendered in {result['seconds']:.2f} s{', from render cache' if result['cache_hit'] else ''}")
+        if result["layout"]:
+            print(format_layout_report(result["layout"]))
+        print(format_render_cache_stats())
+    elif result:
+        print(f"Rendering failed: {result['error']['type']}: {result['error']['message']}")
+    return graph, report, result
+####end section on the JSON graph IR
+
+####section on the run artifact store
+# Every run gets its own directory, named by time, description hash and a random
+# suffix, holding the description, raw model response, fixed script, images and a
+# run.json of metrics, so concurrent and repeated runs never overwrite each other.
+# index.jsonl maps run IDs to their records for lookups without scanning directories;
+# the run.json files stay the source of truth and can always rebuild it.
+ARTIFACT_DIR = Path(os.environ.get('AWS_DIAGRAM_RUNS_DIR', 'diagram_runs'))
+# Retention: the newest runs kept (0 keeps all) and the maximum age in days (0 keeps all)
+ARTIFACT_KEEP_RUNS = int(os.environ.get('AWS_DIAGRAM_KEEP_RUNS', '200'))
+ARTIFACT_MAX_AGE_DAYS = float(os.environ.get('AWS_DIAGRAM_RUNS_MAX_AGE_DAYS', '0'))
+ARTIFACT_INDEX_NAME = "index.jsonl"
+_run_index = {} # run ID -> index record
+_run_index_state = None # (path, size) of the index file _run_index reflects
+_run_index_lock = threading.RLock()
+
+def description_hash(description):
+    """Content hash of a description, ignoring surrounding whitespace"""
+    return hashlib.sha256(description.strip().encode()).hexdigest()
+
+def run_path(run, name=""):
+    """Directory of a run, or one of its files"""
+    return ARTIFACT_DIR / run["id"] / name
+
+def write_run_json(run):
+    """Atomically write the run.json of a run"""
+    path = run_path(run, "run.json")
+    tmp_path = path.with_name(f".run.json.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_text(json.dumps(run, indent=2, default=str))
+    os.replace(tmp_path, path)
+
+def create_run(description=None, kind="generate", **fields):
+    """Start a run in a new, collision-free directory, saving its description; returns the run record"""
+    digest = description_hash(description) if description else None
+    ARTIFACT_DIR.mkdir(parents=True, exist_ok=True)
+    while True:
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{(digest or 'none')[:8]}-{random.getrandbits(32):08x}"
+        try:
+            (ARTIFACT_DIR / run_id).mkdir()
+            break
+        except FileExistsError:
+            continue
+    run = {"id": run_id, "kind": kind, "status": "running", "created": round(time.time(), 3), "telemetry_run": RUN_ID,
+           "description_hash": digest, "files": {}, **fields}
+    if description:
+        save_run_file(run, "description", "description.txt", description)
+    write_run_json(run)
+    return run
+
+def save_run_file(run, role, name, data):
+    """Write one artifact of a run (dicts as JSON) and record it under role; returns its path"""
+    path = run_path(run, name)
+    if isinstance(data, dict):
+        data = json.dumps(data, indent=2, default=str)
+    path.write_text(data)
+    run["files"][role] = name
+    return path
+
+def add_run_images(run, images):
+    """Record rendered images (paths inside the run directory) as artifacts of the run"""
+    names = run["files"].setdefault("images", [])
+    for image in images:
+        name = os.path.relpath(image, run_path(run))
+        if name not in names:
+            names.append(name)
+
+def finish_run(run, status="ok", **fields):
+    """Record the outcome and metrics of a run in run.json and the index, then apply retention"""
+    run.update(fields)
+    run.update({"status": status, "finished": round(time.time(), 3), "seconds": round(time.time() - run["created"], 3)})
+    write_run_json(run)
+    append_run_index(run)
+    removed = gc_runs()
+    if removed:
+        print(f"[GC] Removed {len(removed)} old runs from {ARTIFACT_DIR}")
+    return run
+
+def run_index_path():
+    return ARTIFACT_DIR / ARTIFACT_INDEX_NAME
+
+def append_run_index(run):
+    """Append a run record to the index; one write in append mode, so lines of concurrent processes do not mix"""
+    global _run_index_state
+    path = run_index_path()
+    line = json.dumps(run, default=str) + "\n"
+    with _run_index_lock:
+        size = path.stat().st_size if path.exists() else 0
+        with open(path, "a") as index_file:
+            index_file.write(line)
+        # Still in step with the file unless another process appended meanwhile
+        if _run_index_state == (str(path), size):
+            _run_index_state = (str(path), size + len(line.encode()))
+        _run_index[run["id"]] = run
+
+def load_run_index():
+    """Run ID -> record, re-read only when the index file changed"""
+    global _run_index_state
+    path = run_index_path()
+    with _run_index_lock:
+        state = (str(path), path.stat().st_size if path.exists() else 0)
+        if state != _run_index_state:
+            _run_index.clear()
+            if state[1]:
+                with open(path) as index_file:
+                    for line in index_file:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        _run_index[record["id"]] = record
+            _run_index_state = state
+        return _run_index
+
+def write_run_index(records=None, removed=()):
+    """Atomically replace the index with records, or with the current records except the removed IDs"""
+    global _run_index_state
+    path = run_index_path()
+    with _run_index_lock:
+        if records is None:
+            # Taken under the lock, so runs appended since the caller looked are kept
+            records = [record for run_id, record in load_run_index().items() if run_id not in removed]
+        tmp_path = path.with_name(f".{ARTIFACT_INDEX_NAME}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text("".join(json.dumps(record, default=str) + "\n" for record in records))
+        os.replace(tmp_path, path)
+        _run_index.clear()
+        _run_index.update((record["id"], record) for record in records)
+        _run_index_state = (str(path), path.stat().st_size)
+
+def find_run(key):
+    """Run record by ID, unique ID prefix or 'latest'; None when unknown"""
+    index = load_run_index()
+    if key == "latest":
+        return max(index.values(), key=lambda record: record["created"], default=None)
+    if key in index:
+        return index[key]
+    # Runs still in progress, or appended while another process compacted the index
+    path = ARTIFACT_DIR / key / "run.json"
+    if path.is_file():
+        return json.loads(path.read_text())
+    matches = [record for run_id, record in index.items() if run_id.startswith(key)]
+    return matches[0] if len(matches) == 1 else None
+
+def find_run_of_path(path):
+    """Record of the run whose directory holds path, if any"""
+    run_json = Path(path).resolve().parent / "run.json"
+    return json.loads(run_json.read_text()) if run_json.is_file() else None
+
+def rebuild_run_index():
+    """Rebuild the index from the run.json files of every run directory; returns the record count"""
+    records = []
+    for entry in sorted(ARTIFACT_DIR.iterdir()) if ARTIFACT_DIR.exists() else []:
+        try:
+            records.append(json.loads((entry / "run.json").read_text()))
+        except (OSError, ValueError):
+            continue
+    write_run_index(records)
+    return len(records)
+
+def gc_runs(keep=None, max_age_days=None):
+    """Delete indexed runs older than max_age_days, then the oldest beyond the newest keep; returns the removed IDs"""
+    keep = ARTIFACT_KEEP_RUNS if keep is None else keep
+    max_age_days = ARTIFACT_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    oldest_allowed = time.time() - max_age_days * 86400 if max_age_days else 0
+    runs = sorted(load_run_index().values(), key=lambda record: record["created"], reverse=True)
+    removed = [record["id"] for position, record in enumerate(runs)
+               if (keep and position >= keep) or record["created"] < oldest_allowed]
+    if not removed:
+        return []
+    for run_id in removed:
+        shutil.rmtree(ARTIFACT_DIR / run_id, ignore_errors=True)
+    write_run_index(removed=set(removed))
+    return removed
+
+def run_runs_command(action="list", key=None, limit=20, keep=None, max_age_days=None):
+    """Runs command: list recent runs, show one, or rebuild the index and collect garbage"""
+    if action == "gc":
+        print(f"Indexed {rebuild_run_index()} runs in {ARTIFACT_DIR}")
+        removed = gc_runs(keep, max_age_days)
+        print(f"Removed {len(removed)} runs" + (f": {', '.join(removed)}" if removed else ""))
+        return True
+    if action == "show":
+        run = find_run(key or "latest")
+        if run is None:
+            print(f"[ERROR] No run {key or 'latest'} in {ARTIFACT_DIR}")
+            return False
+        print(json.dumps(run, indent=2, default=str))
+        for role, names in run["files"].items():
+            for name in names if isinstance(names, list) else [names]:
+                print(f"{role:<12} {ARTIFACT_DIR / run['id'] / name}")
+        return True
+    runs = sorted(load_run_index().values(), key=lambda record: record["created"], reverse=True)
+    print(f"{len(runs)} runs in {ARTIFACT_DIR}")
+    print(f"{'Run':<37} {'Kind':<12} {'Status':<7} {'Model':<44} {'Tokens':>7} {'Seconds':>8} {'Images':>6}")
+    for run in runs[:limit]:
+        usage = run.get("usage") or {}
+        print(f"{run['id']:<37} {run['kind']:<12} {run['status']:<7} {run.get('model') or '-':<44} "
+              f"{usage.get('inputTokens', 0) + usage.get('outputTokens', 0):>7} {run.get('seconds', 0):>8.1f} {len(run['files'].get('images', [])):>6}")
+    return True
+####end section on the run artifact store
+
+def save_diagram_script(full_code, run): #code
+    """Save the generated Python script to the run's directory"""
+    script_path = save_run_file(run, "script", "generated_aws_diagram.py", full_code) #code
     
     print(f"\nDiagram script saved to: {script_path}")
     return script_path
 
-def run_diagram_script(script_path):
-    """Run the generated diagram script"""
+####section on rendering diagram scripts
+# Generated scripts are executed with an import guard: only diagrams (and a few stdlib
+# modules) can be imported and file/eval builtins are removed. The guard catches model
+# mistakes early; it is NOT a security boundary (diagrams itself exposes os, and object
+# introspection reaches everything else). By default scripts therefore run in a pool of
+# warm worker interpreters with CPU time, memory and file size limits, a timeout and no AWS
+# credentials in their environment. Each worker imports diagrams once and renders scripts
+# one at a time; it is replaced after a crash or timeout and after RENDER_WORKER_MAX_JOBS
+# scripts, so one script can only affect the few that follow it in the same worker.
+# Workers still run as the current user, so only render scripts you would run yourself.
+RENDER_ALLOWED_IMPORTS = ("diagrams", "math", "itertools", "string")
+RENDER_BLOCKED_BUILTINS = ("open", "exec", "eval", "compile", "input", "breakpoint", "exit", "quit")
+# 'subprocess' (default) renders in resource limited worker processes, 'off' in this process
+RENDER_ISOLATION = os.environ.get('AWS_DIAGRAM_RENDER_ISOLATION', 'subprocess')
+RENDER_TIMEOUT_SECONDS = float(os.environ.get('AWS_DIAGRAM_RENDER_TIMEOUT', '120'))
+RENDER_MAX_MEMORY_MB = int(os.environ.get('AWS_DIAGRAM_RENDER_MAX_MEMORY_MB', '2048'))
+RENDER_MAX_FILE_MB = 512
+RENDER_WORKERS = int(os.environ.get('AWS_DIAGRAM_RENDER_WORKERS', '0')) or os.cpu_count() or 1
+RENDER_WORKER_MAX_JOBS = int(os.environ.get('AWS_DIAGRAM_RENDER_WORKER_MAX_JOBS', '50'))
+# Environment variables never passed to the render child
+RENDER_SECRET_ENV = ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN", "AWS_SECURITY_TOKEN", "AWS_PROFILE",
+                     "AWS_WEB_IDENTITY_TOKEN_FILE", "AWS_ROLE_ARN", "AWS_CONTAINER_CREDENTIALS_RELATIVE_URI",
+                     "AWS_CONTAINER_CREDENTIALS_FULL_URI", "AWS_CONTAINER_AUTHORIZATION_TOKEN")
+# Run by each render worker: apply the limits, load this module and diagrams once, then
+# answer one JSON request per line with one JSON result per line
+RENDER_WORKER_CODE = """
+import contextlib, importlib.util, json, os, sys
+try:
+    import resource
+    memory, size = int(sys.argv[2]), int(sys.argv[3])
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (size, size))
+except (ImportError, ValueError, OSError):
+    resource = None # no resource limits on this platform
+spec = importlib.util.spec_from_file_location("aws_architecture_generator_render", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+module._preload_diagrams()
+results = sys.stdout
+sys.stdout = open(os.devnull, "w") # scripts and the renderer must not write into the result stream
+for line in sys.stdin:
+    job = json.loads(line)
+    if resource is not None:
+        # CPU time is counted over the life of the worker, so each job gets its own allowance
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = int(usage.ru_utime + usage.ru_stime) + job["cpu_seconds"]
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+    module.TELEMETRY_PATH = job["telemetry"]
     try:
-        print("\nGenerating diagram...")
-        # Try python3 first, fall back to python if needed
-        result = os.system(f"python3 {script_path}")
-        if result != 0:
-            print("Trying with 'python' command...")
-            os.system(f"python {script_path}")
-        print("\nDiagram generation complete!")
-        
-        # Look for generated PNG files
-        diagram_files = list(Path('.').glob('*.png'))
-        if diagram_files:
-            print(f"\nGenerated diagram file: {diagram_files[0]}")
-        
+        result = module.render_diagram_code(job["code"], job["script"], job["output_dir"], job["use_cache"])
+    except BaseException as e: # MemoryError and the like: report, then let the pool replace this worker
+        result = {"crashed": f"{type(e).__name__}: {e}"}
+    results.write(json.dumps(result, default=str) + "\\n")
+    results.flush()
+    if "crashed" in result:
+        break
+"""
+_render_lock = threading.Lock()
+
+def sandboxed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """__import__ replacement that only allows the diagrams package and a few stdlib modules.
+    A guard against mistakes, not a sandbox: see the section comment"""
+    if level != 0 or name.split(".")[0] not in RENDER_ALLOWED_IMPORTS:
+        raise ImportError(f"import of '{name}' is not allowed in diagram scripts")
+    return __import__(name, globals, locals, fromlist, level)
+
+def build_render_namespace(script_path):
+    """Fresh globals for executing one diagram script"""
+    safe_builtins = {name: value for name, value in vars(builtins).items() if name not in RENDER_BLOCKED_BUILTINS}
+    safe_builtins["__import__"] = sandboxed_import
+    return {"__name__": "__main__", "__file__": str(script_path), "__builtins__": safe_builtins}
+
+####section on caching rendered images
+# Identical scripts (retries, batch reruns, unchanged regenerations) reuse the images
+# from an earlier render instead of running Graphviz again.
+RENDER_CACHE_DIR = CACHE_DIR / "renders"
+render_cache_stats = {"hits": 0, "misses": 0}
+_render_cache_lock = threading.Lock()
+_graphviz_version = None
+
+def graphviz_version(refresh=False):
+    """Version line reported by 'dot -V', or 'missing' when Graphviz is not installed;
+    taken from the cached dependency check when the installation has not changed"""
+    global _graphviz_version
+    if _graphviz_version is None and not refresh:
+        cached = read_dependency_check()
+        if cached:
+            _graphviz_version = cached["graphviz"]
+    if _graphviz_version is None or refresh:
+        try:
+            completed = subprocess.run(["dot", "-V"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = (completed.stderr or completed.stdout).decode(errors="replace").strip()
+            _graphviz_version = output if completed.returncode == 0 else "missing"
+        except OSError:
+            _graphviz_version = "missing"
+    return _graphviz_version
+
+def normalized_script_hash(code):
+    """Hash of the script's AST without positions, so comments, blank lines and formatting
+    do not matter; show= is dropped because renders never open a viewer"""
+    tree = ast.parse(code)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            node.keywords = [argument for argument in node.keywords if argument.arg != "show"]
+    return hashlib.sha256(ast.dump(tree, include_attributes=False).encode()).hexdigest()
+
+def render_cache_key(kind, source_hash):
+    """Cache key of a render: source hash plus the diagrams and Graphviz versions"""
+    payload = json.dumps({"kind": kind, "source": source_hash, "diagrams": load_class_index()["version"],
+                          "graphviz": graphviz_version()}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def evict_render_cache():
+    """Drop least recently used render entries until the cache is under its size limit"""
+    entries = []
+    for entry in RENDER_CACHE_DIR.iterdir() if RENDER_CACHE_DIR.exists() else []:
+        try:
+            size = sum(path.stat().st_size for path in entry.iterdir())
+            entries.append(((entry / "meta.json").stat().st_mtime, size, entry))
+        except OSError:
+            continue
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    max_size = RENDER_CACHE_MAX_MB * 1024 * 1024
+    for _, size, entry in entries:
+        if total_size <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= size
+
+def read_cached_render(key, output_dir=None, targets=None):
+    """Copy the cached images of key to where the render would write them (or to targets,
+    a list of paths or a function of the stored name); returns their paths or None"""
+    entry = RENDER_CACHE_DIR / key
+    try:
+        meta = json.loads((entry / "meta.json").read_text())
+        images = []
+        for index, name in enumerate(meta["images"]):
+            if callable(targets):
+                target = Path(targets(name))
+            elif targets:
+                target = Path(targets[index])
+            else:
+                target = Path(output_dir) / Path(name).name if output_dir else Path(name)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(entry / f"{index}{Path(name).suffix}", target)
+            images.append(str(target))
+        # Touch the entry so eviction is least recently used
+        os.utime(entry / "meta.json")
+    except (OSError, ValueError, KeyError):
+        with _render_cache_lock:
+            render_cache_stats["misses"] += 1
+        return None
+    with _render_cache_lock:
+        render_cache_stats["hits"] += 1
+    return images
+
+def store_cached_render(key, produced):
+    """Atomically store rendered images; produced is a list of (file written, name the script asked for)"""
+    entry = RENDER_CACHE_DIR / key
+    tmp_entry = RENDER_CACHE_DIR / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        tmp_entry.mkdir(parents=True, exist_ok=True)
+        for index, (path, name) in enumerate(produced):
+            shutil.copyfile(path, tmp_entry / f"{index}{Path(name).suffix}")
+        (tmp_entry / "meta.json").write_text(json.dumps({"images": [name for _, name in produced]}))
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # Another worker stored the same render first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        with _render_cache_lock:
+            evict_render_cache()
+    except OSError as e:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        print(f"[WARN] Could not write render cache entry: {e}")
+
+def format_render_cache_stats(stats=None):
+    """'Render Cache: X hits, Y misses (Z% hit rate)'"""
+    stats = stats or render_cache_stats
+    total = stats["hits"] + stats["misses"]
+    rate = f" ({stats['hits'] / total:.0%} hit rate)" if total else ""
+    return f"Render Cache: {stats['hits']} hits, {stats['misses']} misses{rate}"
+####end section on caching rendered images
+
+@instrumented("render", render_stage_fields)
+def render_diagram_code(code, script_path="<diagram>", output_dir=None, use_cache=True):
+    """Execute a validated diagram script in process and return a structured result.
+
+    The result has 'ok', 'images' (paths of the files Graphviz produced), 'cache_hit',
+    'seconds' and, on failure, 'error' with type, message and script line.
+    Scripts failing the static check are rejected without being executed, and scripts
+    rendered before are served from the render cache."""
+    start = time.perf_counter()
+    result = {"script": str(script_path), "ok": False, "images": [], "cache_hit": False, "layout": []}
+    static_errors = analyze_diagram_script(code)["errors"]
+    if static_errors:
+        first = static_errors[0]
+        message = "; ".join(f"line {e['line']}: {e['message']}" for e in static_errors) if len(static_errors) > 1 else first["message"]
+        result["error"] = {"type": first["type"], "message": message, "line": first["line"]}
+        result["static_errors"] = static_errors
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        return result
+    if output_dir:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+    cache_key = render_cache_key(f"script:{render_settings()}", normalized_script_hash(code)) if use_cache else None
+    if cache_key:
+        images = read_cached_render(cache_key, output_dir)
+        if images is not None:
+            result.update({"ok": True, "images": images, "cache_hit": True, "seconds": round(time.perf_counter() - start, 3)})
+            return result
+    import diagrams
+    original_render = diagrams.Diagram.render
+    produced = [] # (file written, file name the script asked for)
+
+    def capturing_render(diagram):
+        # Never open an image viewer, write next to output_dir and record the produced files
+        diagram.show = False
+        requested = diagram.filename
+        if output_dir:
+            diagram.filename = str(Path(output_dir) / Path(diagram.filename).name)
+            diagram.dot.filename = diagram.filename
+        # Diagram.__exit__ deletes the DOT file after rendering, as diagrams' own render leaves it
+        diagram.dot.save()
+        formats = [RENDER_FORMAT] if RENDER_FORMAT else diagram.outformat if isinstance(diagram.outformat, list) else [diagram.outformat]
+        for fmt in formats:
+            layout = layout_dot(diagram.dot.source, diagram.filename, fmt)
+            result["layout"].extend(layout)
+            failed = next((part for part in layout if part["error"]), None)
+            if failed:
+                # Same exceptions as diagrams' own render, so repair and reporting treat them alike
+                import graphviz
+                if failed["error"]["type"] == "ExecutableNotFound":
+                    raise graphviz.ExecutableNotFound([failed["engine"]])
+                raise graphviz.CalledProcessError(1, [failed["engine"]], stderr=failed["error"]["message"])
+            for part in layout:
+                result["images"].append(part["image"])
+                produced.append((part["image"], requested + part["image"][len(diagram.filename):]))
+
+    try:
+        compiled = compile(code, str(script_path), "exec")
+        # Diagram.render is patched class wide, so in-process renders are serialized
+        with _render_lock:
+            diagrams.Diagram.render = capturing_render
+            try:
+                exec(compiled, build_render_namespace(script_path))
+            finally:
+                diagrams.Diagram.render = original_render
+        result["ok"] = bool(result["images"])
+        if not result["ok"]:
+            result["error"] = {"type": "NoDiagram", "message": "script did not render any Diagram", "line": None}
+        elif cache_key:
+            store_cached_render(cache_key, produced)
     except Exception as e:
-        print(f"Error generating diagram: {str(e)}")
+        line = getattr(e, "lineno", None) if isinstance(e, SyntaxError) else None
+        for frame in traceback.extract_tb(e.__traceback__):
+            if frame.filename == str(script_path):
+                line = frame.lineno
+        result["error"] = {"type": type(e).__name__, "message": str(e), "line": line}
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+class RenderWorker:
+    """One warm render worker process (see RENDER_WORKER_CODE)"""
+    def __init__(self):
+        env = {name: value for name, value in os.environ.items() if name not in RENDER_SECRET_ENV}
+        # The worker records its own render stages under this run's ID
+        env.update({"AWS_DIAGRAM_RUN_ID": RUN_ID, "AWS_DIAGRAM_CACHE_DIR": str(CACHE_DIR),
+                    "AWS_SHARED_CREDENTIALS_FILE": os.devnull, "AWS_CONFIG_FILE": os.devnull})
+        limits = [str(RENDER_MAX_MEMORY_MB * 1024 * 1024), str(RENDER_MAX_FILE_MB * 1024 * 1024)]
+        self.process = subprocess.Popen([sys.executable, "-c", RENDER_WORKER_CODE, str(Path(__file__).resolve())] + limits,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        text=True, env=env)
+        self.jobs = 0
+
+    def render(self, job, timeout):
+        """The worker's result for one job; TimeoutError or EOFError when it does not answer"""
+        self.jobs += 1
+        self.process.stdin.write(json.dumps(job) + "\n")
+        self.process.stdin.flush()
+        # The first job also waits for the worker to start and import diagrams
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not ready:
+            raise TimeoutError
+        line = self.process.stdout.readline()
+        if not line:
+            raise EOFError(f"render worker exited with status {self.process.wait()}")
+        return json.loads(line)
+
+    def close(self):
+        self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+# Idle workers, or None for a slot whose worker is not started yet; started lazily
+_render_workers = None
+_render_workers_lock = threading.Lock()
+
+def render_worker_slots():
+    global _render_workers
+    with _render_workers_lock:
+        if _render_workers is None:
+            _render_workers = queue.LifoQueue()
+            for _ in range(RENDER_WORKERS):
+                _render_workers.put(None)
+            atexit.register(close_render_workers)
+        return _render_workers
+
+def close_render_workers():
+    """Stop the idle render workers, e.g. at exit"""
+    slots = render_worker_slots()
+    for _ in range(slots.qsize()):
+        worker = slots.get()
+        if worker is not None:
+            worker.close()
+        slots.put(None)
+
+def render_isolated(code, script_path="<diagram>", output_dir=None, use_cache=True):
+    """render_diagram_code() in a warm worker process with resource limits, a timeout and no
+    AWS credentials (see RENDER_ISOLATION); returns the same result, or renders in this process
+    when isolation is off"""
+    if RENDER_ISOLATION.lower() == "off":
+        return render_diagram_code(code, script_path, output_dir, use_cache)
+    start = time.perf_counter()
+    result = {"script": str(script_path), "ok": False, "images": [], "cache_hit": False, "layout": []}
+    job = {"code": code, "script": str(script_path), "output_dir": str(output_dir) if output_dir else None,
+           "use_cache": use_cache, "telemetry": TELEMETRY_PATH, "cpu_seconds": int(RENDER_TIMEOUT_SECONDS) + 1}
+    slots = render_worker_slots()
+    worker, healthy = slots.get(), False
+    try:
+        if worker is None or worker.process.poll() is not None:
+            worker = RenderWorker()
+        rendered = worker.render(job, RENDER_TIMEOUT_SECONDS)
+        if "crashed" not in rendered:
+            healthy = True
+            return rendered
+        result["error"] = {"type": "RenderProcessError", "message": rendered["crashed"], "line": None}
+    except TimeoutError:
+        result["error"] = {"type": "RenderTimeout", "message": f"render took over {RENDER_TIMEOUT_SECONDS:g}s", "line": None}
+    except (OSError, EOFError, ValueError) as e:
+        result["error"] = {"type": "RenderProcessError", "message": str(e) or type(e).__name__, "line": None}
+    finally:
+        # A worker that failed, timed out or rendered its share is replaced on next use
+        if worker is not None and (not healthy or worker.jobs >= RENDER_WORKER_MAX_JOBS):
+            worker.close()
+            worker = None
+        slots.put(worker)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    record_stage("render", result["seconds"], ok=False, error=result["error"]["type"], isolated=True)
+    return result
+
+def render_diagram_script(script_path, output_dir=None):
+    """Render a diagram script file (isolated unless RENDER_ISOLATION is off)"""
+    return render_isolated(Path(script_path).read_text(), script_path, output_dir)
+
+def _preload_diagrams():
+    """Process pool and render worker initializer: pay the diagrams imports once per worker"""
+    import diagrams
+    import diagrams.aws
+    for module, _ in iter_diagrams_modules(Path(diagrams.__file__).parent):
+        if module.startswith("diagrams.aws."):
+            importlib.import_module(module)
+
+def render_scripts_parallel(script_paths, output_dir=None, max_workers=None):
+    """Render many diagram scripts in parallel worker processes; returns results in input order"""
+    if RENDER_ISOLATION.lower() != "off":
+        # Isolated renders already run in the worker processes; threads only wait on them
+        with ThreadPoolExecutor(max_workers=max_workers or RENDER_WORKERS) as pool:
+            return list(pool.map(render_diagram_script, script_paths, [output_dir] * len(script_paths)))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_preload_diagrams) as pool:
+        return list(pool.map(render_diagram_script, script_paths, [output_dir] * len(script_paths)))
+
+def run_diagram_script(script_path, output_dir=None):
+    """Run the generated diagram script, writing its images to output_dir (default: where it asks)"""
+    print("\nGenerating diagram...")
+    result = render_diagram_script(script_path, output_dir)
+    if result["ok"]:
+        print(f"\nDiagram generation complete! ({result['seconds']}s{', from render cache' if result['cache_hit'] else ''})")
+        print(format_render_cache_stats())
+        if result["layout"]:
+            print(format_layout_report(result["layout"]))
+        for image in result["images"]:
+            print(f"\nGenerated diagram file: {image}")
+    else:
+        error = result["error"]
+        where = f" (line {error['line']})" if error["line"] else ""
+        print(f"Error generating diagram: {error['type']}{where}: {error['message']}")
+    return result
+
+def run_render_command(paths, output_dir=None):
+    """Render command: render diagram scripts and DOT files with the current format and engine,
+    reporting layout time and size per image; returns True when all rendered"""
+    scripts = [path for path in paths if not path.endswith(".dot")]
+    results = render_scripts_parallel(scripts, output_dir) if len(scripts) > 1 else [render_diagram_script(path, output_dir) for path in scripts]
+    for path in paths:
+        if path.endswith(".dot"):
+            stem = Path(output_dir) / Path(path).stem if output_dir else Path(path).with_suffix("")
+            results.append(render_dot(Path(path).read_text(), stem, use_cache=False))
+            results[-1]["script"] = path
+    print(f"{'Image':<48} {'Engine':<6} {'Nodes':>5} {'Links':>5} {'Layout s':>9} {'KB':>8}")
+    for result in results:
+        for part in result.get("layout", []):
+            if not part["error"]:
+                print(f"{part['image']:<48} {part['engine']:<6} {part['nodes']:>5} {part['edges']:>5} {part['seconds']:>9.2f} {part['bytes'] / 1024:>8.0f}")
+        if result["cache_hit"]:
+            print(f"{result['script']}: from render cache ({', '.join(result['images'])})")
+        elif not result["ok"]:
+            error = result["error"]
+            where = f" (line {error['line']})" if error.get("line") else ""
+            print(f"[ERROR] {result['script']}: {error['type']}{where}: {error['message']}")
+    return all(result["ok"] for result in results)
+####end section on rendering diagram scripts
+
+DEPENDENCY_CHECK_PATH = CACHE_DIR / "dependencies.json"
+GRAPHVIZ_INSTALL_HINT = """  Please install graphviz:
+  - macOS: brew install graphviz
+  - Ubuntu/Debian: apt-get install graphviz
+  - Windows: Download from https://graphviz.org/download/"""
+
+def dependency_fingerprint():
+    """Installed boto3 and diagrams versions and the dot executable, found without importing
+    or running anything"""
+    fingerprint = {}
+    for package in ("boto3", "diagrams"):
+        fingerprint[package] = installed_version(package)
+    dot = shutil.which("dot")
+    try:
+        stat = os.stat(dot) if dot else None
+    except OSError:
+        stat = None
+    fingerprint["dot"] = [dot, stat.st_mtime, stat.st_size] if stat else None
+    return fingerprint
+
+def installed_version(package):
+    """Version of an installed distribution from its dist-info directory, or None"""
+    for entry in sys.path:
+        try:
+            names = os.listdir(entry or ".")
+        except OSError:
+            continue
+        for name in names:
+            if name.startswith(f"{package}-") and name.endswith((".dist-info", ".egg-info")):
+                return name[len(package) + 1:].rsplit(".", 1)[0]
+    return None
 
-def check_dependencies():
-    """Check if required dependencies are installed"""
+def read_dependency_check():
+    """The cached dependency check when it matches the installed versions, else None"""
+    try:
+        cached = json.loads(DEPENDENCY_CHECK_PATH.read_text())
+    except (OSError, ValueError):
+        return None
+    return cached if cached.get("fingerprint") == dependency_fingerprint() else None
+
+def check_dependencies(refresh=False):
+    """Check if required dependencies are installed; a passing check is cached until a version changes"""
+    cached = None if refresh else read_dependency_check()
+    if cached and cached["ok"]:
+        print(f"✓ boto3 {cached['fingerprint']['boto3']}, diagrams {cached['fingerprint']['diagrams']} and {cached['graphviz']} (cached check)")
+        return True
     try:
         # Check boto3
         import boto3
@@ -420,31 +3348,1516 @@ def check_dependencies():
         print("✗ diagrams is not installed. Please install it using: pip install diagrams")
         return False
     
+    ok = True
+    version = graphviz_version(refresh=True)
+    if version != "missing":
+        print("✓ graphviz is installed")
+    else:
+        print("✗ graphviz may not be installed or not in PATH")
+        print(GRAPHVIZ_INSTALL_HINT)
+        print("\nContinuing anyway, but diagram generation may fail...")
+        ok = False
     try:
-        # Check if graphviz is installed by running a simple command
-        import subprocess
-        result = subprocess.run(['dot', '-V'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode == 0:
-            print("✓ graphviz is installed")
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = DEPENDENCY_CHECK_PATH.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"fingerprint": dependency_fingerprint(), "ok": ok, "graphviz": version}))
+        os.replace(tmp_path, DEPENDENCY_CHECK_PATH)
+    except OSError:
+        pass
+    return ok
+
+
+####section on the generate -> validate -> render repair loop
+# Repair turns send only the failing script and a compact error, without reasoning,
+# instead of repeating the full generation prompt.
+REPAIR_PROMPT_TEMPLATE = """The following Python script using the diagrams library failed.
+Error: {error}
+Fix the script so that it runs. Keep the same architecture, use only valid diagrams imports, do not connect lists to lists or Clusters to anything, and return the complete corrected script in a single ```python code block.
+```python
+{code}
+```"""
+REPAIR_REASONING_CONFIG = {}
+# Failures the model cannot fix by changing the script
+NON_REPAIRABLE_ERRORS = ("ExecutableNotFound",)
+
+def format_render_error(error):
+    """One line error delta for a repair prompt, e.g. 'NameError (line 12): name 'x' is not defined'"""
+    where = f" (line {error['line']})" if error.get("line") else ""
+    return f"{error['type']}{where}: {error['message']}"
+
+def build_repair_prompt(code, error):
+    """Compact follow-up prompt: the offending script and its error only"""
+    return REPAIR_PROMPT_TEMPLATE.format(error=format_render_error(error), code=code)
+
+def generate_with_repair(description, max_attempts=3, bedrock_runtime=None, class_map=None,
+                         script_path="generated_diagram.py", output_dir=None, refresh_cache=False):
+    """Generate, validate and render a diagram, feeding render failures back to the model.
+
+    Stops at the first successful render or after max_attempts model calls. Returns a dict
+    with 'ok', 'code', 'render' (last render result) and 'attempts' (per-call kind,
+    seconds, tokens, cache hit and resulting error)."""
+    class_map = class_map if class_map is not None else build_aws_class_to_module_map()
+    attempts = []
+    budget = choose_reasoning_budget(description)
+    print(describe_reasoning_choice(budget))
+    prompt, reasoning_config, kind = build_prompt(description), budget["config"], "generate"
+    fixed_code, render = None, None
+    while len(attempts) < max_attempts:
+        start = time.perf_counter()
+        attempt = {"attempt": len(attempts) + 1, "kind": kind}
+        attempts.append(attempt)
+        # Trivial descriptions are answered by a local template; a failing template script still gets model repairs
+        response = template_response(description) if kind == "generate" else None
+        if response is not None:
+            attempt["cache_hit"], attempt["model"] = False, TEMPLATE_MODEL
         else:
-            print("✗ graphviz may not be installed or not in PATH")
-            print("  Please install graphviz:")
-            print("  - macOS: brew install graphviz")
-            print("  - Ubuntu/Debian: apt-get install graphviz")
-            print("  - Windows: Download from https://graphviz.org/download/")
-            return False
-    except Exception:
-        print("✗ Could not verify graphviz installation")
-        print("  Please ensure graphviz is installed:")
-        print("  - macOS: brew install graphviz")
-        print("  - Ubuntu/Debian: apt-get install graphviz")
-        print("  - Windows: Download from https://graphviz.org/download/")
-        print("\nContinuing anyway, but diagram generation may fail...")
-    
-    return True
+            try:
+                response, attempt["cache_hit"], attempt["model"] = routed_converse(prompt, description, bedrock_runtime, refresh_cache, reasoning_config)
+            except Exception as e: # includes botocore's ClientError: every model failed
+                seconds = round(time.perf_counter() - start, 3)
+                attempt.update({"model": None, "cache_hit": False, "input_tokens": 0, "output_tokens": 0,
+                                "model_seconds": seconds, "seconds": seconds, "error": f"{error_name(e)}: {e}"})
+                print(f"[ATTEMPT {attempt['attempt']} FAILED] No model could answer: {attempt['error']}")
+                render = {"ok": False, "images": [], "cache_hit": False, "layout": [],
+                          "error": {"type": error_name(e), "message": str(e), "line": None}}
+                break
+        usage = response.get("usage") or {}
+        attempt["input_tokens"] = usage.get("inputTokens", 0)
+        attempt["output_tokens"] = usage.get("outputTokens", 0)
+        reasoning, text = parse_converse_response(response)
+        attempt["model_seconds"] = round(time.perf_counter() - start, 3)
+        if text:
+            fixed_code, _ = validate_and_fix_imports(extract_python_code(text), class_map)
+            fixed_code, _ = check_diagram_script(fixed_code)
+            Path(script_path).write_text(fixed_code)
+            render = render_isolated(fixed_code, script_path, output_dir)
+        else:
+            render = {"ok": False, "images": [], "cache_hit": False, "layout": [],
+                      "error": {"type": "EmptyResponse", "message": "model returned no text", "line": None}}
+        attempt["seconds"] = round(time.perf_counter() - start, 3)
+        if render["ok"]:
+            break
+        attempt["error"] = format_render_error(render["error"])
+        print(f"[ATTEMPT {attempt['attempt']} FAILED] {attempt['error']}")
+        if render["error"]["type"] in NON_REPAIRABLE_ERRORS or fixed_code is None:
+            break
+        prompt, reasoning_config, kind = build_repair_prompt(fixed_code, render["error"]), REPAIR_REASONING_CONFIG, "repair"
+    ok = bool(render and render["ok"])
+    if attempts[0]["model"] not in (TEMPLATE_MODEL, None):
+        record_reasoning_outcome(budget, sum(attempt["model_seconds"] for attempt in attempts), ok, len(attempts) - 1,
+                                 attempts[0]["output_tokens"], attempts[0]["cache_hit"])
+    return {"ok": ok, "code": fixed_code, "render": render, "attempts": attempts, "reasoning_budget": budget["budget"]}
+
+def attempts_usage(attempts):
+    """Token usage of all model calls of a generate_with_repair() result, in converse usage form"""
+    return {"inputTokens": sum(attempt["input_tokens"] for attempt in attempts),
+            "outputTokens": sum(attempt["output_tokens"] for attempt in attempts)}
+
+def print_repair_summary(result):
+    """Per-attempt latency and token table for a generate_with_repair() result"""
+    print("\nAttempt  Kind      Seconds  Input  Output  Cached  Result")
+    for attempt in result["attempts"]:
+        outcome = attempt.get("error", "ok")
+        print(f"{attempt['attempt']:<8} {attempt['kind']:<9} {attempt['seconds']:<8} {attempt['input_tokens']:<6} "
+              f"{attempt['output_tokens']:<7} {'yes' if attempt['cache_hit'] else 'no':<7} {outcome}")
+    total_seconds = sum(attempt["seconds"] for attempt in result["attempts"])
+    total_tokens = sum(attempt["input_tokens"] + attempt["output_tokens"] for attempt in result["attempts"])
+    print(f"Total: {total_seconds:.2f}s, {total_tokens} tokens, {'rendered' if result['ok'] else 'not rendered'}")
+    print(format_render_cache_stats())
+    if len(model_stats) > 1:
+        print("\n" + format_model_stats())
+####end section on the generate -> validate -> render repair loop
+
+####section on incremental updates
+# Small description changes patch the previous script instead of regenerating it: the
+# model sees only the description diff and the current script and returns edit blocks,
+# so output tokens and latency follow the size of the change.
+UPDATE_PROMPT_TEMPLATE = """The description of an AWS architecture changed. Update its diagrams script to match.
+Description changes (- removed, + added):
+{diff}
+
+Current script:
+```python
+{code}
+```
+Return only the edits, with no explanation and not the whole script, as one or more blocks like this:
+<<<<<<< SEARCH
+exact lines copied from the current script
+=======
+replacement lines
+>>>>>>> REPLACE
+Add an import line for every new class, use only valid diagrams imports, and never connect Clusters or list to list."""
+UPDATE_REASONING_CONFIG = {}
+EDIT_BLOCK_PATTERN = re.compile(r"<<<<<<< SEARCH\n(.*?)\n?=======\n(.*?)\n?>>>>>>> REPLACE", re.DOTALL)
+
+def split_description(description):
+    """Description as a list of sentences, so a diff shows the sentences that changed"""
+    sentences = re.split(r"(?<=[.!?])\s+|\n+", description.strip())
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+def description_diff(old_description, new_description):
+    """Removed ('- ') and added ('+ ') sentences between two descriptions"""
+    old, new = split_description(old_description), split_description(new_description)
+    diff = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if tag != "equal":
+            diff.extend(f"- {sentence}" for sentence in old[i1:i2])
+            diff.extend(f"+ {sentence}" for sentence in new[j1:j2])
+    return diff
+
+@instrumented("prompt_build", lambda prompt: {"mode": "update", "estimated_tokens": estimate_tokens(prompt)})
+def build_update_prompt(code, diff):
+    """Prompt with only the description diff and the current script"""
+    return UPDATE_PROMPT_TEMPLATE.format(diff="\n".join(diff), code=code)
+
+@instrumented("extraction", lambda edits: {"format": "edits", "found": bool(edits)})
+def parse_edit_blocks(text):
+    """(search, replace) pairs from SEARCH/REPLACE blocks in a model response"""
+    return [(search, replace) for search, replace in EDIT_BLOCK_PATTERN.findall(text or "")]
+
+def apply_edit_blocks(code, edits):
+    """Apply (search, replace) edits in order. Searches are matched as whole lines ignoring
+    indentation and trailing spaces, and the replacement is re-indented to the matched lines;
+    a search inside a single line is replaced verbatim. Returns (code, failed) with the edits
+    that did not apply."""
+    failed = []
+    for search, replace in edits:
+        search = search.strip("\n")
+        lines = code.split("\n")
+        wanted = [line.strip() for line in search.split("\n")]
+        match = None
+        if any(wanted):
+            for start in range(len(lines) - len(wanted) + 1):
+                if all(lines[start + k].strip() == wanted[k] for k in range(len(wanted))):
+                    match = start
+                    break
+        if match is None:
+            if search.strip() and search in code:
+                code = code.replace(search, replace, 1)
+            else:
+                failed.append((search, replace))
+            continue
+        found_indent = lines[match][:len(lines[match]) - len(lines[match].lstrip())]
+        replace_lines = replace.split("\n") if replace else []
+        given_indent = next((line[:len(line) - len(line.lstrip())] for line in replace_lines if line.strip()), "")
+        reindented = [found_indent + line[len(given_indent):] if line.startswith(given_indent) and line.strip() else line
+                      for line in replace_lines]
+        code = "\n".join(lines[:match] + reindented + lines[match + len(wanted):])
+    return code, failed
 
+def changed_lines(old_code, new_code):
+    """1-based line numbers of new_code that were added or changed"""
+    changed = set()
+    matcher = difflib.SequenceMatcher(None, old_code.splitlines(), new_code.splitlines(), autojunk=False)
+    for tag, _, _, j1, j2 in matcher.get_opcodes():
+        if tag in ("replace", "insert"):
+            changed.update(range(j1 + 1, j2 + 1))
+    return changed
 
-def main():
+def imported_names_on_lines(code, lines):
+    """Names imported by diagrams import statements that touch the given lines"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module and node.module.startswith("diagrams"):
+            if lines.intersection(range(node.lineno, node.end_lineno + 1)):
+                names.update(alias.name for alias in node.names)
+    return names
+
+def update_diagram_script(code, old_description, new_description, bedrock_runtime=None, class_map=None, refresh_cache=False):
+    """Patch an existing diagrams script for a changed description.
+
+    Returns a dict with 'ok', 'code', 'diff', 'edits', 'failed' (edits that did not apply),
+    'changed_lines', 'static' (static check report), 'usage', 'cache_hit' and 'seconds', plus
+    'error' when no model could answer. No model call is made when the descriptions do not differ."""
+    start = time.perf_counter()
+    result = {"ok": False, "code": code, "diff": description_diff(old_description, new_description),
+              "edits": 0, "failed": [], "changed_lines": [], "static": None, "usage": {}, "cache_hit": False}
+    if not result["diff"]:
+        result["ok"], result["seconds"] = True, round(time.perf_counter() - start, 3)
+        return result
+    # Routed by the size of the change, so small edits can go to the fast model
+    try:
+        response, result["cache_hit"], result["model"] = routed_converse(
+            build_update_prompt(code, result["diff"]), "\n".join(result["diff"]), bedrock_runtime, refresh_cache,
+            UPDATE_REASONING_CONFIG, accept=lambda response: bool(EDIT_BLOCK_PATTERN.search(parse_converse_response(response)[1] or "")))
+    except Exception as e: # includes botocore's ClientError: every model failed
+        result["error"] = f"{error_name(e)}: {e}"
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        return result
+    result["usage"] = response.get("usage") or {}
+    _, text = parse_converse_response(response)
+    edits = parse_edit_blocks(text)
+    result["edits"] = len(edits)
+    patched, result["failed"] = apply_edit_blocks(code, edits)
+    if not edits or result["failed"]:
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        return result
+    # Only imports on patched lines are re-validated; untouched ones were checked when the script was generated
+    touched = changed_lines(code, patched)
+    only = imported_names_on_lines(patched, touched)
+    if only is None or only:
+        patched, _ = validate_and_fix_imports(patched, class_map if class_map is not None else build_aws_class_to_module_map(), only)
+    # Removing a node can break unchanged lines that still use it, so links and names are checked for the whole script
+    patched, result["static"] = check_diagram_script(patched)
+    result["code"], result["changed_lines"] = patched, sorted(changed_lines(code, patched))
+    result["ok"] = not result["static"]["errors"]
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+def find_saved_description(script_path):
+    """The description saved in the run of a script, or the aws_architecture_description_<n>.txt
+    saved with generated_diagram<n>.py by earlier versions, if any"""
+    script_path = Path(script_path)
+    run = find_run_of_path(script_path)
+    if run and run["files"].get("description"):
+        return script_path.resolve().parent / run["files"]["description"]
+    match = re.search(r"(\d+)$", script_path.stem)
+    if match:
+        candidate = script_path.with_name(f"aws_architecture_description_{match.group(1)}.txt")
+        if candidate.exists():
+            return candidate
+    return None
+
+def run_update(script_path, old_description_path=None, new_description_path=None, refresh_cache=False, render=False):
+    """Update command: patch a saved script for an edited description, regenerating in full if the patch fails"""
+    script_path = Path(script_path)
+    old_description_path = old_description_path or find_saved_description(script_path)
+    if not script_path.exists() or old_description_path is None:
+        print(f"Need an existing script and its saved description (looked for {script_path} and the description of its run).")
+        return
+    code = script_path.read_text()
+    old_description = Path(old_description_path).read_text()
+    new_description = Path(new_description_path).read_text() if new_description_path else get_user_description()
+    if not new_description:
+        print("No description provided. Exiting.")
+        return
+
+    print(f"\nUpdating {script_path} from the description changes...")
+    diff = description_diff(old_description, new_description)
+    for line in diff:
+        print(f"  {line}")
+    if not diff:
+        print("The description did not change; nothing to update.")
+        return
+    parent = find_run_of_path(script_path)
+    run = create_run(new_description, "update", parent=parent["id"] if parent else None, source_script=str(script_path))
+    result = update_diagram_script(code, old_description, new_description, refresh_cache=refresh_cache)
+    if result.get("error"):
+        print(f"[PATCH FAILED] No model could answer: {result['error']}")
+        finish_run(run, "error", error=result["error"])
+        return
+    log_token_usage(result["usage"], cached=result["cache_hit"])
+    if result["failed"] or not result["edits"]:
+        print(f"[PATCH FAILED] {len(result['failed'])} of {result['edits']} edits did not match the script; regenerating in full.")
+        call_info = {}
+        reasoning, text = invoke_bedrock_model(new_description, refresh_cache=refresh_cache, call_info=call_info)
+        if not text:
+            print("Failed to generate diagram code. Exiting.")
+            finish_run(run, "error", error="no model could answer")
+            return
+        save_run_file(run, "response", "response.json", call_info["response"])
+        fixed_code, _ = validate_and_fix_imports(extract_python_code(text), build_aws_class_to_module_map())
+        fixed_code, static = check_diagram_script(fixed_code)
+        result.update({"code": fixed_code, "static": static, "ok": not static["errors"]})
+    else:
+        print(f"Applied {result['edits']} edits, {len(result['changed_lines'])} lines changed ({result['seconds']:.2f} s)")
+
+    output_path = save_run_file(run, "script", "generated_diagram.py", result["code"])
+    print(f"\nYour architecture description saved to: {run_path(run, 'description.txt')}")
+    print(f"Script written to {output_path}")
+    metrics = {"model": result.get("model"), "edits": result["edits"], "failed_edits": len(result["failed"]),
+               "usage": result["usage"], "cache_hit": result["cache_hit"]}
+    if not result["ok"]:
+        print("The updated script still has errors that would fail when rendering. Edit it, or rerun the update.")
+        finish_run(run, "error", error="static check failed", **metrics)
+        return
+    if render:
+        rendered = run_diagram_script(output_path, run_path(run))
+        add_run_images(run, rendered["images"])
+        metrics["render_seconds"] = rendered["seconds"]
+        if not rendered["ok"]:
+            finish_run(run, "error", error=format_render_error(rendered["error"]), **metrics)
+            return
+    finish_run(run, **metrics)
+    print(f"Run {run['id']}: {run_path(run)}")
+####end section on incremental updates
+
+####section on batch generation
+def load_batch_descriptions(source):
+    """Read (item_id, description) pairs from a folder of .txt files or a JSONL file.
+
+    Returns (items, errors): errors are manifest records for unreadable files and JSONL lines
+    that are malformed or have no description, which are skipped instead of ending the batch"""
+    source = Path(source)
+    items, errors = [], []
+    if source.is_dir():
+        for path in sorted(source.glob("*.txt")):
+            try:
+                items.append((path.stem, path.read_text()))
+            except (OSError, UnicodeDecodeError) as e:
+                errors.append({"id": path.stem, "status": "error", "error": f"{path.name}: {type(e).__name__}: {e}"})
+    else:
+        with open(source) as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                item_id = f"{source.stem}_{line_number}"
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError("expected a JSON object")
+                    item_id = str(record.get("id") or item_id)
+                    if not isinstance(record.get("description"), str) or not record["description"].strip():
+                        raise ValueError("no 'description' string")
+                except ValueError as e:
+                    errors.append({"id": item_id, "status": "error", "error": f"line {line_number}: {e}"})
+                    continue
+                items.append((item_id, record["description"]))
+    return items, errors
+
+def generate_from_description(item_id, description, output_dir, bedrock_runtime, class_map, refresh_cache=False, repair_attempts=0):
+    """Generate, repair and save one diagram script; returns a manifest record"""
+    start = time.perf_counter()
+    record = {"id": item_id, "status": "ok"}
+    try:
+        if repair_attempts:
+            script_path = Path(output_dir) / f"generated_diagram_{item_id}.py"
+            result = generate_with_repair(description, repair_attempts, bedrock_runtime, class_map,
+                                          script_path, output_dir, refresh_cache)
+            record.update({"script": str(script_path), "attempts": result["attempts"], "render": result["render"]})
+            if not result["ok"]:
+                record["status"] = "error"
+                record["error"] = format_render_error(result["render"]["error"])
+            record["seconds"] = round(time.perf_counter() - start, 3)
+            return record
+        budget = choose_reasoning_budget(description)
+        record["reasoning_budget"] = budget["budget"]
+        model_start = time.perf_counter()
+        response = template_response(description)
+        if response is not None:
+            record["cache_hit"], record["model"] = False, TEMPLATE_MODEL
+        else:
+            response, record["cache_hit"], record["model"] = routed_converse(build_prompt(description), description, bedrock_runtime,
+                                                                             refresh_cache, budget["config"])
+        model_seconds = time.perf_counter() - model_start
+        record["usage"] = response.get("usage")
+        reasoning, text = parse_converse_response(response)
+        if not text:
+            raise ValueError("model returned no text")
+        fixed_code, modified = validate_and_fix_imports(extract_python_code(text), class_map)
+        fixed_code, static_report = check_diagram_script(fixed_code)
+        script_path = Path(output_dir) / f"generated_diagram_{item_id}.py"
+        script_path.write_text(fixed_code)
+        record["script"] = str(script_path)
+        record["imports_corrected"] = modified
+        record["links_fixed"] = len(static_report["fixed"])
+        if static_report["errors"]:
+            record["status"] = "error"
+            record["error"] = "static check: " + "; ".join(f"line {e['line']}: {e['message']}" for e in static_report["errors"])
+        if record["model"] != TEMPLATE_MODEL:
+            record_reasoning_outcome(budget, model_seconds, not static_report["errors"], 0,
+                                     (record["usage"] or {}).get("outputTokens", 0), record["cache_hit"])
+    except Exception as e: # includes botocore's ClientError
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+def run_batch(source, output_dir, manifest_path=None, max_workers=4, bedrock_runtime=None, refresh_cache=False, render=False, repair_attempts=0):
+    """Fan descriptions out to Bedrock with bounded concurrency and stream results to a JSONL manifest"""
+    items, input_errors = load_batch_descriptions(source)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = Path(manifest_path or output_dir / "manifest.jsonl")
+    if bedrock_runtime is None:
+        # boto3 clients are thread safe, so all workers share one connection pool, with room for hedged calls
+        hedged = len(route_models("")) > 1 and HEDGE_AFTER_SECONDS > 0
+        bedrock_runtime = get_bedrock_client(max_pool_connections=max_workers * (2 if hedged else 1))
+    class_map = build_aws_class_to_module_map()
+
+    print(f"Generating {len(items)} diagrams with {max_workers} workers...")
+    counts = {"ok": 0, "error": 0}
+    scripts = {}
+    with open(manifest_path, "a") as manifest, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for record in input_errors:
+            counts["error"] += 1
+            manifest.write(json.dumps(record) + "\n")
+            print(f"[ERROR] {record['id']}: {record['error']}")
+        manifest.flush()
+        futures = [pool.submit(generate_from_description, item_id, description, output_dir, bedrock_runtime, class_map, refresh_cache, repair_attempts)
+                   for item_id, description in items]
+        for future in as_completed(futures):
+            record = future.result()
+            counts[record["status"]] += 1
+            if record["status"] == "ok":
+                scripts[record["id"]] = record["script"]
+            manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+            print(f"[{record['status'].upper()}] {record['id']} ({record['seconds']}s)")
+
+        # With repair attempts every script has already been rendered inside the loop
+        if render and scripts and not repair_attempts:
+            print(f"\nRendering {len(scripts)} diagrams in parallel...")
+            results = render_scripts_parallel(list(scripts.values()), output_dir)
+            for item_id, result in zip(scripts, results):
+                manifest.write(json.dumps({"id": item_id, "status": "rendered" if result["ok"] else "render_error", "render": result}) + "\n")
+            manifest.flush()
+            counts["rendered"] = sum(result["ok"] for result in results)
+            # Worker processes keep their own counters, so the hit rate comes from the results
+            counts["render_cache_hits"] = sum(result["cache_hit"] for result in results)
+            render_seconds = sum(result["seconds"] for result in results)
+            layout = [part for result in results for part in result.get("layout", [])]
+    print(f"\nBatch complete: {counts['ok']} succeeded, {counts['error']} failed. Manifest: {manifest_path}")
+    if render and not repair_attempts:
+        print(f"Rendered: {counts.get('rendered', 0)} of {counts['ok']}")
+        if scripts:
+            hits = counts["render_cache_hits"]
+            print(f"Render time: {render_seconds:.2f}s total. " + format_render_cache_stats({"hits": hits, "misses": len(scripts) - hits}))
+            if layout:
+                print(f"Layout: {len(layout)} images, {sum(part['seconds'] for part in layout):.2f} s, "
+                      f"{sum(part['bytes'] for part in layout) / 1024 / 1024:.1f} MB (per image in the manifest)")
+    print(f"Response Cache: {response_cache_stats['hits']} hits, {response_cache_stats['misses']} misses")
+    if model_stats:
+        print("\n" + format_model_stats())
+    return counts
+####end section on batch generation
+
+####section on lightweight commands
+# Commands that never touch Bedrock or import boto3/diagrams, so they start quickly.
+def directory_usage(path, pattern="*"):
+    """(files, bytes) below path matching pattern"""
+    path = Path(path)
+    files = [entry for entry in path.rglob(pattern) if entry.is_file()] if path.exists() else []
+    return len(files), sum(entry.stat().st_size for entry in files)
+
+def run_cache_command(clear=None):
+    """Cache command: show what the local caches hold, optionally clearing responses, renders or all"""
+    targets = {"responses": RESPONSE_CACHE_DIR, "renders": RENDER_CACHE_DIR}
+    for name in (targets if clear == "all" else [clear] if clear else []):
+        shutil.rmtree(targets[name], ignore_errors=True)
+        print(f"Cleared {name} cache")
+    print(f"Cache directory: {CACHE_DIR}")
+    if CLASS_INDEX_PATH.exists():
+        index = json.loads(CLASS_INDEX_PATH.read_text())
+        names = sum(len(entry["classes"]) + len(entry["aliases"]) for entry in index["modules"].values())
+        print(f"  Class index:   diagrams {index['version']}, {names} names, {CLASS_INDEX_PATH.stat().st_size / 1024:.0f} KB")
+    else:
+        print("  Class index:   not built yet")
+    files, size = directory_usage(RESPONSE_CACHE_DIR, "*.json")
+    print(f"  Responses:     {files} entries, {size / 1024 / 1024:.1f} MB of {RESPONSE_CACHE_MAX_MB:.0f} MB")
+    entries = sum(1 for entry in RENDER_CACHE_DIR.iterdir() if entry.is_dir()) if RENDER_CACHE_DIR.exists() else 0
+    size = directory_usage(RENDER_CACHE_DIR)[1]
+    print(f"  Renders:       {entries} entries, {size / 1024 / 1024:.1f} MB of {RENDER_CACHE_MAX_MB:.0f} MB")
+    runs, size = len(load_run_index()), directory_usage(ARTIFACT_DIR)[1]
+    print(f"  Runs:          {runs} runs, {size / 1024 / 1024:.1f} MB in {ARTIFACT_DIR} (keeping {ARTIFACT_KEEP_RUNS or 'all'})")
+    telemetry = Path(TELEMETRY_PATH)
+    print(f"  Telemetry:     {telemetry.stat().st_size / 1024:.0f} KB in {telemetry}" if telemetry.exists() else "  Telemetry:     none recorded")
+    cached = read_dependency_check()
+    print(f"  Dependencies:  {'checked, ' + cached['graphviz'] if cached else 'not checked for the installed versions'}")
+
+# Directories never searched for diagram scripts
+VALIDATE_SKIP_DIRS = {"__pycache__", ".git", ".venv", "venv", "node_modules", ".tox", ".nox"}
+# Below this many files the pool's start-up costs more than it saves
+VALIDATE_POOL_MIN_FILES = 16
+_validate_class_map = None
+# Fingerprint of _validate_class_map, part of the repair cache key
+_validate_class_map_key = None
+
+def iter_script_paths(paths):
+    """Python files named directly or found recursively under directories, in sorted order"""
+    for path in map(Path, paths):
+        if not path.is_dir():
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d not in VALIDATE_SKIP_DIRS and not d.startswith("."))
+            for name in sorted(files):
+                if name.endswith(".py"):
+                    yield Path(root) / name
+
+def write_file_atomically(path, text):
+    """Replace path with text through a temporary file in the same directory, keeping its mode"""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        tmp_path.write_text(text)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def set_validate_class_map(class_map):
+    """Use class_map for repair_script_text(); always change it through here so cached repairs
+    made with another map are not reused"""
+    global _validate_class_map, _validate_class_map_key
+    _validate_class_map = class_map
+    _validate_class_map_key = hashlib.sha256(json.dumps(sorted(class_map.items())).encode()).hexdigest()
+    get_repair_tables()
+
+def init_validate_worker(class_map):
+    """Process pool initializer: keep one class map per worker and skip per-stage telemetry.
+    Only for pool workers; the main process uses set_validate_class_map()"""
+    global TELEMETRY_PATH
+    set_validate_class_map(class_map)
+    TELEMETRY_PATH = "off"
+
+# Report lines of the import repair and static check that describe a change to the script
+REPAIR_CHANGE_PREFIXES = ("[FIX]", "[UNKNOWN CLASS]", "[MERGE]", "[AUTO-FIX]", "[INVALID MODULE]")
+
+def repair_script_text(code):
+    """Quiet repair of one script's text with the validate class map: (fixed code, changes, errors)"""
+    if _validate_class_map is None:
+        set_validate_class_map(build_aws_class_to_module_map())
+    return cached_repair_script_text(code, _validate_class_map_key)
+
+@functools.lru_cache(maxsize=1024)
+def cached_repair_script_text(code, class_map_key):
+    """repair_script_text() memoized per script text and class map fingerprint, as script
+    libraries often hold many identical copies"""
+    output = []
+    fixed_code, _ = validate_and_fix_imports(code, _validate_class_map, log=output.append)
+    fixed_code, static_report = check_diagram_script(fixed_code, log=output.append)
+    changes = tuple(line for line in output if line.startswith(REPAIR_CHANGE_PREFIXES))
+    errors = tuple(f"line {error['line']}: {error['message']}" for error in static_report["errors"])
+    return fixed_code, changes, errors
+
+def repair_script_file(script_path, write=False, class_map=None, verbose=False):
+    """Repair one existing script with the import repair and static check of the generator.
+
+    Returns a report record: 'path', 'status' (clean, fixed, error, skipped or unreadable),
+    'changes' and 'errors' as messages, 'written' and 'seconds'."""
+    start = time.perf_counter()
+    record = {"path": str(script_path), "status": "clean", "changes": [], "errors": [], "written": False}
+    try:
+        code = Path(script_path).read_text()
+    except (OSError, UnicodeDecodeError) as e:
+        record.update({"status": "unreadable", "errors": [f"{type(e).__name__}: {e}"], "seconds": round(time.perf_counter() - start, 4)})
+        return record
+    if "diagrams" not in code:
+        record.update({"status": "skipped", "seconds": round(time.perf_counter() - start, 4)})
+        return record
+    if verbose:
+        output = []
+        def log(line):
+            print(line)
+            output.append(line)
+        fixed_code, _ = validate_and_fix_imports(code, class_map if class_map is not None else build_aws_class_to_module_map(), log=log)
+        fixed_code, static_report = check_diagram_script(fixed_code, log=log)
+        errors = [f"line {error['line']}: {error['message']}" for error in static_report["errors"]]
+        record["changes"] = [line for line in output if line.startswith(REPAIR_CHANGE_PREFIXES)]
+    else:
+        if class_map is not None and _validate_class_map is None:
+            set_validate_class_map(class_map)
+        fixed_code, changes, errors = repair_script_text(code)
+        record["changes"] = list(changes)
+    record["errors"] = list(errors)
+    if fixed_code != code:
+        record["status"] = "fixed"
+        if write:
+            write_file_atomically(script_path, fixed_code)
+            record["written"] = True
+    if record["errors"]:
+        record["status"] = "error"
+    record["seconds"] = round(time.perf_counter() - start, 4)
+    return record
+
+def run_validate_command(paths, write=False, workers=None, report_path=None):
+    """Validate command: repair imports and check links of existing scripts (files or directory
+    trees) without calling Bedrock. Returns True when no script is left with errors"""
+    start = time.perf_counter()
+    script_paths = list(iter_script_paths(paths))
+    class_map = build_aws_class_to_module_map()
+    if len(script_paths) == 1:
+        print(f"\n== {script_paths[0]}")
+        record = repair_script_file(script_paths[0], write, class_map, verbose=True)
+        if record["written"]:
+            print(f"Corrected script written to {record['path']}")
+        elif record["status"] == "fixed" or (record["status"] == "error" and record["changes"]):
+            print("Corrections available; rerun with --write to save them.")
+        return record["status"] not in ("error", "unreadable")
+
+    counts = {}
+    report = open(report_path, "w") if report_path else None
+    try:
+        if len(script_paths) < VALIDATE_POOL_MIN_FILES or workers == 1:
+            # In this process: keep its telemetry, unlike pool workers
+            set_validate_class_map(class_map)
+            results = (repair_script_file(path, write) for path in script_paths)
+            pool = None
+        else:
+            # Workers forked after the class map is loaded share it without rebuilding it
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=init_validate_worker, initargs=(class_map,))
+            chunksize = max(1, min(256, len(script_paths) // ((workers or os.cpu_count() or 1) * 8)))
+            results = pool.map(repair_script_file, script_paths, [write] * len(script_paths), chunksize=chunksize)
+        for record in results:
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+            if report:
+                report.write(json.dumps(record) + "\n")
+            if record["status"] in ("fixed", "error", "unreadable"):
+                detail = f"{len(record['changes'])} changes" + (", written" if record["written"] else "")
+                if record["errors"]:
+                    detail += f"; {record['errors'][0]}" + (f" (+{len(record['errors']) - 1} more)" if len(record["errors"]) > 1 else "")
+                print(f"[{record['status'].upper()}] {record['path']}: {detail}")
+        if pool:
+            pool.shutdown()
+    finally:
+        if report:
+            report.close()
+    seconds = time.perf_counter() - start
+    record_stage("bulk_validate", seconds, ok=True, files=len(script_paths), **counts)
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    print(f"\nChecked {len(script_paths)} files in {seconds:.2f}s ({len(script_paths) / max(seconds, 1e-9):.0f} files/s): {summary or 'none'}")
+    if counts.get("fixed") and not write:
+        print("Rerun with --write to save the corrections.")
+    if report_path:
+        print(f"Per-file report: {report_path}")
+    return not (counts.get("error") or counts.get("unreadable"))
+####end section on lightweight commands
+
+####section on benchmarking the local pipeline
+# Offline benchmark: recorded (or synthesized) converse responses are replayed through
+# a stub client and every local stage is timed and memory profiled, at scales from a
+# handful of nodes to thousands, with a share of deliberately broken imports.
+BENCHMARK_SCALES = (10, 100, 1000, 5000)
+BENCHMARK_BASELINE_PATH = CACHE_DIR / "benchmark_baseline.json"
+# A stage regresses when it is this much slower (or bigger) than the baseline and the
+# absolute difference is above the noise floor
+BENCHMARK_TOLERANCE = float(os.environ.get('AWS_DIAGRAM_BENCHMARK_TOLERANCE', '0.25'))
+BENCHMARK_MIN_SECONDS = 0.002
+BENCHMARK_MIN_KB = 256
+
+class ReplayBedrockClient:
+    """Stand-in for the bedrock-runtime client that returns recorded converse responses in turn.
+
+    To exercise model routing offline, delays maps model IDs to the seconds each call takes and
+    errors maps model IDs to an AWS error code (e.g. ThrottlingException) raised on every call."""
+    def __init__(self, responses, delays=None, errors=None):
+        self.responses = list(responses)
+        self.delays = delays or {}
+        self.errors = errors or {}
+        self.calls = 0
+        self.calls_by_model = {}
+        self._lock = threading.Lock()
+
+    def converse(self, **kwargs):
+        model_id = kwargs.get("modelId")
+        with self._lock:
+            response = self.responses[self.calls % len(self.responses)]
+            self.calls += 1
+            self.calls_by_model[model_id] = self.calls_by_model.get(model_id, 0) + 1
+        if self.delays.get(model_id):
+            time.sleep(self.delays[model_id])
+        if model_id in self.errors:
+            from botocore.exceptions import ClientError
+            raise ClientError({"Error": {"Code": self.errors[model_id], "Message": "simulated by ReplayBedrockClient"}}, "Converse")
+        return response
+
+def corrupt_class_name(name, module_path, kind, rng):
+    """A plausible model mistake for an import: ('moved' | 'case' | 'typo' | 'unknown') -> (module, name)"""
+    if kind == "moved":
+        return "diagrams.aws.general" if module_path != "diagrams.aws.general" else "diagrams.aws.compute", name
+    if kind == "case":
+        return module_path, name.lower() if name.lower() != name else name.upper()
+    if kind == "typo" and len(name) >= 6:
+        position = rng.randrange(1, len(name) - 1)
+        return module_path, name[:position] + name[position + 1:]
+    return module_path, f"Managed{name}Service"
+
+def synthesize_diagram_script(nodes, bad_import_ratio=0.2, seed=0):
+    """A diagrams script with the given number of AWS nodes in clusters of ten, a chain of
+    links plus fan-outs, and bad_import_ratio of its imported classes broken"""
+    rng = random.Random(seed)
+    index = load_class_index()
+    catalog = [(module_path, name) for module_path, entry in sorted(index["modules"].items())
+               if module_path.startswith("diagrams.aws.") for name in entry["classes"]]
+    chosen = [catalog[(i * 7919) % len(catalog)] for i in range(nodes)]
+    kinds = ("moved", "case", "typo", "unknown")
+    written = {} # (module, class) -> (module, class) as the script imports it
+    for module_path, name in dict.fromkeys(chosen):
+        written[(module_path, name)] = (corrupt_class_name(name, module_path, rng.choice(kinds), rng)
+                                        if rng.random() < bad_import_ratio else (module_path, name))
+    imports = {}
+    for module_path, name in written.values():
+        imports.setdefault(module_path, []).append(name)
+    lines = ["from diagrams import Diagram, Cluster"]
+    lines += [f"from {module_path} import {', '.join(dict.fromkeys(names))}" for module_path, names in imports.items()]
+    lines += ["", f'with Diagram("Benchmark {nodes} nodes", show=False, direction="LR"):']
+    for i, key in enumerate(chosen):
+        if i % 10 == 0:
+            lines.append(f'    with Cluster("Group {i // 10}"):')
+        lines.append(f'        n{i} = {written[key][1]}("Node {i}")')
+    for i in range(1, nodes):
+        lines.append(f"    n{i - 1} >> n{i}")
+        if i % 10 == 0 and i + 5 < nodes:
+            lines.append(f"    n{i} >> [n{i + 3}, n{i + 5}]")
+    return "\n".join(lines) + "\n"
+
+def synthesize_converse_response(code, reasoning="Benchmark fixture."):
+    """A converse response in the shape Bedrock returns, wrapping code in a python fence"""
+    text = f"Here is the diagram script.\n\n```python\n{code}```\n"
+    return {"output": {"message": {"role": "assistant", "content": [
+                {"reasoningContent": {"reasoningText": {"text": reasoning, "signature": ""}}}, {"text": text}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 0, "outputTokens": len(text) // 4, "totalTokens": len(text) // 4}}
+
+def load_benchmark_fixtures(fixtures_dir):
+    """Recorded converse responses: every *.json file in fixtures_dir (response cache entries qualify)"""
+    fixtures = []
+    for path in sorted(Path(fixtures_dir).glob("*.json")):
+        try:
+            response = json.loads(path.read_text())
+            parse_converse_response(response)
+        except (OSError, ValueError, KeyError, TypeError):
+            print(f"[SKIP] {path} is not a converse response")
+            continue
+        fixtures.append((path.stem[:12], response))
+    return fixtures
+
+def benchmark_stages(response, render=False):
+    """The pipeline stages for one recorded response, as (name, callable) pairs sharing state"""
+    state = {}
+    client = ReplayBedrockClient([response])
+    def reset_class_map():
+        global _class_index, _repair_tables
+        _class_index, _repair_tables = None, None
+        _name_indexes.clear()
+    def class_map_load():
+        reset_class_map()
+        state["class_map"] = build_aws_class_to_module_map()
+        get_name_index("aws")
+    def bedrock_replay():
+        state["response"] = converse_with_bedrock("benchmark", client)
+    def extraction():
+        _, text = parse_converse_response(state["response"])
+        state["code"] = extract_python_code(text)
+    def quiet(line):
+        pass
+    def import_repair():
+        state["fixed"], _ = validate_and_fix_imports(state["code"], state["class_map"], log=quiet)
+    def static_check():
+        state["checked"], _ = check_diagram_script(state["fixed"], log=quiet)
+    stages = [("class_map_load", class_map_load), ("bedrock_replay", bedrock_replay), ("extraction", extraction),
+              ("import_repair", import_repair), ("static_check", static_check)]
+    if render:
+        def render_stage():
+            with tempfile.TemporaryDirectory() as output_dir:
+                state["render"] = render_diagram_code(state["checked"], "<benchmark>", output_dir, use_cache=False)
+        stages.append(("render", render_stage))
+    return stages
+
+def run_benchmark_case(response, repeat=3, render=False):
+    """Best seconds over repeat runs (the least noisy estimate) and peak traced memory
+    (one extra run) per stage"""
+    timings = {}
+    for _ in range(repeat):
+        for name, stage in benchmark_stages(response, render):
+            start = time.perf_counter()
+            stage()
+            timings.setdefault(name, []).append(time.perf_counter() - start)
+    memory = {}
+    tracemalloc.start()
+    try:
+        for name, stage in benchmark_stages(response, render):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            stage()
+            memory[name] = (tracemalloc.get_traced_memory()[1] - before) / 1024
+    finally:
+        tracemalloc.stop()
+    return {name: {"seconds": round(min(values), 5), "peak_kb": round(memory[name], 1)}
+            for name, values in timings.items()}
+
+def synthesize_descriptions(count, seed=0):
+    """count descriptions mixing service synonyms, class names and filler: a third are short
+    chains a template can answer, the rest longer prose that goes to the model"""
+    rng = random.Random(seed)
+    index = load_class_index()
+    names = sorted({name for module_path, entry in index["modules"].items()
+                    if module_path.startswith("diagrams.aws.") for name in entry["classes"]})
+    phrases = sorted(SERVICE_SYNONYMS) + names
+    filler = ("a serverless backend for a mobile app", "which is monitored around the clock", "in two regions",
+              "behind a VPN for the finance team", "with nightly exports for reporting", "for a few thousand users")
+    descriptions = []
+    for i in range(count):
+        services = rng.sample(phrases, rng.randint(2, 4) if i % 3 == 0 else rng.randint(4, 9))
+        if i % 3 == 0:
+            descriptions.append(" -> ".join(services))
+        else:
+            parts = [f"{rng.choice(filler)} using {service}" if rng.random() < 0.4 else service for service in services]
+            descriptions.append(f"{rng.choice(filler).capitalize()}: " + ", then ".join(parts) + ".")
+    return descriptions
+
+def run_entity_case(count, seed=0):
+    """Benchmark case 'entities:<count>': trie build, extraction and templating over count
+    synthesized descriptions, with the throughput and templated share"""
+    global _service_trie
+    descriptions = synthesize_descriptions(count, seed)
+    timings = {}
+    start = time.perf_counter()
+    _service_trie = None
+    build_service_trie()
+    timings["trie_build"] = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [extract_services(description) for description in descriptions]
+    timings["extract"] = time.perf_counter() - start
+    start = time.perf_counter()
+    templated = sum(template_script(description) is not None for description in descriptions)
+    timings["template"] = time.perf_counter() - start
+    print(f"Extraction: {count / timings['extract']:.0f} descriptions/s, "
+          f"{sum(map(len, found)) / count:.1f} services on average, {templated / count:.0%} templated")
+    return {name: {"seconds": round(seconds, 5), "peak_kb": None} for name, seconds in timings.items()}
+
+def measure_startup(argv, repeat=5, as_module=True):
+    """Best wall time, in seconds, of running the CLI with argv in a fresh interpreter"""
+    script = Path(__file__).resolve()
+    command = [sys.executable, "-m", script.stem] if as_module else [sys.executable, str(script)]
+    env = {**os.environ, "AWS_DIAGRAM_TELEMETRY": "off",
+           "PYTHONPATH": os.pathsep.join(filter(None, [str(script.parent), os.environ.get("PYTHONPATH")]))}
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command + list(argv), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run_startup_cases(repeat=5):
+    """Startup benchmark: interpreter floor, --help, cache and validate, as 'startup:*' cases"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"])
+        best = time.perf_counter() - start if best is None else min(best, time.perf_counter() - start)
+    cases = {"startup:interpreter": best}
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = Path(tmp) / "sample.py"
+        sample.write_text(synthesize_diagram_script(10, 0))
+        cases["startup:script --help"] = measure_startup(["--help"], repeat, as_module=False)
+        cases["startup:-m --help"] = measure_startup(["--help"], repeat)
+        cases["startup:-m cache"] = measure_startup(["cache"], repeat)
+        cases["startup:-m validate"] = measure_startup(["validate", str(sample)], repeat)
+    return {case: {"process": {"seconds": round(seconds, 5), "peak_kb": None}} for case, seconds in cases.items()}
+
+def compare_benchmark(results, baseline, tolerance=None):
+    """Regressions of results against a baseline, as readable strings"""
+    tolerance = BENCHMARK_TOLERANCE if tolerance is None else tolerance
+    regressions = []
+    for case, stages in results.items():
+        for stage, values in stages.items():
+            base = baseline.get(case, {}).get(stage)
+            if not base:
+                continue
+            slower = values["seconds"] - base["seconds"]
+            if slower > BENCHMARK_MIN_SECONDS and values["seconds"] > base["seconds"] * (1 + tolerance):
+                regressions.append(f"{case} {stage}: {values['seconds'] * 1000:.1f} ms vs {base['seconds'] * 1000:.1f} ms baseline")
+            if values["peak_kb"] is None or base["peak_kb"] is None:
+                continue
+            bigger = values["peak_kb"] - base["peak_kb"]
+            if bigger > BENCHMARK_MIN_KB and values["peak_kb"] > base["peak_kb"] * (1 + tolerance):
+                regressions.append(f"{case} {stage}: {values['peak_kb']:.0f} KB vs {base['peak_kb']:.0f} KB baseline")
+    return regressions
+
+def run_benchmark(fixtures_dir=None, scales=BENCHMARK_SCALES, bad_import_ratio=0.2, repeat=3,
+                  baseline_path=None, save_baseline=False, render=False, startup=False, descriptions=2000):
+    """Benchmark command: returns True when no stage regressed against the baseline"""
+    global TELEMETRY_PATH
+    # Benchmark runs would skew the recorded production telemetry
+    TELEMETRY_PATH = "off"
+    cases = [(f"fixture:{name}", response) for name, response in load_benchmark_fixtures(fixtures_dir)] if fixtures_dir else []
+    cases += [(f"synthetic:{nodes}", synthesize_converse_response(synthesize_diagram_script(nodes, bad_import_ratio)))
+              for nodes in scales]
+    results = {}
+    print(f"{'Case':<22} {'Stage':<15} {'Best ms':>10} {'Peak KB':>10}")
+    for case, response in cases:
+        results[case] = run_benchmark_case(response, repeat, render)
+    if startup:
+        results.update(run_startup_cases(max(repeat, 5)))
+    if descriptions:
+        results[f"entities:{descriptions}"] = run_entity_case(descriptions)
+    for case, stages in results.items():
+        for stage, values in stages.items():
+            peak = "-" if values["peak_kb"] is None else f"{values['peak_kb']:.0f}"
+            print(f"{case:<22} {stage:<15} {values['seconds'] * 1000:>10.2f} {peak:>10}")
+
+    baseline_path = Path(baseline_path or BENCHMARK_BASELINE_PATH)
+    if save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(results, indent=2))
+        print(f"\nBaseline saved to {baseline_path}")
+        return True
+    if not baseline_path.exists():
+        print(f"\nNo baseline at {baseline_path}; run with --save-baseline to create one.")
+        return True
+    regressions = compare_benchmark(results, json.loads(baseline_path.read_text()))
+    for regression in regressions:
+        print(f"[REGRESSION] {regression}")
+    print(f"\n{len(regressions)} regressions against {baseline_path} (tolerance {BENCHMARK_TOLERANCE:.0%})")
+    return not regressions
+####end section on benchmarking the local pipeline
+
+####section on the HTTP service
+# One warm process (class map, repair tables and Bedrock client loaded once) serves
+# generate, repair and render requests over HTTP/1.1 with asyncio. Identical requests
+# in flight share a single job, and a bounded job queue answers 503 when it is full
+# instead of letting latency grow without limit.
+SERVE_HOST = os.environ.get('AWS_DIAGRAM_SERVE_HOST', '127.0.0.1')
+SERVE_PORT = int(os.environ.get('AWS_DIAGRAM_SERVE_PORT', '8080'))
+SERVE_WORKERS = int(os.environ.get('AWS_DIAGRAM_SERVE_WORKERS', '4'))
+SERVE_QUEUE_SIZE = int(os.environ.get('AWS_DIAGRAM_SERVE_QUEUE', '32'))
+SERVE_OUTPUT_DIR = Path(os.environ.get('AWS_DIAGRAM_SERVE_OUTPUT_DIR', 'served_diagrams'))
+SERVE_MAX_BODY_BYTES = 1024 * 1024
+# Upper bound for repair_attempts of /generate; larger values are clamped
+SERVE_MAX_REPAIR_ATTEMPTS = int(os.environ.get('AWS_DIAGRAM_SERVE_MAX_REPAIR_ATTEMPTS', '5'))
+# Latencies kept per endpoint for the /health percentiles
+SERVE_LATENCY_WINDOW = 1000
+# Browser origins allowed to POST (comma separated). Browsers send Origin on cross-site
+# requests, so any other page trying to drive the local service is refused.
+SERVE_ALLOWED_ORIGINS = {origin.strip() for origin in os.environ.get('AWS_DIAGRAM_SERVE_ORIGINS', '').split(",") if origin.strip()}
+
+def service_request_key(endpoint, payload):
+    """Content address of a request: identical endpoint and JSON body share one job"""
+    return hashlib.sha256(json.dumps({"endpoint": endpoint, "payload": payload}, sort_keys=True).encode()).hexdigest()
+
+def service_repair(code):
+    """Import repair and static check for the service: (fixed code, changes, errors)"""
+    fixed_code, changes, errors = repair_script_text(code)
+    return fixed_code, list(changes), list(errors)
+
+def service_render_result(render, root=None, prefix="/files"):
+    """JSON body of a render result, with images as URLs of the files under root"""
+    root = (root or SERVE_OUTPUT_DIR).resolve()
+    return {"ok": render["ok"], "cache_hit": render["cache_hit"], "seconds": render.get("seconds"), "error": render.get("error"),
+            "images": [f"{prefix}/{Path(image).resolve().relative_to(root).as_posix()}" for image in render["images"]],
+            "layout": [{key: part[key] for key in ("engine", "nodes", "edges", "seconds", "bytes")}
+                       for part in render.get("layout", []) if not part["error"]]}
+
+def serve_generate(payload, key):
+    """POST /generate: {"description", "render" (default true), "refresh", "repair_attempts"}
+    -> the repaired script, its changes and errors and, when rendered, its images; every
+    job is a run of the artifact store"""
+    description = payload.get("description")
+    if not isinstance(description, str) or not description.strip():
+        raise ValueError("'description' must be a non-empty string")
+    refresh = bool(payload.get("refresh"))
+    repair_attempts = payload.get("repair_attempts") or 0
+    if not isinstance(repair_attempts, int) or isinstance(repair_attempts, bool) or repair_attempts < 0:
+        raise ValueError("'repair_attempts' must be a non-negative integer")
+    repair_attempts = min(repair_attempts, SERVE_MAX_REPAIR_ATTEMPTS)
+    run = create_run(description, "service")
+    script_path = run_path(run, "generated_diagram.py")
+    if repair_attempts > 1:
+        result = generate_with_repair(description, repair_attempts, class_map=_validate_class_map,
+                                      script_path=script_path, output_dir=run_path(run), refresh_cache=refresh)
+        if result["code"] is not None:
+            run["files"]["script"] = script_path.name
+        add_run_images(run, result["render"]["images"] if result["render"] else [])
+        finish_run(run, "ok" if result["ok"] else "error", attempts=result["attempts"], reasoning_budget=result["reasoning_budget"],
+                   model=result["attempts"][-1]["model"], usage=attempts_usage(result["attempts"]),
+                   error=None if result["ok"] else result["attempts"][-1].get("error"))
+        body = {"ok": result["ok"], "run": run["id"], "code": result["code"], "reasoning_budget": result["reasoning_budget"],
+                "attempts": result["attempts"], "render": service_render_result(result["render"], ARTIFACT_DIR, "/runs") if result["render"] else None}
+        return (200 if result["ok"] else 422), body
+    start = time.perf_counter()
+    budget = choose_reasoning_budget(description)
+    call_info = {}
+    _, text = invoke_bedrock_model(description, refresh_cache=refresh, reasoning_config=budget["config"], call_info=call_info)
+    model_seconds = time.perf_counter() - start
+    if not text:
+        finish_run(run, "error", error="no model could answer")
+        return 502, {"ok": False, "run": run["id"], "error": "no model could answer"}
+    save_run_file(run, "response", "response.json", call_info["response"])
+    fixed_code, changes, errors = service_repair(extract_python_code(text))
+    save_run_file(run, "script", script_path.name, fixed_code)
+    if call_info["model"] != TEMPLATE_MODEL:
+        record_reasoning_outcome(budget, model_seconds, not errors, 0, call_info["usage"].get("outputTokens", 0), call_info["cache_hit"])
+    metrics = {"model": call_info["model"], "cache_hit": call_info["cache_hit"], "usage": call_info["usage"],
+               "reasoning_budget": budget["budget"], "model_seconds": round(model_seconds, 3)}
+    body = {"ok": not errors, "run": run["id"], "code": fixed_code, **metrics, "changes": changes, "errors": errors}
+    if payload.get("render", True) and not errors:
+        render = render_isolated(fixed_code, script_path, run_path(run))
+        add_run_images(run, render["images"])
+        body["render"] = service_render_result(render, ARTIFACT_DIR, "/runs")
+        body["ok"] = body["render"]["ok"]
+    finish_run(run, "ok" if body["ok"] else "error", **metrics, changes=len(changes), errors=errors)
+    return (200 if body["ok"] else 422), body
+
+def serve_repair(payload, key):
+    """POST /repair: {"code"} -> the script with imports repaired and links checked, without Bedrock"""
+    code = payload.get("code")
+    if not isinstance(code, str) or not code.strip():
+        raise ValueError("'code' must be a non-empty string")
+    fixed_code, changes, errors = service_repair(code)
+    return 200, {"ok": not errors, "code": fixed_code, "modified": fixed_code != code, "changes": changes, "errors": errors}
+
+def serve_render(payload, key):
+    """POST /render: {"graph"} (a JSON graph IR), {"dot"} (Graphviz source) or {"run"} (the ID of
+    a /generate run) -> its images, in a directory named by the request's content hash.
+
+    Python from clients is never executed: graphs and DOT go to Graphviz without any code,
+    and only scripts this service generated itself are rendered, in the isolated child"""
+    if "code" in payload:
+        raise ValueError("rendering client-supplied Python is not supported; send 'graph' (JSON graph IR), "
+                         "'dot' (Graphviz source) or 'run' (the ID of a /generate run)")
+    run_dir = SERVE_OUTPUT_DIR / f"render_{key[:16]}"
+    if isinstance(payload.get("graph"), dict):
+        graph, report = compile_graph_ir(payload["graph"], _validate_class_map)
+        run_dir.mkdir(parents=True, exist_ok=True)
+        render = render_dot(emit_dot(graph), run_dir / "diagram")
+        return (200 if render["ok"] else 422), {**service_render_result(render), "fixes": report["fixes"], "graph_errors": report["errors"]}
+    if isinstance(payload.get("dot"), str):
+        run_dir.mkdir(parents=True, exist_ok=True)
+        render = render_dot(payload["dot"], run_dir / "diagram")
+        return (200 if render["ok"] else 422), service_render_result(render)
+    if isinstance(payload.get("run"), str):
+        run = find_run(payload["run"]) if re.fullmatch(r"[0-9A-Za-z-]+", payload["run"]) else None
+        if not run or run.get("kind") != "service" or "script" not in run.get("files", {}):
+            raise ValueError(f"no script generated by this service in run '{payload['run']}'")
+        script_path = run_path(run, run["files"]["script"])
+        render = render_isolated(script_path.read_text(), script_path, run_dir)
+        return (200 if render["ok"] else 422), service_render_result(render)
+    raise ValueError("expected 'graph' (JSON graph IR), 'dot' (Graphviz source) or 'run' (the ID of a /generate run)")
+
+async def read_http_message(reader):
+    """Start line, lower-cased headers and body of one HTTP/1.1 message; None at end of stream"""
+    import asyncio
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise
+        return None
+    start_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+    headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > SERVE_MAX_BODY_BYTES:
+        raise ValueError(f"request body over {SERVE_MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return start_line, headers, body
+
+def format_http_response(status, body, headers=None, keep_alive=True):
+    """Bytes of an HTTP/1.1 response; dict bodies are sent as JSON"""
+    headers = dict(headers or {})
+    if isinstance(body, dict):
+        body = json.dumps(body, default=str).encode()
+        headers.setdefault("Content-Type", "application/json")
+    headers.update({"Content-Length": str(len(body)), "Connection": "keep-alive" if keep_alive else "close"})
+    head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n" + "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    return head.encode("latin-1") + b"\r\n" + body
+
+def serve_file(relative_path, root=None):
+    """GET /files/<path>: an image written by the service (or GET /runs/<run>/<file> with root ARTIFACT_DIR)"""
+    output_dir = (root or SERVE_OUTPUT_DIR).resolve()
+    path = (output_dir / unquote(relative_path)).resolve()
+    if not path.is_relative_to(output_dir) or not path.is_file():
+        return 404, {"error": f"no file {relative_path}"}, {}
+    return 200, path.read_bytes(), {"Content-Type": mimetypes.guess_type(path.name)[0] or "application/octet-stream"}
+
+class DiagramService:
+    """asyncio front end of the generator: coalesces identical in-flight requests, queues
+    jobs in a bounded queue and runs them on a pool of worker threads"""
+    handlers = {"generate": serve_generate, "repair": serve_repair, "render": serve_render}
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = workers or SERVE_WORKERS
+        self.queue_size = queue_size or SERVE_QUEUE_SIZE
+        self.inflight = {} # request key -> future shared by identical requests
+        self.stats = {"requests": 0, "jobs": 0, "coalesced": 0, "rejected": 0, "errors": 0}
+        self.latencies = {}
+
+    async def start(self):
+        import asyncio
+        self.queue = asyncio.Queue(self.queue_size)
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="diagram-service")
+        self.tasks = [asyncio.create_task(self.run_jobs()) for _ in range(self.workers)]
+
+    async def run_jobs(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            endpoint, payload, key, future = await self.queue.get()
+            try:
+                future.set_result(await loop.run_in_executor(self.executor, self.handlers[endpoint], payload, key))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, endpoint, payload):
+        """(future, coalesced): the job of an identical request in flight, or a newly queued one.
+        Raises asyncio.QueueFull when the queue is full"""
+        import asyncio
+        key = service_request_key(endpoint, payload)
+        if key in self.inflight:
+            return self.inflight[key], True
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((endpoint, payload, key, future))
+        self.inflight[key] = future
+        future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        self.stats["jobs"] += 1
+        return future, False
+
+    async def dispatch(self, method, target, body, headers=None):
+        """(status, body, headers) of one request"""
+        import asyncio
+        start = time.perf_counter()
+        headers = headers or {}
+        path = target.split("?", 1)[0]
+        endpoint = path.strip("/")
+        if method == "GET" and endpoint == "health":
+            return 200, self.health(), {}
+        if method == "GET" and path.startswith("/files/"):
+            return serve_file(path[len("/files/"):])
+        if method == "GET" and path.startswith("/runs/"):
+            run_id, _, name = path[len("/runs/"):].partition("/")
+            if name:
+                return serve_file(f"{run_id}/{name}", ARTIFACT_DIR)
+            run = find_run(run_id)
+            return (200, run, {}) if run else (404, {"error": f"no run {run_id}"}, {})
+        if endpoint not in self.handlers:
+            return 404, {"error": f"no endpoint {path}"}, {}
+        if method != "POST":
+            return 405, {"error": f"use POST for {path}"}, {"Allow": "POST"}
+        # A JSON content type cannot be sent cross-site without a CORS preflight, which this
+        # service never grants, so web pages cannot forge requests as simple text/plain POSTs
+        if headers.get("content-type", "").split(";")[0].strip().lower() != "application/json":
+            return 415, {"error": "send the request body as Content-Type: application/json"}, {}
+        if headers.get("origin") and headers["origin"] not in SERVE_ALLOWED_ORIGINS:
+            return 403, {"error": f"origin {headers['origin']} is not allowed (see AWS_DIAGRAM_SERVE_ORIGINS)"}, {}
+        try:
+            payload = json.loads(body or b"{}")
+            if not isinstance(payload, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            return 400, {"error": f"invalid JSON body: {e}"}, {}
+        self.stats["requests"] += 1
+        try:
+            future, coalesced = self.submit(endpoint, payload)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            record_stage("serve_request", time.perf_counter() - start, ok=False, endpoint=endpoint, status=503, coalesced=False)
+            return 503, {"error": f"queue full ({self.queue_size} jobs waiting), retry later"}, {"Retry-After": "1"}
+        self.stats["coalesced"] += coalesced
+        try:
+            # Shielded: a waiter going away must not cancel the job shared with other waiters
+            status, result = await asyncio.shield(future)
+        except ValueError as e:
+            status, result = 400, {"error": str(e)}
+        except Exception as e:
+            status, result = 500, {"error": f"{error_name(e)}: {e}"}
+        seconds = time.perf_counter() - start
+        self.stats["errors"] += status >= 500
+        latencies = self.latencies.setdefault(endpoint, [])
+        latencies.append(seconds)
+        del latencies[:-SERVE_LATENCY_WINDOW]
+        record_stage("serve_request", seconds, ok=status < 400, endpoint=endpoint, status=status, coalesced=coalesced)
+        return status, result, {"X-Coalesced": "true" if coalesced else "false"}
+
+    def health(self):
+        """Queue depth, counters, recent latency percentiles and per model calls"""
+        return {"status": "ok", "workers": self.workers, "queued": self.queue.qsize(), "queue_size": self.queue_size,
+                "in_flight": len(self.inflight), **self.stats,
+                "latency": {endpoint: {"p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "count": len(values)}
+                            for endpoint, values in self.latencies.items()},
+                "response_cache": response_cache_stats, "models": summarize_models()}
+
+    async def handle_connection(self, reader, writer):
+        """Serve the requests of one (keep-alive) connection"""
+        import asyncio
+        try:
+            while True:
+                try:
+                    message = await read_http_message(reader)
+                except ValueError as e:
+                    writer.write(format_http_response(400, {"error": str(e)}, keep_alive=False))
+                    break
+                if message is None:
+                    break
+                start_line, headers, body = message
+                method, target, *_ = start_line.split(" ") + [""]
+                status, result, extra = await self.dispatch(method, target, body, headers)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(format_http_response(status, result, extra, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+def replay_bedrock_client(fixtures_dir=None, delay=0.0):
+    """Stand-in Bedrock client for local runs: recorded responses from fixtures_dir, or
+    synthesized scripts, answered by every configured model after delay seconds"""
+    if fixtures_dir:
+        responses = [response for _, response in load_benchmark_fixtures(fixtures_dir)]
+        if not responses:
+            raise ValueError(f"no converse responses in {fixtures_dir}")
+    else:
+        responses = [synthesize_converse_response(synthesize_diagram_script(nodes, 0.2, seed)) for seed, nodes in enumerate((8, 12, 20))]
+    models = AWS_BEDROCK_MODELS + ([AWS_BEDROCK_FAST_MODEL] if AWS_BEDROCK_FAST_MODEL else [])
+    return ReplayBedrockClient(responses, delays={model_id: delay for model_id in models})
+
+def run_service(host=None, port=None, workers=None, queue_size=None, replay=None, replay_delay=0.0):
+    """Serve command: load the class map, repair tables and Bedrock client once, then serve
+    until interrupted. replay (a fixtures directory, or '' for synthesized responses) uses
+    a stand-in Bedrock client"""
+    import asyncio
+    global RESPONSE_CACHE_DIR, TELEMETRY_PATH
+    host, port = host or SERVE_HOST, port or SERVE_PORT
+    if replay is not None:
+        # Stand-in answers must not reach the real response cache, telemetry or reasoning history
+        RESPONSE_CACHE_DIR = Path(tempfile.mkdtemp(prefix="aws_diagram_service_"))
+        TELEMETRY_PATH = "off"
+        set_bedrock_client(replay_bedrock_client(replay, replay_delay))
+        print(f"[REPLAY] Stand-in Bedrock client ({replay or 'synthesized responses'}, {replay_delay}s per call)")
+    else:
+        get_bedrock_client()
+    set_validate_class_map(build_aws_class_to_module_map())
+    get_repair_tables()
+    service = DiagramService(workers, queue_size)
+
+    async def serve():
+        await service.start()
+        server = await asyncio.start_server(service.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} ({service.workers} workers, queue of {service.queue_size}); "
+              f"POST /generate, /repair, /render; GET /health, /runs/..., /files/...")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\nService stopped.")
+
+def load_test_payloads(endpoint, distinct):
+    """distinct request bodies for an endpoint: varied descriptions, synthesized scripts with
+    broken imports for repair, or synthesized JSON graphs for render"""
+    if endpoint == "generate":
+        services = ("an S3 bucket", "a DynamoDB table", "an SQS queue", "an RDS database", "an ElastiCache cluster")
+        return [{"description": f"Service {i}: users call an API Gateway that triggers Lambda functions, "
+                                f"which read {services[i % len(services)]} and publish events to SNS."} for i in range(distinct)]
+    if endpoint == "render":
+        classes = ("APIGateway", "Lambda", "Dynamodb", "S3", "SQS", "SNS", "RDS", "ElastiCache", "EC2", "ELB")
+        return [{"graph": {"title": f"Load test {seed}", "direction": "LR",
+                           "nodes": [{"id": f"n{i}", "class": classes[(seed + i) % len(classes)]} for i in range(20)],
+                           "edges": [{"from": f"n{i}", "to": f"n{i + 1}"} for i in range(19)]}}
+                for seed in range(distinct)]
+    return [{"code": synthesize_diagram_script(20, 0.2, seed).replace("Benchmark 20 nodes", f"Load test {seed}")}
+            for seed in range(distinct)]
+
+async def load_test_requests(url, endpoint, payloads, requests, concurrency):
+    """Send requests bodies (cycling through payloads) over concurrency keep-alive connections;
+    returns (status, seconds, coalesced) per request"""
+    import asyncio
+    address = urlsplit(url)
+    pending = iter(range(requests))
+    results = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection(address.hostname, address.port or 80)
+        try:
+            for i in pending:
+                body = json.dumps(payloads[i % len(payloads)]).encode()
+                start = time.perf_counter()
+                writer.write(f"POST /{endpoint} HTTP/1.1\r\nHost: {address.netloc}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+                start_line, headers, _ = await read_http_message(reader)
+                results.append((int(start_line.split(" ")[1]), time.perf_counter() - start, headers.get("x-coalesced") == "true"))
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(client() for _ in range(min(concurrency, requests))))
+    return results
+
+def fetch_service_health(url):
+    """The /health document of a running service, or None"""
+    from urllib.request import urlopen
+    try:
+        with urlopen(url.rstrip("/") + "/health", timeout=10) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+def run_load_test(url, endpoint="generate", requests=200, concurrency=20, distinct=10, render=False, refresh=False):
+    """Loadtest command: throughput, latency percentiles, status counts and coalesced share
+    against a running service; returns True when every request got an answer other than 5xx
+    (503 rejections by the bounded queue excepted)"""
+    import asyncio
+    payloads = load_test_payloads(endpoint, max(1, distinct))
+    if endpoint == "generate":
+        payloads = [{**payload, "render": render, "refresh": refresh} for payload in payloads]
+    before = fetch_service_health(url)
+    if before is None:
+        print(f"[ERROR] No service answering at {url}; start one with the serve command")
+        return False
+    print(f"Load test: {requests} {endpoint} requests, {concurrency} concurrent, {len(payloads)} distinct, against {url}")
+    start = time.perf_counter()
+    results = asyncio.run(load_test_requests(url, endpoint, payloads, requests, concurrency))
+    elapsed = time.perf_counter() - start
+    after = fetch_service_health(url) or before
+    statuses = {}
+    for status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    answered = [seconds * 1000 for status, seconds, _ in results if status != 503]
+    coalesced = sum(1 for _, _, was_coalesced in results if was_coalesced)
+    print(f"Completed {len(results)} requests in {elapsed:.2f} s: {len(results) / elapsed:.1f} requests/s")
+    print("Status: " + ", ".join(f"{status} x{count}" for status, count in sorted(statuses.items())))
+    print(f"Coalesced: {coalesced} ({coalesced / len(results):.0%}), server jobs: {after['jobs'] - before['jobs']}")
+    if answered:
+        print(f"Latency ms: p50 {percentile(answered, 0.5):.1f}, p95 {percentile(answered, 0.95):.1f}, "
+              f"p99 {percentile(answered, 0.99):.1f}, max {max(answered):.1f}")
+    model_calls = sum(values["calls"] for values in after["models"].values()) - sum(values["calls"] for values in before["models"].values())
+    print(f"Model calls: {model_calls}, response cache: {after['response_cache']['hits']} hits, {after['response_cache']['misses']} misses")
+    return all(status < 500 or status == 503 for status in statuses)
+####end section on the HTTP service
+
+def parse_args(argv=None):
+    """Parse command line arguments; no subcommand runs the interactive generator"""
+    parser = argparse.ArgumentParser(description="Generate AWS architecture diagrams from natural language descriptions.")
+    parser.add_argument("--refresh-cache", action="store_true", help="ignore cached Bedrock responses and regenerate")
+    parser.add_argument("--stream", action="store_true", help="stream reasoning and code with converse_stream and validate imports as soon as the code block closes")
+    parser.add_argument("--full-prompt", action="store_true", help="send the full import whitelist and all examples instead of the slim, description-specific prompt")
+    parser.add_argument("--repair-attempts", type=int, default=0, metavar="N",
+                        help="render automatically and send failures back to the model, up to N model calls in total")
+    parser.add_argument("--ir", action="store_true", help="ask the model for a JSON graph and compile it to DOT locally instead of running generated Python")
+    parser.add_argument("--format", choices=RENDER_FORMATS, help="image format of every render (default: as the script asks, usually png); svgz is compressed SVG")
+    parser.add_argument("--engine", choices=("auto",) + tuple(LAYOUT_ENGINES),
+                        help=f"Graphviz layout engine (default: auto, the faster 'fast' layout from {LARGE_DIAGRAM_NODES} nodes on)")
+    subparsers = parser.add_subparsers(dest="command")
+
+    update_parser = subparsers.add_parser("update", help="patch a previously generated script for an edited description")
+    update_parser.add_argument("script", help="existing generated_diagram*.py script")
+    update_parser.add_argument("--old-description", help="description the script was generated from (default: the matching aws_architecture_description_*.txt)")
+    update_parser.add_argument("--description", help="file with the new description (default: prompt for it)")
+    update_parser.add_argument("--render", action="store_true", help="render the updated script")
+
+    summarize_parser = subparsers.add_parser("summarize", help="report p50/p95 latency and tokens per stage over recorded runs")
+    summarize_parser.add_argument("--telemetry", help="telemetry JSONL file (default: AWS_DIAGRAM_TELEMETRY or <cache>/telemetry.jsonl)")
+    summarize_parser.add_argument("--since-days", type=float, help="only include runs from the last N days")
+    summarize_parser.add_argument("--prometheus", metavar="PATH", help="also write Prometheus text format metrics to PATH ('-' for stdout)")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="time the local pipeline stages offline on recorded or synthesized responses")
+    benchmark_parser.add_argument("--fixtures", help="directory of recorded converse responses (*.json, e.g. the response cache)")
+    benchmark_parser.add_argument("--scales", default=",".join(map(str, BENCHMARK_SCALES)), help="comma separated node counts of synthesized scripts")
+    benchmark_parser.add_argument("--bad-imports", type=float, default=0.2, help="share of synthesized imports that are broken")
+    benchmark_parser.add_argument("--repeat", type=int, default=3, help="runs per case; the best time is reported")
+    benchmark_parser.add_argument("--baseline", help=f"baseline JSON (default: {BENCHMARK_BASELINE_PATH})")
+    benchmark_parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    benchmark_parser.add_argument("--render", action="store_true", help="also time rendering (needs Graphviz)")
+    benchmark_parser.add_argument("--startup", action="store_true", help="also time CLI startup of --help, cache and validate in fresh interpreters")
+    benchmark_parser.add_argument("--descriptions", type=int, default=2000, help="synthesized descriptions for the service extraction throughput case (0 skips it)")
+
+    cache_parser = subparsers.add_parser("cache", help="show the local caches (class index, responses, renders, telemetry)")
+    cache_parser.add_argument("--clear", choices=("responses", "renders", "all"), help="delete cached responses, renders or both")
+
+    validate_parser = subparsers.add_parser("validate", help="repair imports and check links of existing scripts, without Bedrock")
+    validate_parser.add_argument("scripts", nargs="+", help="diagram scripts, or directories searched recursively for *.py")
+    validate_parser.add_argument("--write", action="store_true", help="save the corrected scripts (atomically)")
+    validate_parser.add_argument("--workers", type=int, help="worker processes for many files (default: CPU count)")
+    validate_parser.add_argument("--report", help="write a JSONL per-file change report to this path")
+
+    render_parser = subparsers.add_parser("render", help="render diagram scripts or DOT files and report layout time and size per image")
+    render_parser.add_argument("paths", nargs="+", help="diagram scripts (.py) or DOT files (.dot)")
+    render_parser.add_argument("--output-dir", help="where images are written (default: next to each DOT file, or where the script asks)")
+
+    runs_parser = subparsers.add_parser("runs", help="list, show or garbage collect the stored runs")
+    runs_parser.add_argument("action", nargs="?", choices=("list", "show", "gc"), default="list")
+    runs_parser.add_argument("run", nargs="?", help="run ID, unique ID prefix or 'latest' (for show)")
+    runs_parser.add_argument("--limit", type=int, default=20, help="runs listed")
+    runs_parser.add_argument("--keep", type=int, help=f"newest runs kept by gc (default: AWS_DIAGRAM_KEEP_RUNS or {ARTIFACT_KEEP_RUNS}, 0 keeps all)")
+    runs_parser.add_argument("--max-age-days", type=float, help="runs older than this are removed by gc (default: AWS_DIAGRAM_RUNS_MAX_AGE_DAYS, 0 keeps all)")
+
+    serve_parser = subparsers.add_parser("serve", help="serve generate, repair and render over HTTP from one warm process")
+    serve_parser.add_argument("--host", help=f"address to listen on (default: AWS_DIAGRAM_SERVE_HOST or {SERVE_HOST})")
+    serve_parser.add_argument("--port", type=int, help=f"port to listen on (default: AWS_DIAGRAM_SERVE_PORT or {SERVE_PORT})")
+    serve_parser.add_argument("--workers", type=int, help=f"jobs run concurrently (default: {SERVE_WORKERS})")
+    serve_parser.add_argument("--queue", type=int, help=f"jobs that may wait before requests get 503 (default: {SERVE_QUEUE_SIZE})")
+    serve_parser.add_argument("--replay", nargs="?", const="", metavar="FIXTURES",
+                              help="use a stand-in Bedrock client answering with recorded responses from FIXTURES (or synthesized ones)")
+    serve_parser.add_argument("--replay-delay", type=float, default=0.0, help="seconds each stand-in model call takes")
+
+    loadtest_parser = subparsers.add_parser("loadtest", help="measure throughput and latency percentiles of a running service")
+    loadtest_parser.add_argument("--url", default=f"http://{SERVE_HOST}:{SERVE_PORT}", help="service address")
+    loadtest_parser.add_argument("--endpoint", choices=tuple(DiagramService.handlers), default="generate", help="endpoint to load")
+    loadtest_parser.add_argument("--requests", type=int, default=200, help="requests in total")
+    loadtest_parser.add_argument("--concurrency", type=int, default=20, help="concurrent connections")
+    loadtest_parser.add_argument("--distinct", type=int, default=10, help="distinct request bodies; the rest repeat them")
+    loadtest_parser.add_argument("--render", action="store_true", help="have generate requests render their diagrams")
+    loadtest_parser.add_argument("--refresh", action="store_true", help="have generate requests bypass the response cache")
+
+    batch_parser = subparsers.add_parser("batch", help="generate diagrams for a folder of .txt files or a JSONL file of descriptions")
+    batch_parser.add_argument("source", help="directory of .txt descriptions or JSONL file with 'id' and 'description' fields")
+    batch_parser.add_argument("--output-dir", default="generated_diagrams", help="where generated scripts are written")
+    batch_parser.add_argument("--manifest", help="JSONL manifest path (default: <output-dir>/manifest.jsonl)")
+    batch_parser.add_argument("--workers", type=int, default=4, help="maximum concurrent Bedrock requests")
+    batch_parser.add_argument("--render", action="store_true", help="render the generated scripts in parallel worker processes")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global PROMPT_MODE, RENDER_FORMAT, RENDER_ENGINE
+    args = parse_args(argv)
+    if args.full_prompt:
+        PROMPT_MODE = "full"
+    # Also exported, so render worker processes see the same settings
+    if args.format:
+        RENDER_FORMAT = os.environ['AWS_DIAGRAM_FORMAT'] = args.format
+    if args.engine:
+        RENDER_ENGINE = os.environ['AWS_DIAGRAM_ENGINE'] = args.engine
+    if args.command == "cache":
+        run_cache_command(args.clear)
+        return
+    if args.command == "validate":
+        if not run_validate_command(args.scripts, args.write, args.workers, args.report):
+            sys.exit(1)
+        return
+    if args.command == "benchmark":
+        scales = [int(scale) for scale in args.scales.split(",") if scale.strip()]
+        if not run_benchmark(args.fixtures, scales, args.bad_imports, args.repeat, args.baseline, args.save_baseline,
+                             args.render, args.startup, args.descriptions):
+            sys.exit(1)
+        return
+    if args.command == "summarize":
+        run_summarize(args.telemetry, args.since_days, args.prometheus)
+        return
+    if args.command == "render":
+        if not run_render_command(args.paths, args.output_dir):
+            sys.exit(1)
+        return
+    if args.command == "runs":
+        if not run_runs_command(args.action, args.run, args.limit, args.keep, args.max_age_days):
+            sys.exit(1)
+        return
+    if args.command == "loadtest":
+        if not run_load_test(args.url, args.endpoint, args.requests, args.concurrency, args.distinct, args.render, args.refresh):
+            sys.exit(1)
+        return
+    # Every command from here on calls Bedrock
+    if not AWS_BEDROCK_MODELS:
+        print(f"[ERROR] {MODEL_LIST_ERROR}")
+        sys.exit(2)
+    if TELEMETRY_PATH.lower() != "off":
+        print(f"Run ID: {RUN_ID} (telemetry: {TELEMETRY_PATH})")
+    if args.command == "serve":
+        run_service(args.host, args.port, args.workers, args.queue, args.replay, args.replay_delay)
+        return
+    if args.command == "update":
+        run_update(args.script, args.old_description, args.description, refresh_cache=args.refresh_cache, render=args.render)
+        return
+    if args.command == "batch":
+        run_batch(args.source, args.output_dir, args.manifest, args.workers, refresh_cache=args.refresh_cache,
+                  render=args.render, repair_attempts=args.repair_attempts)
+        return
+    run_interactive(refresh_cache=args.refresh_cache, stream=args.stream, repair_attempts=args.repair_attempts, ir=args.ir)
+
+def run_interactive(refresh_cache=False, stream=False, repair_attempts=0, ir=False):
     try:
         print("\n=== AWS Architecture Diagram Generator ===\n")
         # Check dependencies
@@ -458,41 +4871,132 @@ def main():
             print("No description provided. Exiting.")
             return
         
-        # Step 2: Call Bedrock model
-        reasoning, text = invoke_bedrock_model(description)
-        print("\n<thinking>")
-        print(reasoning)
-        print(text)
+        # Every output of this run goes to its own directory in the artifact store
+        run = create_run(description, "interactive")
+        print(f"\nRun {run['id']}: artifacts in {run_path(run)}")
+        print(f"Your architecture description saved to: {run_path(run, 'description.txt')}")
+
+        # Steps 2-7 in one self-healing loop: generate, repair imports, render, retry on failure
+        if repair_attempts:
+            output_path = run_path(run, "generated_diagram.py")
+            print("\nSending request to Amazon Bedrock (Claude 3.7)...")
+            result = generate_with_repair(description, repair_attempts, script_path=output_path, output_dir=run_path(run),
+                                          refresh_cache=refresh_cache)
+            if result["code"] is not None:
+                run["files"]["script"] = output_path.name
+            print(f"\nScript written to {output_path}")
+            print_repair_summary(result)
+            if result["ok"] and result["render"]["layout"]:
+                print(format_layout_report(result["render"]["layout"]))
+            for image in result["render"]["images"] if result["ok"] else []:
+                print(f"\nGenerated diagram file: {image}")
+            add_run_images(run, result["render"]["images"] if result["ok"] else [])
+            finish_run(run, "ok" if result["ok"] else "error", attempts=result["attempts"], reasoning_budget=result["reasoning_budget"],
+                       model=result["attempts"][-1]["model"], usage=attempts_usage(result["attempts"]),
+                       error=None if result["ok"] else result["attempts"][-1].get("error"))
+            print("\nDone!")
+            return
+
+        # Step 2: Call Bedrock model with a thinking budget sized to the description
+        early_fix = None
+        budget = choose_reasoning_budget(description)
+        print(describe_reasoning_choice(budget))
+        call_info = {}
+        model_start = time.perf_counter()
+        if ir:
+            reasoning, text = invoke_bedrock_model(description, refresh_cache=refresh_cache, prompt=build_ir_prompt(description),
+                                                   accept=lambda response: find_graph_ir(parse_converse_response(response)[1]) is not None,
+                                                   reasoning_config=budget["config"], call_info=call_info)
+            print("\n<thinking>")
+            print(reasoning)
+            print(text)
+            graph_ir = extract_graph_ir(text)
+            if graph_ir is not None:
+                save_run_file(run, "response", "response.json", call_info["response"])
+                try:
+                    _, report, rendered = write_graph_ir_outputs(graph_ir, run_path(run, "generated_diagram"))
+                except ValueError as e:
+                    print(f"[IR ERROR] {e}")
+                    graph_ir = None
+            if graph_ir is not None:
+                run["files"].update({"ir": "generated_diagram.json", "dot": "generated_diagram.dot", "script": "generated_diagram.py"})
+                add_run_images(run, rendered["images"] if rendered else [])
+                finish_run(run, "ok" if rendered and rendered["ok"] else "error", model=call_info["model"], usage=call_info["usage"],
+                           cache_hit=call_info["cache_hit"], reasoning_budget=budget["budget"], graph=report)
+                print("\nDone!")
+                return
+            if text:
+                # The IR prompt asks for JSON only, so its answer has no usable script: ask again for Python
+                print("No usable JSON graph in the response; asking the model for a Python script instead.")
+                reasoning, text = invoke_bedrock_model(description, refresh_cache=refresh_cache, reasoning_config=budget["config"],
+                                                       call_info=call_info)
+                print("\n<thinking>")
+                print(reasoning)
+                print(text)
+        elif stream:
+            # Validate imports in the background as soon as the code block closes
+            # Its report lines are buffered and printed after the stream, not between tokens
+            validation_pool = ThreadPoolExecutor(max_workers=1)
+            early_class_map = build_aws_class_to_module_map()
+            def validate_early(code):
+                nonlocal early_fix
+                report = []
+                early_fix = (code, validation_pool.submit(validate_and_fix_imports, code, early_class_map, log=report.append), report)
+            reasoning, text, _ = invoke_bedrock_model_streaming(description, refresh_cache=refresh_cache, on_code_block=validate_early,
+                                                                reasoning_config=budget["config"], call_info=call_info)
+            validation_pool.shutdown(wait=False)
+        else:
+            reasoning, text = invoke_bedrock_model(description, refresh_cache=refresh_cache, reasoning_config=budget["config"],
+                                                   call_info=call_info)
+            print("\n<thinking>")
+            print(reasoning)
+            print(text)
+        model_seconds = time.perf_counter() - model_start
         if not text:
             print("Failed to generate diagram code. Exiting.")
+            finish_run(run, "error", error="no model could answer")
             return
         
         # Step 3: Extract Python code
         python_code = extract_python_code(text)
         
-        # Step 4: Save the user's description         
-        description_path = f"aws_architecture_description_{tracking_number}.txt"
-        with open(description_path, "w") as f:
-            f.write(description)
-        print(f"\nYour architecture description saved to: {description_path}")
+        # Step 4: Save the raw model response with the description
+        save_run_file(run, "response", "response.json", call_info["response"])
         
         #step 4.5: check generated code for diagram import errors
-        print("Building diagrams class map (this may take a few seconds)...")
+        print("Loading diagrams class map...")
         class_map = build_aws_class_to_module_map()
-        code = generate_diagram_script()
         print("\nValidating and auto-correcting...")
-        fixed_code, modified = validate_and_fix_imports(python_code, class_map)
+        if early_fix and early_fix[0] == python_code:
+            fixed_code, modified = early_fix[1].result()
+            for line in early_fix[2]:
+                print(line)
+        else:
+            fixed_code, modified = validate_and_fix_imports(python_code, class_map)
+        print("\nChecking links and names...")
+        fixed_code, static_report = check_diagram_script(fixed_code)
+        modified = modified or bool(static_report["fixed"])
+        if call_info["model"] != TEMPLATE_MODEL:
+            record_reasoning_outcome(budget, model_seconds, not static_report["errors"], 0,
+                                     call_info["usage"].get("outputTokens", 0), call_info["cache_hit"])
 
-        output_path = Path(f"generated_diagram{tracking_number}.py")
-        output_path.write_text(fixed_code)
+        output_path = save_run_file(run, "script", "generated_diagram.py", fixed_code)
         print(f"\nScript written to {output_path}")
         if modified:
-            print("One or more imports were corrected.")
+            print("One or more imports or links were corrected.")
         else:
             print("All imports and usages were valid.")
+        metrics = {"model": call_info["model"], "usage": call_info["usage"], "cache_hit": call_info["cache_hit"],
+                   "reasoning_budget": budget["budget"], "model_seconds": round(model_seconds, 3),
+                   "imports_corrected": modified, "links_fixed": len(static_report["fixed"])}
+        if static_report["errors"]:
+            print("The script still has errors that would fail when rendering. Edit it, or rerun with --repair-attempts to let the model fix them.")
+            finish_run(run, "error", error="static check failed", **metrics)
+            print("\nDone!")
+            return
         
         # Step 5: Save the script
-        #script_path = save_diagram_script(python_code)
+        #script_path = save_diagram_script(python_code, run)
         
         # Step 6: Ask if user wants to run the script
         #run_script = input("\nWould you like to run the script to generate the diagram? (y/n): ").lower()
@@ -502,7 +5006,12 @@ def main():
         # Step 7: Ask if user wants to run the corrected script
         run2_script = input("\nWould you like to run the corrected script to generate the diagram? (y/n): ").lower()
         if run2_script == 'y':
-            run_diagram_script(output_path)
+            rendered = run_diagram_script(output_path, run_path(run))
+            add_run_images(run, rendered["images"])
+            metrics["render_seconds"] = rendered["seconds"]
+            if not rendered["ok"]:
+                metrics["error"] = format_render_error(rendered["error"])
+        finish_run(run, "error" if metrics.get("error") else "ok", **metrics)
             
         print("\nDone!")
         
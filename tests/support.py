@@ -0,0 +1,20 @@
+"""Shared test setup: a throwaway cache, runs and output directory, no telemetry, then the generator module"""
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+WORK_DIR = Path(tempfile.mkdtemp(prefix="aws_diagram_tests_"))
+os.environ["AWS_DIAGRAM_CACHE_DIR"] = str(WORK_DIR / "cache")
+os.environ["AWS_DIAGRAM_RUNS_DIR"] = str(WORK_DIR / "runs")
+os.environ["AWS_DIAGRAM_SERVE_OUTPUT_DIR"] = str(WORK_DIR / "served")
+os.environ["AWS_DIAGRAM_TELEMETRY"] = "off"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aws_architecture_generator as generator
+
+HAS_DIAGRAMS = importlib.util.find_spec("diagrams") is not None
+HAS_BOTOCORE = importlib.util.find_spec("botocore") is not None
+HAS_GRAPHVIZ = shutil.which("dot") is not None
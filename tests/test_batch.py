@@ -0,0 +1,62 @@
+import contextlib
+import io
+import json
+import unittest
+
+from support import HAS_BOTOCORE, HAS_DIAGRAMS, WORK_DIR, generator
+
+DESCRIPTIONS = ["A VPC with public and private subnets, an ALB in front of EC2 web servers and an RDS database",
+                "Three tiers in two regions: CloudFront, ECS services in a private subnet and DynamoDB global tables"]
+
+@unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package for the class index")
+class BatchTest(unittest.TestCase):
+    """run_batch() end to end against a stand-in Bedrock client, without AWS"""
+    def setUp(self):
+        self.template_mode = generator.TEMPLATE_MODE
+        generator.TEMPLATE_MODE = "off"
+        generator.model_stats.clear()
+        script = generator.synthesize_diagram_script(6, 0)
+        self.client = generator.ReplayBedrockClient([generator.synthesize_converse_response(script)])
+        generator.set_bedrock_client(self.client)
+        self.output_dir = WORK_DIR / f"batch_{self.id().rsplit('.', 1)[-1]}"
+
+    def tearDown(self):
+        generator.set_bedrock_client(None)
+        generator.TEMPLATE_MODE = self.template_mode
+
+    def run_batch(self, lines):
+        source = WORK_DIR / f"{self.output_dir.name}.jsonl"
+        source.write_text("\n".join(lines) + "\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            counts = generator.run_batch(source, self.output_dir, max_workers=2, refresh_cache=True)
+        manifest = [json.loads(line) for line in (self.output_dir / "manifest.jsonl").read_text().splitlines()]
+        return counts, {record["id"]: record for record in manifest}
+
+    def test_descriptions_are_generated(self):
+        counts, manifest = self.run_batch([json.dumps({"id": f"item{i}", "description": text}) for i, text in enumerate(DESCRIPTIONS)])
+        self.assertEqual(counts, {"ok": 2, "error": 0})
+        self.assertEqual(self.client.calls, 2)
+        for record in manifest.values():
+            self.assertEqual(record["status"], "ok")
+            self.assertTrue((self.output_dir / f"generated_diagram_{record['id']}.py").is_file())
+
+    def test_bad_lines_are_reported_and_skipped(self):
+        lines = [json.dumps({"id": "good", "description": DESCRIPTIONS[0]}), "{not json",
+                 json.dumps({"id": "empty"}), json.dumps(["a", "list"])]
+        counts, manifest = self.run_batch(lines)
+        self.assertEqual(counts, {"ok": 1, "error": 3})
+        self.assertEqual(self.client.calls, 1)
+        self.assertEqual(manifest["good"]["status"], "ok")
+        self.assertIn("line 3: no 'description'", manifest["empty"]["error"])
+        line_errors = [record["error"] for item_id, record in manifest.items() if item_id.endswith(("_2", "_4"))]
+        self.assertEqual(len(line_errors), 2)
+
+    @unittest.skipUnless(HAS_BOTOCORE, "the stand-in client raises botocore's ClientError")
+    def test_model_errors_fail_only_their_items(self):
+        self.client.errors = {generator.AWS_BEDROCK_MODEL: "ValidationException"}
+        counts, manifest = self.run_batch([json.dumps({"id": f"item{i}", "description": text}) for i, text in enumerate(DESCRIPTIONS)])
+        self.assertEqual(counts, {"ok": 0, "error": 2})
+        self.assertTrue(all("ValidationException" in record["error"] for record in manifest.values()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from support import HAS_DIAGRAMS, generator
+
+# DOT as emit_dot() and graphviz write it: one statement per line, a cluster nested in another
+NESTED_DOT = '''digraph "t" {
+	graph [pad="2.0", label="t", rankdir="LR"]
+	node [shape="box"]
+	edge [color="#7B8894"]
+	"n4" [label="S3"]
+	subgraph "cluster_a" {
+		graph [style="rounded", label="A"]
+		"n1" [label="EC2"]
+		subgraph "cluster_b" {
+			graph [style="rounded", label="B"]
+			node [fontsize="12"]
+			"n2" [label="EC2"]
+			"n3" [label="RDS"]
+		}
+	}
+	"n1" -> "n2" [dir="forward"]
+}
+'''
+
+class ParseDotGraphTest(unittest.TestCase):
+    def test_nested_cluster_attributes_are_not_nodes(self):
+        graph = generator.parse_dot_graph(NESTED_DOT)
+        self.assertEqual(graph["node_count"], 4)
+        self.assertEqual(len(graph["header"]), 4)
+        [block] = graph["blocks"]
+        self.assertEqual(block["label"], "A")
+        self.assertEqual(block["nodes"], {'"n1"', '"n2"', '"n3"'})
+        self.assertEqual([edge[:2] for edge in graph["edges"]], [('"n1"', '"n2"')])
+
+    def test_bare_attribute_statements_are_not_nodes(self):
+        dot = NESTED_DOT.replace('\t\t\tnode [fontsize="12"]', "\t\t\tgraph;\n\t\t\tnode")
+        self.assertEqual(generator.parse_dot_graph(dot)["node_count"], 4)
+
+    @unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package for the class index")
+    def test_counts_of_compiled_ir(self):
+        ir = {"title": "t", "clusters": [{"id": "a", "label": "A"}, {"id": "b", "label": "B", "parent": "a"}],
+              "nodes": [{"id": "n1", "class": "EC2", "cluster": "a"}, {"id": "n2", "class": "EC2", "cluster": "b"},
+                        {"id": "n3", "class": "RDS", "cluster": "b"}, {"id": "n4", "class": "S3"}],
+              "edges": [{"from": "n1", "to": "n2"}]}
+        graph, _ = generator.compile_graph_ir(ir)
+        parsed = generator.parse_dot_graph(generator.emit_dot(graph))
+        self.assertEqual(parsed["node_count"], 4)
+        self.assertNotIn("graph", parsed["blocks"][0]["nodes"])
+
+    @unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package for the class index")
+    def test_malformed_ir_is_a_value_error(self):
+        for ir in ({"nodes": ["a"]}, {"nodes": [{"id": "a"}], "edges": ["a->b"]},
+                   {"nodes": [{"id": "a"}], "clusters": [["c"]]}, {"nodes": [], "edges": {"from": "a"}}, {"nodes": "a"}):
+            with self.subTest(ir=ir), self.assertRaises(ValueError):
+                generator.compile_graph_ir(ir)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import contextlib
+import io
+import json
+import time
+import unittest
+from unittest import mock
+
+from support import HAS_DIAGRAMS, WORK_DIR, generator
+
+SCRIPT = '''from diagrams import Diagram
+from diagrams.aws.network import EC2
+
+with Diagram("Stream test", show=False):
+    EC2("web")
+'''
+
+class StreamingClient:
+    """Stand-in converse_stream client: the code block, then more text after a pause"""
+    def converse_stream(self, **request):
+        def events():
+            yield {"contentBlockDelta": {"delta": {"text": f"```python\n{SCRIPT}```\n"}}}
+            time.sleep(0.3)
+            yield {"contentBlockDelta": {"delta": {"text": "END OF STREAM\n"}}}
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            yield {"metadata": {"usage": {"inputTokens": 10, "outputTokens": 20, "totalTokens": 30}}}
+        return {"stream": events()}
+
+@unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package for the class index")
+class StreamValidationTest(unittest.TestCase):
+    """Early validation in the --stream path reports after the stream, not between tokens"""
+    def setUp(self):
+        self.template_mode = generator.TEMPLATE_MODE
+        generator.TEMPLATE_MODE = "off"
+        generator.set_bedrock_client(StreamingClient())
+
+    def tearDown(self):
+        generator.set_bedrock_client(None)
+        generator.TEMPLATE_MODE = self.template_mode
+
+    def test_validation_report_follows_the_stream(self):
+        with mock.patch.object(generator, "get_user_description", return_value="Stream test: one EC2 web server"), \
+                mock.patch("builtins.input", return_value="n"), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            generator.run_interactive(refresh_cache=True, stream=True)
+        output = output.getvalue()
+        self.assertLess(output.index("END OF STREAM"), output.index("[FIX] EC2 should be imported from diagrams.aws.compute"))
+        self.assertLess(output.index("Validating and auto-correcting"), output.index("[FIX] EC2"))
+
+@unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package for the class index")
+class GraphRunTest(unittest.TestCase):
+    """--ir runs against stand-in clients"""
+    def setUp(self):
+        self.template_mode = generator.TEMPLATE_MODE
+        generator.TEMPLATE_MODE = "off"
+        malformed = generator.synthesize_converse_response("")
+        malformed["output"]["message"]["content"] = [{"text": '```json\n{"nodes": ["a", "b"]}\n```'}]
+        self.client = generator.ReplayBedrockClient([malformed, generator.synthesize_converse_response(SCRIPT)])
+        generator.set_bedrock_client(self.client)
+
+    def tearDown(self):
+        generator.set_bedrock_client(None)
+        generator.TEMPLATE_MODE = self.template_mode
+
+    def test_malformed_graph_falls_back_to_python(self):
+        with mock.patch.object(generator, "get_user_description", return_value="Malformed graph test: one EC2 web server"), \
+                mock.patch("builtins.input", return_value="n"), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            generator.run_interactive(refresh_cache=True, ir=True)
+        output = output.getvalue()
+        self.assertIn("[IR ERROR] 'graph' nodes must be a list of objects", output)
+        self.assertNotIn("Unexpected error", output)
+        self.assertEqual(self.client.calls, 2)
+        self.assertIn("[FIX] EC2 should be imported from diagrams.aws.compute", output)
+
+    def test_routing_checks_do_not_record_extraction_stages(self):
+        graph = generator.synthesize_converse_response("")
+        graph["output"]["message"]["content"] = [{"text": json.dumps({"nodes": [{"id": "n1", "class": "EC2"}], "edges": []})}]
+        no_graph = generator.synthesize_converse_response("")
+        no_graph["output"]["message"]["content"] = [{"text": "Sorry, no graph."}]
+        generator.set_bedrock_client(generator.ReplayBedrockClient([no_graph, graph]))
+        saved = generator.TELEMETRY_PATH, generator.AWS_BEDROCK_MODELS, generator.AWS_BEDROCK_FAST_MODEL
+        self.addCleanup(lambda: setattr(generator, "TELEMETRY_PATH", saved[0]))
+        self.addCleanup(lambda: setattr(generator, "AWS_BEDROCK_MODELS", saved[1]))
+        self.addCleanup(lambda: setattr(generator, "AWS_BEDROCK_FAST_MODEL", saved[2]))
+        telemetry = WORK_DIR / "ir_telemetry.jsonl"
+        generator.TELEMETRY_PATH, generator.AWS_BEDROCK_MODELS, generator.AWS_BEDROCK_FAST_MODEL = str(telemetry), ["model-a", "model-b"], ""
+        with mock.patch.object(generator, "get_user_description", return_value="Extraction stage test: one EC2 server"), \
+                contextlib.redirect_stdout(io.StringIO()):
+            generator.run_interactive(refresh_cache=True, ir=True)
+        records = [json.loads(line) for line in telemetry.read_text().splitlines()]
+        self.assertEqual([record["stage"] for record in records].count("model_route"), 1)
+        self.assertEqual([record.get("format") for record in records if record["stage"] == "extraction"], ["ir"])
+
+if __name__ == "__main__":
+    unittest.main()
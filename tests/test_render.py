@@ -0,0 +1,57 @@
+import os
+import unittest
+from unittest import mock
+
+from support import HAS_DIAGRAMS, HAS_GRAPHVIZ, WORK_DIR, generator
+
+SCRIPT = '''from diagrams import Diagram
+from diagrams.aws.compute import EC2
+
+with Diagram("Render test {n}", show=False, filename="render_test_{n}"):
+    EC2("web")
+'''
+
+@unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package")
+class RenderWorkerTest(unittest.TestCase):
+    """Isolated renders run in warm, resource limited worker processes"""
+    def setUp(self):
+        self.saved = generator.RENDER_ISOLATION, generator.RENDER_TIMEOUT_SECONDS
+        generator.RENDER_ISOLATION = "subprocess"
+        generator.close_render_workers()
+
+    def tearDown(self):
+        generator.RENDER_ISOLATION, generator.RENDER_TIMEOUT_SECONDS = self.saved
+        generator.close_render_workers()
+
+    def render(self, code):
+        return generator.render_isolated(code, WORK_DIR / "render_test.py", WORK_DIR / "renders_out", use_cache=False)
+
+    def worker_pids(self):
+        slots = generator.render_worker_slots()
+        workers = [slots.get() for _ in range(slots.qsize())]
+        for worker in workers:
+            slots.put(worker)
+        return {worker.process.pid for worker in workers if worker is not None}
+
+    @unittest.skipUnless(HAS_GRAPHVIZ, "needs Graphviz")
+    def test_worker_is_reused_between_renders(self):
+        self.assertTrue(self.render(SCRIPT.format(n=1))["ok"])
+        pids = self.worker_pids()
+        self.assertTrue(self.render(SCRIPT.format(n=2))["ok"])
+        self.assertEqual(self.worker_pids(), pids)
+
+    def test_timeout_replaces_the_worker(self):
+        generator.RENDER_TIMEOUT_SECONDS = 2
+        result = self.render("from diagrams import Diagram\nwhile True:\n    pass\n")
+        self.assertEqual(result["error"]["type"], "RenderTimeout")
+        self.assertEqual(self.worker_pids(), set())
+
+    def test_workers_get_no_aws_credentials(self):
+        # diagrams exposes os, so a script can read the worker's environment
+        probe = 'from diagrams import Diagram\nraise RuntimeError(repr(Diagram.__init__.__globals__["os"].environ.get("AWS_SECRET_ACCESS_KEY")))\n'
+        with mock.patch.dict(os.environ, {"AWS_SECRET_ACCESS_KEY": "test-secret"}):
+            result = self.render(probe)
+        self.assertEqual((result["error"]["type"], result["error"]["message"]), ("RuntimeError", "None"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import contextlib
+import io
+import time
+import unittest
+
+from support import HAS_BOTOCORE, WORK_DIR, generator
+
+SCRIPT = '''from diagrams import Diagram
+from diagrams.aws.compute import EC2
+
+with Diagram("Routing test", show=False):
+    EC2("web")
+'''
+GOOD = generator.synthesize_converse_response(SCRIPT)
+NO_SCRIPT = {"output": {"message": {"role": "assistant", "content": [{"text": "Sorry, I cannot draw that."}]}},
+             "stopReason": "end_turn", "usage": {"inputTokens": 0, "outputTokens": 8, "totalTokens": 8}}
+
+class RoutingTest(unittest.TestCase):
+    """routed_converse() against stand-in clients that simulate slow and failing models"""
+    def setUp(self):
+        self.saved = generator.HEDGE_AFTER_SECONDS, generator.AWS_BEDROCK_FAST_MODEL
+        generator.model_stats.clear()
+
+    def tearDown(self):
+        generator.HEDGE_AFTER_SECONDS, generator.AWS_BEDROCK_FAST_MODEL = self.saved
+
+    def route(self, client, models, prompt):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            result = generator.routed_converse(prompt, bedrock_runtime=client, refresh=True, reasoning_config={}, models=models)
+        return result, output.getvalue()
+
+    @unittest.skipUnless(HAS_BOTOCORE, "the stand-in client raises botocore's ClientError")
+    def test_failover_follows_model_order(self):
+        client = generator.ReplayBedrockClient([GOOD], errors={"model-a": "ThrottlingException", "model-b": "ValidationException"})
+        (response, cache_hit, model_id), output = self.route(client, ["model-a", "model-b", "model-c"], "failover order")
+        self.assertEqual(model_id, "model-c")
+        self.assertFalse(cache_hit)
+        self.assertEqual(client.calls_by_model, {"model-a": 1, "model-b": 1, "model-c": 1})
+        self.assertLess(output.index("model-a failed"), output.index("model-b failed"))
+        stats = generator.model_stats
+        self.assertEqual((stats["model-a"]["errors"], stats["model-a"]["throttled"]), (1, 1))
+        self.assertEqual((stats["model-b"]["errors"], stats["model-b"]["throttled"]), (1, 0))
+        self.assertEqual((stats["model-c"]["wins"], stats["model-c"]["errors"]), (1, 0))
+
+    @unittest.skipUnless(HAS_BOTOCORE, "the stand-in client raises botocore's ClientError")
+    def test_every_model_failing_raises_the_last_error(self):
+        client = generator.ReplayBedrockClient([GOOD], errors={"model-a": "ThrottlingException", "model-b": "AccessDeniedException"})
+        with self.assertRaises(Exception) as raised:
+            self.route(client, ["model-a", "model-b"], "all failing")
+        self.assertEqual(generator.error_name(raised.exception), "AccessDeniedException")
+
+    def test_slow_model_is_hedged_and_the_loser_finishes_in_background(self):
+        generator.HEDGE_AFTER_SECONDS = 0.1
+        client = generator.ReplayBedrockClient([GOOD], delays={"model-a": 1.0})
+        start = time.perf_counter()
+        (_, _, model_id), output = self.route(client, ["model-a", "model-b"], "hedged")
+        self.assertEqual(model_id, "model-b")
+        self.assertLess(time.perf_counter() - start, 0.8)
+        self.assertIn("No response after 0.1s", output)
+        # The losing call is not cancelled: it completes later without counting as a win
+        deadline = time.time() + 5
+        while "model-a" not in generator.model_stats and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual((generator.model_stats["model-a"]["calls"], generator.model_stats["model-a"]["wins"]), (1, 0))
+
+    def test_fast_answer_is_not_hedged(self):
+        generator.HEDGE_AFTER_SECONDS = 0.5
+        client = generator.ReplayBedrockClient([GOOD], delays={"model-a": 0.05})
+        (_, _, model_id), _ = self.route(client, ["model-a", "model-b"], "not hedged")
+        self.assertEqual(model_id, "model-a")
+        self.assertEqual(client.calls_by_model, {"model-a": 1})
+
+    def test_response_without_script_fails_over(self):
+        client = generator.ReplayBedrockClient([NO_SCRIPT, GOOD])
+        (_, _, model_id), output = self.route(client, ["model-a", "model-b"], "no script")
+        self.assertEqual(model_id, "model-b")
+        self.assertIn("model-a returned no valid script", output)
+
+    def test_short_descriptions_go_to_the_fast_model_first(self):
+        generator.AWS_BEDROCK_FAST_MODEL = "model-fast"
+        self.assertEqual(generator.route_models("Users -> S3")[0], "model-fast")
+        self.assertEqual(generator.route_models(" ".join(["word"] * (generator.ROUTING_SIMPLE_MAX_WORDS + 1)))[-1], "model-fast")
+
+    def test_empty_model_list_is_a_clear_error(self):
+        generator.AWS_BEDROCK_MODELS, saved = [], generator.AWS_BEDROCK_MODELS
+        self.addCleanup(setattr, generator, "AWS_BEDROCK_MODELS", saved)
+        with self.assertRaisesRegex(ValueError, "AWS_BEDROCK_MODELS"):
+            generator.route_models("Users -> S3")
+
+@unittest.skipUnless(HAS_BOTOCORE, "the stand-in client raises botocore's ClientError")
+class AllModelsFailingTest(unittest.TestCase):
+    """Callers of routed_converse() report a failed run instead of crashing when every model fails"""
+    def setUp(self):
+        self.saved = generator.AWS_BEDROCK_MODELS, generator.AWS_BEDROCK_FAST_MODEL, generator.TEMPLATE_MODE
+        generator.AWS_BEDROCK_MODELS, generator.AWS_BEDROCK_FAST_MODEL, generator.TEMPLATE_MODE = ["model-a", "model-b"], "", "off"
+        generator.set_bedrock_client(generator.ReplayBedrockClient(
+            [GOOD], errors={"model-a": "ThrottlingException", "model-b": "ServiceUnavailableException"}))
+
+    def tearDown(self):
+        generator.set_bedrock_client(None)
+        generator.AWS_BEDROCK_MODELS, generator.AWS_BEDROCK_FAST_MODEL, generator.TEMPLATE_MODE = self.saved
+
+    def test_repair_loop_returns_a_failed_result(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = generator.generate_with_repair("All failing: EC2 behind an ALB", 3, script_path=WORK_DIR / "failing.py",
+                                                    refresh_cache=True)
+        self.assertFalse(result["ok"])
+        self.assertEqual(len(result["attempts"]), 1)
+        self.assertTrue(result["attempts"][0]["error"].startswith("ServiceUnavailableException"))
+
+    def test_service_repair_path_marks_the_run_failed(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            status, body = generator.serve_generate({"description": "All failing: Lambda reading S3", "repair_attempts": 2,
+                                                     "refresh": True}, None)
+        self.assertEqual((status, body["ok"]), (422, False))
+        self.assertEqual(generator.find_run(body["run"])["status"], "error")
+
+    def test_update_marks_the_run_failed(self):
+        script, old, new = WORK_DIR / "update_failing.py", WORK_DIR / "update_old.txt", WORK_DIR / "update_new.txt"
+        script.write_text(SCRIPT)
+        old.write_text("One EC2 web server")
+        new.write_text("One EC2 web server and an S3 bucket")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            generator.run_update(script, old, new, refresh_cache=True)
+        self.assertIn("No model could answer", output.getvalue())
+        run = generator.find_run("latest")
+        self.assertEqual((run["kind"], run["status"]), ("update", "error"))
+
+if __name__ == "__main__":
+    unittest.main()
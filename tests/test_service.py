@@ -0,0 +1,153 @@
+import asyncio
+import contextlib
+import http.client
+import io
+import json
+import threading
+import unittest
+
+from support import HAS_DIAGRAMS, HAS_GRAPHVIZ, generator
+
+class RunningService:
+    """DiagramService on an ephemeral local port, its event loop in a background thread"""
+    def __init__(self, workers=2, queue_size=8):
+        self.service = generator.DiagramService(workers, queue_size)
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        async def start():
+            await self.service.start()
+            self.server = await asyncio.start_server(self.service.handle_connection, "127.0.0.1", 0)
+            self.port = self.server.sockets[0].getsockname()[1]
+            started.set()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(start())
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait(10)
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def request(self, method, path, payload=None, headers=None):
+        """(status, headers, body) of one request; JSON bodies are decoded"""
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        body = json.dumps(payload).encode() if isinstance(payload, dict) else payload
+        connection.request(method, path, body, {"Content-Type": "application/json", **(headers or {})})
+        response = connection.getresponse()
+        body = response.read()
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            body = json.loads(body)
+        connection.close()
+        return response.status, dict(response.getheaders()), body
+
+    def load(self, endpoint, payloads, requests, concurrency):
+        """load_test_requests() of the loadtest command against this service"""
+        return asyncio.run(generator.load_test_requests(self.url, endpoint, payloads, requests, concurrency))
+
+    def stop(self):
+        async def shutdown():
+            self.server.close()
+            await self.server.wait_closed()
+            for task in self.service.tasks:
+                task.cancel()
+            await asyncio.gather(*self.service.tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        self.loop.close()
+        self.service.executor.shutdown(wait=True)
+
+@unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package for the class index")
+class ServiceTest(unittest.TestCase):
+    """The HTTP service against a slow stand-in Bedrock client"""
+    def setUp(self):
+        self.template_mode = generator.TEMPLATE_MODE
+        generator.TEMPLATE_MODE = "off"
+        self.client = generator.replay_bedrock_client(delay=0.5)
+        generator.set_bedrock_client(self.client)
+        generator.set_validate_class_map(generator.build_aws_class_to_module_map())
+        self.running = None
+
+    def tearDown(self):
+        if self.running:
+            self.running.stop()
+        generator.set_bedrock_client(None)
+        generator.TEMPLATE_MODE = self.template_mode
+
+    def start(self, workers=2, queue_size=8):
+        self.running = RunningService(workers, queue_size)
+        return self.running
+
+    def test_identical_requests_share_one_job(self):
+        service = self.start()
+        payload = {"description": "Coalescing test: an ALB in a VPC in front of EC2 web servers and an RDS database",
+                   "render": False, "refresh": True}
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = service.load("generate", [payload], requests=8, concurrency=8)
+        self.assertEqual([status for status, _, _ in results], [200] * 8)
+        self.assertEqual(service.service.stats["jobs"], 1)
+        self.assertEqual(self.client.calls, 1)
+        self.assertEqual(sum(coalesced for _, _, coalesced in results), 7)
+
+    def test_full_queue_answers_503(self):
+        service = self.start(workers=1, queue_size=1)
+        payloads = [{"description": f"Backpressure test {i}: EC2 servers in a private subnet writing to S3 and DynamoDB",
+                     "render": False, "refresh": True} for i in range(6)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = service.load("generate", payloads, requests=6, concurrency=6)
+        statuses = sorted(status for status, _, _ in results)
+        self.assertIn(503, statuses)
+        self.assertIn(200, statuses)
+        self.assertEqual(service.service.stats["rejected"], statuses.count(503))
+        self.assertLessEqual(self.client.calls, 2)
+
+    def test_endpoints(self):
+        service = self.start()
+        status, _, health = service.request("GET", "/health")
+        self.assertEqual((status, health["status"]), (200, "ok"))
+        broken = "from diagrams import Diagram\nfrom diagrams.aws.network import EC2\n\nwith Diagram('t', show=False):\n    EC2('web')\n"
+        status, headers, body = service.request("POST", "/repair", {"code": broken})
+        self.assertEqual(status, 200)
+        self.assertIn("from diagrams.aws.compute import EC2", body["code"])
+        self.assertEqual(headers["X-Coalesced"], "false")
+        with contextlib.redirect_stdout(io.StringIO()):
+            status, _, body = service.request("POST", "/generate", {"description": "Endpoint test: Lambda in a VPC reading RDS",
+                                                                     "render": False, "refresh": True})
+        self.assertEqual(status, 200)
+        status, _, run = service.request("GET", f"/runs/{body['run']}")
+        self.assertEqual((status, run["kind"], run["status"]), (200, "service", "ok"))
+        status, _, script = service.request("GET", f"/runs/{body['run']}/{run['files']['script']}")
+        self.assertEqual(status, 200)
+        self.assertEqual(script.decode(), body["code"])
+
+    def test_requests_that_are_refused(self):
+        service = self.start()
+        runs_before = dict(generator.load_run_index())
+        self.assertEqual(service.request("POST", "/repair", b'{"code": "x"}', {"Content-Type": "text/plain"})[0], 415)
+        self.assertEqual(service.request("POST", "/repair", {"code": "x"}, {"Origin": "http://example.com"})[0], 403)
+        self.assertEqual(service.request("POST", "/render", {"code": "import os"})[0], 400)
+        self.assertEqual(service.request("POST", "/render", {"run": "../../etc"})[0], 400)
+        self.assertEqual(service.request("POST", "/render", {"graph": {"nodes": ["a"]}})[0], 400)
+        self.assertEqual(service.request("POST", "/generate", b"{not json")[0], 400)
+        for attempts in ("x", -1, 1.5, True):
+            status, _, body = service.request("POST", "/generate", {"description": "Bad attempts: EC2", "repair_attempts": attempts})
+            self.assertEqual(status, 400, attempts)
+        self.assertEqual(service.request("GET", "/generate")[0], 405)
+        self.assertEqual(service.request("GET", "/nothing")[0], 404)
+        self.assertEqual(self.client.calls, 0)
+        self.assertEqual(generator.load_run_index(), runs_before)
+
+    @unittest.skipUnless(HAS_GRAPHVIZ, "needs Graphviz")
+    def test_render_of_a_json_graph(self):
+        service = self.start()
+        [payload] = generator.load_test_payloads("render", 1)
+        status, _, body = service.request("POST", "/render", payload)
+        self.assertEqual(status, 200)
+        self.assertEqual(body["layout"][0]["nodes"], 20)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import ast
+import contextlib
+import io
+import unittest
+
+from support import generator
+
+HEADER = '''from diagrams import Diagram
+from diagrams.aws.compute import EC2
+from diagrams.aws.network import ELB
+
+with Diagram("Static test", show=False):
+    lb = ELB("lb")
+    web = [EC2("web1"), EC2("web2")]
+    api = [EC2("api1"), EC2("api2")]
+'''
+
+class DuplicateEdgeTest(unittest.TestCase):
+    """DuplicateEdge follows nodes, not variable names, and its fix keeps the script valid"""
+    def errors(self, code):
+        return [error["type"] for error in generator.analyze_diagram_script(code)["errors"]]
+
+    def check(self, code):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return generator.check_diagram_script(code)
+
+    def test_rebound_loop_target_is_not_a_duplicate(self):
+        code = HEADER + "    for svc in web:\n        lb >> svc\n    for svc in api:\n        lb >> svc\n"
+        self.assertEqual(self.errors(code), [])
+        fixed_code, report = self.check(code)
+        self.assertEqual((fixed_code, report["errors"]), (code, []))
+
+    def test_reassigned_name_is_not_a_duplicate(self):
+        code = HEADER + "    node = web[0]\n    lb >> node\n    node = api[0]\n    lb >> node\n"
+        self.assertEqual(self.errors(code), [])
+
+    def test_repeated_link_is_still_a_duplicate(self):
+        code = HEADER + "    lb >> web[0]\n    lb >> web[0]\n"
+        self.assertEqual(self.errors(code), ["DuplicateEdge"])
+        fixed_code, report = self.check(code)
+        self.assertEqual(fixed_code.count("lb >> web[0]"), 1)
+        self.assertEqual(report["errors"], [])
+
+    def test_duplicate_alone_in_its_block_becomes_pass(self):
+        code = HEADER + "    lb >> web[0]\n    if web:\n        lb >> web[0]\n"
+        fixed_code, report = self.check(code)
+        ast.parse(fixed_code)
+        self.assertIn("    if web:\n        pass\n", fixed_code)
+        self.assertEqual([error["type"] for error in report["fixed"]], ["DuplicateEdge"])
+
+if __name__ == "__main__":
+    unittest.main()
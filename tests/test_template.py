@@ -0,0 +1,53 @@
+import ast
+import unittest
+
+from support import HAS_DIAGRAMS, generator
+
+class TemplateTitleTest(unittest.TestCase):
+    """template_title() cuts long descriptions at a clause boundary"""
+    def test_leading_clauses_that_fit(self):
+        title = generator.template_title("Users call API Gateway, which invokes Lambda, which writes to DynamoDB and S3")
+        self.assertEqual(title, "Users call API Gateway, which invokes Lambda")
+
+    def test_short_description_is_kept_whole(self):
+        self.assertEqual(generator.template_title("API Gateway to Lambda to DynamoDB."), "API Gateway to Lambda to DynamoDB")
+
+    def test_long_first_clause_gets_an_ellipsis(self):
+        title = generator.template_title("Users call API Gateway which invokes Lambda which reads from S3 and writes to DynamoDB")
+        self.assertEqual(title, "Users call API Gateway which invokes Lambda which reads from S3 and...")
+
+@unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package for the class index")
+class TemplateScriptTest(unittest.TestCase):
+    """Services in template scripts come from their usual module"""
+    def setUp(self):
+        self.template_mode = generator.TEMPLATE_MODE
+        generator.TEMPLATE_MODE = "on"
+
+    def tearDown(self):
+        generator.TEMPLATE_MODE = self.template_mode
+
+    def test_api_gateway_is_the_network_class(self):
+        [mention] = generator.find_service_mentions("an API Gateway")
+        self.assertEqual((mention["module"], mention["class"]), ("diagrams.aws.network", "APIGateway"))
+        code = generator.template_script("Users call API Gateway, which invokes Lambda, which writes to DynamoDB and S3")
+        self.assertIn("from diagrams.aws.network import APIGateway", code)
+        self.assertIn('with Diagram("Users call API Gateway, which invokes Lambda"', code)
+        ast.parse(code)
+
+    def test_link_verbs_are_not_services(self):
+        classes = [mention["class"] for mention in generator.find_service_mentions("CloudFront serves S3 content")]
+        self.assertEqual(classes, ["CloudFront", "S3"])
+
+    def test_descriptions_the_template_cannot_draw_go_to_the_model(self):
+        for description in ("CloudFront serves S3 content; backup to Glacier", "EC2 -> EC2",
+                            "the function calls the function", "Lambda does not write to DynamoDB",
+                            "Lambda and DynamoDB"):
+            with self.subTest(description=description):
+                self.assertIsNone(generator.template_script(description))
+
+    def test_plain_chain_uses_the_template(self):
+        code = generator.template_script("CloudFront serves S3")
+        self.assertIn("cloudfront >> s3", code)
+
+if __name__ == "__main__":
+    unittest.main()
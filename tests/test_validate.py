@@ -0,0 +1,81 @@
+import contextlib
+import io
+import json
+import sys
+import threading
+import unittest
+
+from support import HAS_DIAGRAMS, WORK_DIR, generator
+
+SCRIPT = '''from diagrams import Diagram
+from diagrams.aws.network import EC2
+
+with Diagram("Validate test", show=False):
+    EC2("web")
+'''
+
+@unittest.skipUnless(HAS_DIAGRAMS, "needs the diagrams package for the class index")
+class ValidateTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = generator.TELEMETRY_PATH, generator._validate_class_map, generator._validate_class_map_key
+
+    def tearDown(self):
+        generator.TELEMETRY_PATH, generator._validate_class_map, generator._validate_class_map_key = self.saved
+
+    def test_serial_validate_keeps_telemetry(self):
+        directory = WORK_DIR / "validate_serial"
+        directory.mkdir(exist_ok=True)
+        for name in ("a.py", "b.py"):
+            (directory / name).write_text(SCRIPT)
+        telemetry = WORK_DIR / "validate_telemetry.jsonl"
+        generator.TELEMETRY_PATH = str(telemetry)
+        with contextlib.redirect_stdout(io.StringIO()):
+            generator.run_validate_command([str(directory)], workers=1)
+        self.assertEqual(generator.TELEMETRY_PATH, str(telemetry))
+        stages = [json.loads(line)["stage"] for line in telemetry.read_text().splitlines()]
+        self.assertIn("bulk_validate", stages)
+
+    def test_single_file_reports_its_changes(self):
+        path = WORK_DIR / "validate_single.py"
+        path.write_text(SCRIPT + "    missing >> EC2('db')\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            record = generator.repair_script_file(path, class_map=generator.build_aws_class_to_module_map(), verbose=True)
+        self.assertEqual(record["status"], "error")
+        self.assertEqual(record["changes"], ["[FIX] EC2 should be imported from diagrams.aws.compute"])
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertFalse(generator.run_validate_command([str(path)]))
+        self.assertIn("Corrections available; rerun with --write to save them.", output.getvalue())
+
+    def test_repair_cache_follows_the_class_map(self):
+        class_map = generator.build_aws_class_to_module_map()
+        generator.set_validate_class_map(class_map)
+        fixed_code, _, _ = generator.repair_script_text(SCRIPT)
+        self.assertIn("from diagrams.aws.compute import EC2", fixed_code)
+        # The same text repaired against another map must not come from the cache
+        generator.set_validate_class_map({**class_map, "EC2": "diagrams.aws.general"})
+        fixed_code, _, _ = generator.repair_script_text(SCRIPT)
+        self.assertIn("from diagrams.aws.general import EC2", fixed_code)
+
+    def test_repair_changes_ignore_other_threads(self):
+        generator.set_validate_class_map(generator.build_aws_class_to_module_map())
+        stop = threading.Event()
+        def noisy():
+            while not stop.is_set():
+                print("[FIX] Foreign should be imported from elsewhere")
+        thread = threading.Thread(target=noisy)
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+        with contextlib.redirect_stdout(io.StringIO()):
+            thread.start()
+            try:
+                results = [generator.serve_repair({"code": SCRIPT.replace("Validate test", f"Thread test {i}")}, None)
+                           for i in range(30)]
+            finally:
+                stop.set()
+                thread.join()
+        for status, body in results:
+            self.assertEqual(body["changes"], ["[FIX] EC2 should be imported from diagrams.aws.compute"])
+
+if __name__ == "__main__":
+    unittest.main()